@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+# benchmark.py
+#
+# Times the checking pipeline on synthetic input: building the graph of a large course,
+# evaluating a deep and wide check tree with Strategy.check_submission, rendering its instructions
+# and checking a whole batch end to end with check_submission_batch on an eager Celery app.
+# Courses, check trees and git repositories are generated, so nothing but git is needed.
+# If the `config` module of the host project is importable, its Celery app is used (in eager mode),
+# otherwise an eager app with an in-memory broker stands in for it.
+#
+# Results can be written as JSON with --output and compared with an earlier run with --baseline.
+# A benchmark whose median is more than --tolerance slower than in the baseline counts as a regression
+# and makes the script exit with status 1. Benchmarks that ran with other parameters are not compared.
+#
+# usage: python benchmark.py [--nodes N] [--tree-depth D] [--tree-width W] [--files N] [--exercises N]
+#                            [--repeats N] [--only NAME ...] [--output FILE] [--baseline FILE] [--tolerance FRACTION]
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import types
+from boot_django import boot_django
+
+BENCHMARKS = ('course_graph','strategy_check','render_instructions','check_batch')
+COURSE_MODULE = 'xchk_benchmark_course'
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmarks for the xchk checking pipeline.')
+    parser.add_argument('--nodes',type=int,default=2000,help='content nodes in the synthetic course')
+    parser.add_argument('--fan-in',type=int,default=3,help='prerequisites per content node')
+    parser.add_argument('--tree-depth',type=int,default=4,help='levels of composite checks in a strategy')
+    parser.add_argument('--tree-width',type=int,default=4,help='children of every composite check')
+    parser.add_argument('--files',type=int,default=200,help='files in the generated repositories')
+    parser.add_argument('--file-size',type=int,default=1024,help='size of every generated file in bytes')
+    parser.add_argument('--exercises',type=int,default=10,help='submissions in a checked batch')
+    parser.add_argument('--repeats',type=int,default=5)
+    parser.add_argument('--seed',type=int,default=42)
+    parser.add_argument('--only',nargs='+',choices=BENCHMARKS,default=list(BENCHMARKS))
+    parser.add_argument('--output',help='file to write the results to, as JSON')
+    parser.add_argument('--baseline',help='results of an earlier run, as written by --output')
+    parser.add_argument('--tolerance',type=float,default=0.25,help='allowed slowdown compared to the baseline, e.g. 0.25 for 25%%')
+    return parser.parse_args()
+
+def make_repo(path,files):
+    subprocess.run(['git','init','-q',path],check=True)
+    for (name,content) in files.items():
+        os.makedirs(os.path.dirname(os.path.join(path,name)),exist_ok=True)
+        with open(os.path.join(path,name),'w') as fh:
+            fh.write(content)
+    subprocess.run(['git','add','-A'],cwd=path,check=True)
+    subprocess.run(['git','-c','user.name=benchmark','-c','user.email=benchmark@localhost','commit','-q','-m','benchmark'],cwd=path,check=True)
+
+def synthetic_files(rng,count,size):
+    """Returns `count` files of `size` bytes, spread over ten directories, as a dict from path to content."""
+    return {f'dir{idx % 10}/file{idx}.txt': ''.join(rng.choice('abcdefghij\n') for _ in range(size)) for idx in range(count)}
+
+def check_tree(rng,depth,width,leaves):
+    """Returns a tree of conjunctions and disjunctions that accepts a checkout containing all of `leaves`.
+
+    Every disjunction starts with a failing child, so it cannot short-circuit on its first child."""
+    from xchk_core.strats import ConjunctiveCheck, DisjunctiveCheck, FileExistsCheck, Negation, TrueCheck
+    if depth == 0:
+        (name,_) = os.path.splitext(rng.choice(leaves))
+        return FileExistsCheck(name,'txt')
+    children = [check_tree(rng,depth-1,width,leaves) for _ in range(width)]
+    if depth % 2 == 0:
+        return ConjunctiveCheck(children)
+    return DisjunctiveCheck([Negation(TrueCheck())] + children[1:])
+
+def synthetic_course(rng,args,files,solutions_url):
+    """Registers a course module with `args.nodes` content nodes, of which the first `args.exercises` get a large strategy.
+
+    Every node depends on `args.fan_in` of the fifty nodes before it."""
+    from django.conf import settings
+    from xchk_core import courses
+    from xchk_core.contentviews import ContentView, invalidate_contentview_registry
+    from xchk_core.strats import Strategy
+    leaves = sorted(files)
+    nodes = []
+    for idx in range(args.nodes):
+        attrs = {'uid': f'benchmark_{idx}','__module__': f'{COURSE_MODULE}.course'}
+        if idx < args.exercises:
+            attrs['strat'] = Strategy(accepting_check=check_tree(rng,args.tree_depth,args.tree_width,leaves))
+        nodes.append(type(f'BenchmarkNode{idx}',(ContentView,),attrs))
+    structure = [(node,rng.sample(nodes[max(0,idx-50):idx],min(args.fan_in,idx))) for (idx,node) in enumerate(nodes) if idx > 0]
+    course_module = types.ModuleType(f'{COURSE_MODULE}.course')
+    course_module.course = courses.Course('benchmark','synthetic course',structure,solutions_url)
+    sys.modules[COURSE_MODULE] = types.ModuleType(COURSE_MODULE)
+    sys.modules[course_module.__name__] = course_module
+    # the course registry is built when Django starts, before the course exists
+    settings.XCHK_SOURCE_COURSES = {'benchmark': COURSE_MODULE}
+    courses.registry.invalidate()
+    invalidate_contentview_registry()
+    return nodes
+
+def eager_celery():
+    """Makes the Celery app of `config` run tasks eagerly, providing `config` if the host project does not."""
+    try:
+        import config
+    except ImportError:
+        import celery
+        config = types.ModuleType('config')
+        config.celery_app = celery.Celery('xchk-benchmark',broker='memory://',backend='cache+memory://')
+        sys.modules['config'] = config
+    config.celery_app.conf.task_always_eager = True
+    config.celery_app.conf.task_eager_propagates = True
+
+def timed(repeats,run,prepare=lambda: None):
+    """Calls `run` with the result of `prepare` `repeats` times and returns the wall times of the calls."""
+    samples = []
+    for _ in range(repeats):
+        prepared = prepare()
+        start = time.perf_counter()
+        run(prepared)
+        samples.append(time.perf_counter() - start)
+    return samples
+
+def summary(samples,**params):
+    return {'median_s': statistics.median(samples),'min_s': min(samples),'samples_s': samples,'params': params}
+
+def bench_course_graph(args,context):
+    from xchk_core import courses
+    def build(_):
+        courses.registry.invalidate()
+        courses.registry.build()
+    return summary(timed(args.repeats,build),nodes=args.nodes,fan_in=args.fan_in)
+
+def bench_strategy_check(args,context):
+    from xchk_core.models import SubmissionState, SubmissionV2
+    node = context['nodes'][0]
+    submission = SubmissionV2(content_uid=node.uid)
+    def check(_):
+        (state,_) = node.strat.check_submission(submission,context['student_dir'],context['solutions_dir'])
+        if state != SubmissionState.ACCEPTED:
+            raise RuntimeError(f'synthetic strategy did not accept: {state}')
+    return summary(timed(args.repeats,check),tree_depth=args.tree_depth,tree_width=args.tree_width,files=args.files)
+
+def bench_render_instructions(args,context):
+    from xchk_core.templatetags import xchk_instructions
+    node = context['nodes'][0]
+    instructions = node.strat.instructions(node.uid)
+    def render(_):
+        # rendered HTML is cached per instructions object
+        xchk_instructions._rendered_instructions.clear()
+        xchk_instructions.node_instructions_2_ul(instructions)
+    return summary(timed(args.repeats,render),tree_depth=args.tree_depth,tree_width=args.tree_width)
+
+def bench_check_batch(args,context):
+    from django.contrib.auth.models import User
+    from xchk_core import tasks
+    from xchk_core.models import Repo, SubmissionState, SubmissionV2
+    user = User.objects.create(username='benchmark')
+    repo = Repo.objects.create(url=f"file://{context['student_dir']}",user=user,course='benchmark')
+    uids = [node.uid for node in context['nodes'][:args.exercises]]
+
+    def submit():
+        return [SubmissionV2.objects.create(timestamp=datetime.datetime.now(),repo=repo,submitter=user,content_uid=uid).id for uid in uids]
+
+    def check(submission_ids):
+        tasks.publish_check(0,repo,submission_ids,'benchmark')
+
+    def verify(submission_ids):
+        states = set(SubmissionV2.objects.filter(id__in=submission_ids).values_list('state',flat=True))
+        if states != {SubmissionState.ACCEPTED}:
+            raise RuntimeError(f'synthetic batch was not accepted: {states}')
+
+    # the first batch clones the repositories into the repository cache, later ones only fetch
+    cold = submit()
+    [cold_time] = timed(1,check,lambda: cold)
+    verify(cold)
+    warm = []
+    samples = timed(args.repeats,check,lambda: warm.append(submit()) or warm[-1])
+    for submission_ids in warm:
+        verify(submission_ids)
+    return dict(summary(samples,exercises=args.exercises,files=args.files,file_size=args.file_size,tree_depth=args.tree_depth,tree_width=args.tree_width),
+                cold_s=cold_time)
+
+def regressions(results,baseline,tolerance):
+    """Returns `(name, baseline median, median)` for every benchmark that got more than `tolerance` slower."""
+    slower = []
+    for (name,result) in results.items():
+        previous = baseline['results'].get(name)
+        if previous is None or previous['params'] != result['params']:
+            continue
+        if result['median_s'] > previous['median_s'] * (1 + tolerance):
+            slower.append((name,previous['median_s'],result['median_s']))
+    return slower
+
+def main():
+    args = parse_args()
+    rng = random.Random(args.seed)
+    tmp = tempfile.mkdtemp(prefix='xchk-benchmark-')
+    boot_django(DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3','NAME': os.path.join(tmp,'db.sqlite3')}},
+                CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+                        # every batch has to be checked, not looked up
+                        'benchmark-verdicts': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}},
+                CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+                XCHK_VERDICT_CACHE_ALIAS='benchmark-verdicts',
+                XCHK_REPO_CACHE_DIR=os.path.join(tmp,'cache'),
+                XCHK_WORKSPACE_DIR=tmp)
+    try:
+        from django.core.management import call_command
+        call_command('migrate',verbosity=0)
+        eager_celery()
+        files = synthetic_files(rng,args.files,args.file_size)
+        context = {'solutions_dir': os.path.join(tmp,'solutions'),'student_dir': os.path.join(tmp,'student')}
+        make_repo(context['solutions_dir'],files)
+        make_repo(context['student_dir'],files)
+        context['nodes'] = synthetic_course(rng,args,files,f"file://{context['solutions_dir']}")
+        results = {}
+        for name in BENCHMARKS:
+            if name in args.only:
+                results[name] = globals()[f'bench_{name}'](args,context)
+                print(f"{name:22} median {results[name]['median_s'] * 1000:10.2f}ms  min {results[name]['min_s'] * 1000:10.2f}ms")
+    finally:
+        shutil.rmtree(tmp,ignore_errors=True)
+    output = {'python': platform.python_version(),'platform': platform.platform(),'results': results}
+    if args.output:
+        with open(args.output,'w') as fh:
+            json.dump(output,fh,indent=2)
+    if args.baseline:
+        with open(args.baseline) as fh:
+            slower = regressions(results,json.load(fh),args.tolerance)
+        for (name,previous,current) in slower:
+            print(f'REGRESSION {name}: {previous * 1000:.2f}ms -> {current * 1000:.2f}ms')
+        if slower:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
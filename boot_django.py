@@ -8,8 +8,9 @@ from django.conf import settings
 
 BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "xchk_core"))
 
-def boot_django():
-    settings.configure(
+def boot_django(**extra_settings):
+    """`extra_settings` are added to the defaults below or replace them."""
+    options = dict(
         DEBUG=True,
         DATABASES={
 
@@ -30,4 +31,6 @@ def boot_django():
             "xchk_core",
         ),
     )
+    options.update(extra_settings)
+    settings.configure(**options)
     django.setup()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# consumer_load_test.py
+#
+# Opens many websocket connections at once to the sync and the async consumers
+# and reports how long it takes to connect them all, to handle one check request
+# per connection and to deliver one completion message to every connection.
+# Publishing a task is replaced by a sleep of --publish-delay seconds, so no broker is needed.
+# If the `config` module of the host project is not importable, the stand-in of benchmark.py is used.
+#
+# usage: python consumer_load_test.py [--connections N] [--publish-delay SECONDS]
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import tempfile
+import threading
+import time
+from benchmark import eager_celery
+from boot_django import boot_django
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Load test for the xchk websocket consumers.')
+    parser.add_argument('--connections',type=int,default=200)
+    parser.add_argument('--publish-delay',type=float,default=0.005)
+    return parser.parse_args()
+
+async def run_scenario(consumer_class,users,repo_id):
+    from channels.layers import get_channel_layer
+    from channels.testing import WebsocketCommunicator
+
+    def application_for(user):
+        # what AuthMiddlewareStack would do for a logged in user
+        return lambda scope: consumer_class(dict(scope,user=user))
+
+    communicators = [WebsocketCommunicator(application_for(user),'/ws/sock/') for user in users]
+    start = time.perf_counter()
+    await asyncio.gather(*(communicator.connect() for communicator in communicators))
+    connect_time = time.perf_counter() - start
+
+    async def check_request(communicator):
+        request_start = time.perf_counter()
+        await communicator.send_to(text_data=json.dumps({'repo': repo_id,'exercises': ['impossible_node'],'batchtype': 0}))
+        # the consumer does not answer a successful request, so wait until the group message of the "task" arrives
+        await communicator.receive_from(timeout=60)
+        return time.perf_counter() - request_start
+
+    channel_layer = get_channel_layer()
+
+    async def complete_all():
+        # stands in for notify_result of every batch, sent once the requests were handled
+        while _published[consumer_class] < len(users):
+            await asyncio.sleep(0.001)
+        await asyncio.gather(*(channel_layer.group_send(f'user{user.id}',{'type': 'completion','last_reached_file': 'impossible_node','analysis': []}) for user in users))
+
+    start = time.perf_counter()
+    (latencies,_) = await asyncio.gather(asyncio.gather(*(check_request(communicator) for communicator in communicators)),complete_all())
+    request_time = time.perf_counter() - start
+    await asyncio.gather(*(communicator.disconnect() for communicator in communicators))
+    latencies = sorted(latencies)
+    return {'connect_s': connect_time,
+            'requests_s': request_time,
+            'median_latency_s': statistics.median(latencies),
+            'p95_latency_s': latencies[int(0.95 * (len(latencies) - 1))]}
+
+# publications per consumer class, task publication runs in worker threads
+_published = {}
+_published_lock = threading.Lock()
+
+def main():
+    args = parse_args()
+    database = tempfile.NamedTemporaryFile(suffix='.sqlite3',delete=False)
+    database.close()
+    boot_django(DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3','NAME': database.name}},
+                CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer','CONFIG': {'capacity': 10 * args.connections}}})
+    try:
+        from django.core.management import call_command
+        from django.contrib.auth.models import User
+        # xchk_core.tasks imports the Celery app from `config`, no task actually runs
+        eager_celery()
+        from xchk_core import consumers
+        from xchk_core.models import Repo
+        call_command('migrate',verbosity=0)
+        results = {}
+        for consumer_class in (consumers.CheckRequestConsumer,consumers.AsyncCheckRequestConsumer):
+            # fresh users for every scenario, so the fifteen second limit does not refuse the requests
+            User.objects.bulk_create([User(username=f'{consumer_class.__name__}{idx}') for idx in range(args.connections)])
+            users = list(User.objects.filter(username__startswith=consumer_class.__name__))
+            repo = Repo.objects.create(url='file:///dev/null',user=users[0],course='loadtest')
+            _published[consumer_class] = 0
+
+            def publish(batchtype,submissions,group_name,consumer_class=consumer_class):
+                time.sleep(args.publish_delay)
+                with _published_lock:
+                    _published[consumer_class] += 1
+
+            consumers._publish_check = publish
+            results[consumer_class.__name__] = asyncio.run(run_scenario(consumer_class,users,repo.id))
+        print(f'{args.connections} connections, {args.publish_delay * 1000:.1f} ms per task publication')
+        for (name,result) in results.items():
+            print(f"{name:28} connect {result['connect_s']:7.3f}s  requests {result['requests_s']:7.3f}s  "
+                  f"median {result['median_latency_s'] * 1000:8.1f}ms  p95 {result['p95_latency_s'] * 1000:8.1f}ms")
+    finally:
+        os.unlink(database.name)
+
+if __name__ == '__main__':
+    main()
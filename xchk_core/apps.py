@@ -7,4 +7,7 @@ class CheckerappConfig(AppConfig):
 
     def ready(self):
         from .signals import handlers
+        from . import courses
+        # course graphs are built once per process, not per request
+        courses.registry.build()
 
@@ -0,0 +1,109 @@
+"""Coalescing of identical check requests.
+
+A check request is identified by the repository, the exercises (in order) and the batch type.
+While a batch for such a request is queued or running, later identical requests subscribe to it
+instead of starting a batch of their own. When the batch is done, its result is copied to their submissions
+and sent to their channel groups. Subscribers that arrived while the batch was already running
+only get the result if HEAD of the repository did not move in the meantime.
+
+The in-flight registry lives in the Django cache named by `XCHK_COALESCE_CACHE_ALIAS`, which has to be shared
+by the consumers and the workers and support atomic `add` and `incr`, e.g. memcached or redis.
+It is disabled by default. A batch that never runs or never finishes, e.g. because it expired in its queue or its worker died,
+would make identical requests wait for nothing, so entries expire: a queued batch after `BATCH_EXPIRES` seconds,
+when Celery drops it, and a running batch after `XCHK_COALESCE_TIMEOUT` seconds. Keep the latter just above
+the time the longest batch may take, e.g. the `task_time_limit` of the workers.
+"""
+import hashlib
+import json
+import uuid
+from django.conf import settings
+from django.core.cache import caches
+
+# seconds a published batch may wait in its queue before Celery drops it
+BATCH_EXPIRES = 300
+DEFAULT_TIMEOUT = 300
+CACHE_KEY_PREFIX = 'xchk-inflight'
+
+STATE_QUEUED = 'queued'
+STATE_RUNNING = 'running'
+
+def _cache():
+    alias = getattr(settings,'XCHK_COALESCE_CACHE_ALIAS',None)
+    return caches[alias] if alias is not None else None
+
+def _timeout():
+    return getattr(settings,'XCHK_COALESCE_TIMEOUT',DEFAULT_TIMEOUT)
+
+def enabled():
+    return _cache() is not None
+
+def request_key(repo_id,content_uids,batchtype_id):
+    # order matters, exercises after the first refused one are not reached
+    request = json.dumps([repo_id,list(content_uids),batchtype_id])
+    return f"{CACHE_KEY_PREFIX}-{hashlib.sha256(request.encode('utf-8')).hexdigest()}"
+
+def _split_token(token):
+    (key,generation) = token.rsplit(':',1)
+    return (key,generation)
+
+def join(key,group_name,submission_ids):
+    """Attaches a request to an identical batch in flight, or registers the request as the one that runs the batch.
+
+    Returns `(True, None)` if the request was attached. Otherwise returns `(False, token)`. The caller then starts the batch
+    and passes `token` to it. `token` is `None` if the request could not be registered, and then nothing is coalesced."""
+    cache = _cache()
+    timeout = _timeout()
+    for _ in range(3):
+        entry = cache.get(key)
+        if entry is None:
+            # every batch gets its own generation, so leftovers of an earlier batch are never mixed in
+            generation = uuid.uuid4().hex
+            cache.set(f'{key}-{generation}-count',0,timeout)
+            # the batch is published right after this and expires in its queue at about the same time
+            if cache.add(key,{'state': STATE_QUEUED,'generation': generation},min(timeout,BATCH_EXPIRES)):
+                return (False,f'{key}:{generation}')
+            continue
+        generation = entry['generation']
+        try:
+            slot = cache.incr(f'{key}-{generation}-count')
+        except ValueError:
+            # expired together with its batch
+            continue
+        # a batch that is already running may have read HEAD before this request was made
+        cache.set(f'{key}-{generation}-subscriber{slot}',
+                  {'group_name': group_name,'submission_ids': list(submission_ids),'verify_head': entry['state'] == STATE_RUNNING},
+                  timeout)
+        current = cache.get(key)
+        if current is not None and current['generation'] == generation:
+            return (True,None)
+        # the batch finished in the meantime, whoever claims the slot first handles this request
+        if not cache.add(f'{key}-{generation}-claim{slot}',True,timeout):
+            return (True,None)
+    return (False,None)
+
+def mark_running(token):
+    """Called by the batch for `token` before it reads HEAD of the repository."""
+    cache = _cache()
+    (key,generation) = _split_token(token)
+    entry = cache.get(key)
+    if entry is not None and entry['generation'] == generation:
+        cache.set(key,{'state': STATE_RUNNING,'generation': generation},_timeout())
+
+def finish(token):
+    """Closes the batch for `token` to new subscribers and returns its subscribers.
+
+    Each subscriber is a dict with `group_name`, `submission_ids` and `verify_head`."""
+    cache = _cache()
+    timeout = _timeout()
+    (key,generation) = _split_token(token)
+    entry = cache.get(key)
+    if entry is not None and entry['generation'] == generation:
+        cache.delete(key)
+    count = cache.get(f'{key}-{generation}-count') or 0
+    subscribers = []
+    for slot in range(1,count + 1):
+        subscriber = cache.get(f'{key}-{generation}-subscriber{slot}')
+        # a subscriber that has not been written yet will notice the batch is gone and claim its own slot
+        if subscriber is not None and cache.add(f'{key}-{generation}-claim{slot}',True,timeout):
+            subscribers.append(subscriber)
+    return subscribers
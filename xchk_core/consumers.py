@@ -1,12 +1,69 @@
-from channels.generic.websocket import WebsocketConsumer
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncWebsocketConsumer, WebsocketConsumer
 import json
-from .tasks import check_submission_batch, notify_result, retrieve_submitted_files, notify_submitted_files
+from .tasks import check_submission_batch, notify_result, publish_check, retrieve_submitted_files, notify_submitted_files
 from .models import Repo, SubmissionState, SubmissionV2
 from django.utils import timezone
-from django.db import transaction
+from django.db import connection, transaction
 import datetime
-from asgiref.sync import async_to_sync
-from . import contentviews, strats
+from asgiref.sync import async_to_sync, sync_to_async
+from . import coalesce, contentviews, ratelimit, strats
+
+def _throttle_response(reason):
+    return {'last_reached_file': "geen bestand gecontroleerd", "analysis": [(None,None,None,"text",reason)]}
+
+def _create_submissions(submissions):
+    """Inserts `submissions` in a single transaction and returns them with their primary keys set."""
+    with transaction.atomic():
+        # Django 2.2 and 3.x name this feature differently
+        if getattr(connection.features,'can_return_rows_from_bulk_insert',False) or\
+           getattr(connection.features,'can_return_ids_from_bulk_insert',False):
+            return SubmissionV2.objects.bulk_create(submissions)
+        # backend cannot report the keys of a bulk insert, which the task needs
+        for submission in submissions:
+            submission.save()
+        return submissions
+
+def _submissions_for_check_request(user,request):
+    """Creates the pending submissions for a decoded check request.
+
+    Returns `(submissions, None)`, or `(None, reason)` if the rate limiter refuses the request.
+    All database access of a check request happens here, so async consumers can run it in a single `database_sync_to_async` call."""
+    refusal = ratelimit.get_rate_limiter().check(user)
+    if refusal is not None:
+        return (None,refusal)
+    # TODO: giving task five minutes, may be able to come up with something more intelligent
+    repo = Repo.objects.get(pk=int(request['repo']))
+    registry = contentviews.contentview_registry()
+    exercises = [registry[uid] for uid in request['exercises'] if uid in registry]
+    # TODO: is dit niet wat omslachtig? krijg de UID, ga hem omzetten naar een contentview, om dan hier toch maar gewoon id te geven?
+    # kan gewoon de omzetting van data naar views overslaan? bekijk later
+    return (_create_submissions([SubmissionV2(checksum=None,
+                                              timestamp=datetime.datetime.now(),
+                                              repo=repo,
+                                              state=SubmissionState.PENDING,
+                                              submitter=user,
+                                              # eigenlijk een class attribute maar kan er ook zo aan
+                                              content_uid=exercise.uid)
+                                 for exercise in exercises]),None)
+
+def _publish_check(batchtype,submissions,group_name):
+    if not submissions:
+        # nothing to check, e.g. only unknown exercises were requested
+        return
+    repo = submissions[0].repo
+    submission_ids = [submission.id for submission in submissions]
+    coalesce_token = None
+    if coalesce.enabled():
+        key = coalesce.request_key(repo.id,[submission.content_uid for submission in submissions],batchtype)
+        (attached,coalesce_token) = coalesce.join(key,group_name,submission_ids)
+        if attached:
+            # an identical batch is queued or running, its result will be sent to this group too
+            return
+    publish_check(batchtype,repo,submission_ids,group_name,coalesce_token=coalesce_token)
+
+def _publish_file_retrieval(submission_id,group_name):
+    retrieve_submitted_files.apply_async(args=[submission_id],link=notify_submitted_files.s(group_name),expires=300)
 
 class SubmittedFilesConsumer(WebsocketConsumer):
 
@@ -28,7 +85,7 @@ class SubmittedFilesConsumer(WebsocketConsumer):
     def receive(self, text_data):
         text_data_json = json.loads(text_data)
         if self.scope['user'].is_superuser:
-            retrieve_submitted_files.apply_async(args=[int(text_data_json['submission'])],link=notify_submitted_files.s(self.group_name),expires=300)
+            _publish_file_retrieval(int(text_data_json['submission']),self.group_name)
 
     def files(self, event):
         self.send(text_data=json.dumps({'files': event['files']}))
@@ -52,35 +109,61 @@ class CheckRequestConsumer(WebsocketConsumer):
     def receive(self, text_data):
         print(text_data)
         text_data_json = json.loads(text_data)
-        # TODO: giving task five minutes, may be able to come up with something more intelligent
-        repo = Repo.objects.get(pk=int(text_data_json['repo']))
-        exercises = [contentview for contentview in contentviews.all_contentviews if contentview.uid in text_data_json['exercises']]
-        recent_submissions = SubmissionV2.objects.filter(submitter=self.scope['user']).filter(timestamp__gte=datetime.datetime.now() - datetime.timedelta(seconds=15))
-        if len(recent_submissions) > 0 and not self.scope['user'].is_superuser:
-            self.send(text_data=json.dumps({'last_reached_file': "geen bestand gecontroleerd", "analysis": [(None,None,None,"text","je mag maar één keer per vijftien seconden checken")]}))
+        (submissions,refusal) = _submissions_for_check_request(self.scope['user'],text_data_json)
+        if refusal is not None:
+            self.send(text_data=json.dumps(_throttle_response(refusal)))
             return
-        batchtype = int(text_data_json['batchtype'])
-        submissions = []
-        with transaction.atomic():
-            # TODO: is dit niet wat omslachtig? krijg de UID, ga hem omzetten naar een contentview, om dan hier toch maar gewoon id te geven?
-            # kan gewoon de omzetting van data naar views overslaan? bekijk later
-            for exercise in exercises:
-                submission = SubmissionV2(checksum=None,
-                                          timestamp=datetime.datetime.now(),
-                                          repo=repo,
-                                          state=SubmissionState.PENDING,
-                                          submitter=self.scope['user'],
-                                          # eigenlijk een class attribute maar kan er ook zo aan
-                                          content_uid=exercise.uid)
-                submission.save()
-                submissions.append(submission)
-        # need to represent repo / submission through their IDs because of serialization
-        check_submission_batch.apply_async(args=[batchtype,\
-                                                 repo.id,\
-                                                 [submission.id for submission in submissions]],\
-                                           link=notify_result.s(self.group_name),\
-                                           expires=300)
+        _publish_check(int(text_data_json['batchtype']),submissions,self.group_name)
+
+    def progress(self, event):
+        # sent while the batch runs, once per decided exercise
+        self.send(text_data=json.dumps({'progress': {'content_uid': event['content_uid'], 'state': event['state'], 'analysis': event['analysis']}}))
 
     def completion(self, event):
         print(event)
         self.send(text_data=json.dumps({'last_reached_file': event['last_reached_file'], 'analysis': event['analysis']}))
+
+class AsyncSubmittedFilesConsumer(AsyncWebsocketConsumer):
+    """Async version of `SubmittedFilesConsumer`, which does not hold a worker thread per connection."""
+
+    async def connect(self):
+        self.group_name = f"user{self.scope['user'].id}"
+        await self.channel_layer.group_add(self.group_name,self.channel_name)
+        await self.accept()
+
+    async def disconnect(self, close_code):
+        await self.channel_layer.group_discard(self.group_name,self.channel_name)
+
+    async def receive(self, text_data):
+        text_data_json = json.loads(text_data)
+        if self.scope['user'].is_superuser:
+            # publishing talks to the broker, so keep it off the event loop
+            await sync_to_async(_publish_file_retrieval,thread_sensitive=False)(int(text_data_json['submission']),self.group_name)
+
+    async def files(self, event):
+        await self.send(text_data=json.dumps({'files': event['files']}))
+
+class AsyncCheckRequestConsumer(AsyncWebsocketConsumer):
+    """Async version of `CheckRequestConsumer`. Only the database work and task publication run in threads."""
+
+    async def connect(self):
+        self.group_name = f"user{self.scope['user'].id}"
+        await self.channel_layer.group_add(self.group_name,self.channel_name)
+        await self.accept()
+
+    async def disconnect(self, close_code):
+        await self.channel_layer.group_discard(self.group_name,self.channel_name)
+
+    async def receive(self, text_data):
+        text_data_json = json.loads(text_data)
+        (submissions,refusal) = await database_sync_to_async(_submissions_for_check_request)(self.scope['user'],text_data_json)
+        if refusal is not None:
+            await self.send(text_data=json.dumps(_throttle_response(refusal)))
+            return
+        await sync_to_async(_publish_check,thread_sensitive=False)(int(text_data_json['batchtype']),submissions,self.group_name)
+
+    async def progress(self, event):
+        await self.send(text_data=json.dumps({'progress': {'content_uid': event['content_uid'], 'state': event['state'], 'analysis': event['analysis']}}))
+
+    async def completion(self, event):
+        await self.send(text_data=json.dumps({'last_reached_file': event['last_reached_file'], 'analysis': event['analysis']}))
@@ -5,10 +5,12 @@ from django.views import View
 from django.contrib.auth.decorators import login_required
 from django.utils.decorators import method_decorator
 from django.http import HttpResponseServerError
+from django.core.exceptions import ImproperlyConfigured
+from types import MappingProxyType
 from .forms import RepoSelectionForm, BatchTypeForm
 from . import strats, courses
 from . import courses
-from .models import SubmissionV2, SubmissionState
+from .models import CompletedContent, SubmissionV2, SubmissionState
 from .strats import *
 
 class ContentView(View,LoginRequiredMixin):
@@ -22,19 +24,15 @@ class ContentView(View,LoginRequiredMixin):
     @classmethod
     def is_accessible_by(cls,user):
         print(f'superuser: {user.is_superuser}')
-        return user.is_superuser or any(cls.is_accessible_by_in(user,course) for course in courses.courses)
+        return user.is_superuser or any(cls.uid in course_accessibility.accessible for course_accessibility in courses.accessibility_by_course(user).values())
 
     @classmethod
     def is_accessible_by_in(cls,user,course):
-        graph = courses.course_graphs[course]
-        v = graph.vs.find(label=cls.uid)
-        preds = [e.source_vertex for e in graph.es.select(_to=v.index)]
-        return all((pred["contentview"].completed_by(user) for p in preds))
+        return cls.uid in courses.accessibility(user,course).accessible
 
     @classmethod
     def completed_by(cls,user):
-        submissions = SubmissionV2.objects.filter(content_uid=cls.uid).filter(submitter=user)
-        return any((submission.state == SubmissionState.ACCEPTED for submission in submissions))
+        return CompletedContent.objects.filter(user=user,content_uid=cls.uid).exists()
 
     def get(self,request,*args,**kwargs):
         batchtypeform = BatchTypeForm()
@@ -53,5 +51,44 @@ class ImpossibleNodeView(ContentView):
     strat = strats.Strategy(refusing_check=strats.TrueCheck())
     template = 'checkerapp/impossible_node.html'
 
-# generator for laziness
-all_contentviews = (cv for cv in set(ContentView.__subclasses__()))
+def _all_subclasses(cls):
+    for subclass in cls.__subclasses__():
+        yield subclass
+        yield from _all_subclasses(subclass)
+
+def _build_contentview_registry():
+    registry = {}
+    for contentview in _all_subclasses(ContentView):
+        # intermediate base classes do not define their own uid
+        if 'uid' not in vars(contentview):
+            continue
+        existing = registry.get(contentview.uid)
+        if existing is not None and existing is not contentview:
+            same_definition = (existing.__module__,existing.__qualname__) == (contentview.__module__,contentview.__qualname__)
+            if not same_definition:
+                raise ImproperlyConfigured(f"uid {contentview.uid} wordt gebruikt door {existing.__qualname__} en {contentview.__qualname__}")
+        # a reloaded module leaves its old class behind, the most recent definition wins
+        registry[contentview.uid] = contentview
+    return MappingProxyType(registry)
+
+_contentview_registry = None
+
+def contentview_registry():
+    """Returns a read-only mapping from uid to every (direct or indirect) subclass of `ContentView`."""
+    global _contentview_registry
+    if _contentview_registry is None:
+        _contentview_registry = _build_contentview_registry()
+    return _contentview_registry
+
+def invalidate_contentview_registry():
+    global _contentview_registry
+    _contentview_registry = None
+
+def get_contentview(uid):
+    """Returns the `ContentView` with the given uid or raises `KeyError`."""
+    registry = contentview_registry()
+    if uid not in registry:
+        # content may have been defined after the registry was built
+        invalidate_contentview_registry()
+        registry = contentview_registry()
+    return registry[uid]
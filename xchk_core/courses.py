@@ -1,8 +1,13 @@
 from . import contentviews as cv
+import collections
 import importlib
 import os
+import threading
 import igraph
 from django.conf import settings
+from .models import CompletedContent
+
+Accessibility = collections.namedtuple('Accessibility',['completed','accessible'])
 
 class Course:
 
@@ -12,37 +17,117 @@ class Course:
         self.structure = structure
         self.solutions_url = solutions_url
 
+def build_course_graph(course):
+    """Builds the dependency graph of `course` and a dict mapping each content uid to its vertex index."""
+    contentviews = {}
+    edges = []
+    for (dependent,dependencies) in course.structure:
+        contentviews.setdefault(dependent.uid,dependent)
+        for dependency in dependencies:
+            contentviews.setdefault(dependency.uid,dependency)
+    vertex_index = {uid: idx for (idx,uid) in enumerate(contentviews)}
+    for (dependent,dependencies) in course.structure:
+        for dependency in dependencies:
+            edges.append((vertex_index[dependency.uid],vertex_index[dependent.uid]))
+    graph = igraph.Graph(n=len(vertex_index),
+                         edges=edges,
+                         directed=True,
+                         vertex_attrs={'contentview': list(contentviews.values()),
+                                       'label': list(contentviews.keys())})
+    return (graph,vertex_index)
+
+def course_prerequisites(graph):
+    """Returns `(uid, prerequisite uids)` for every node of a course graph, in vertex order.
+
+    Only direct prerequisites matter, so a course with a cycle still loads. Nodes on the cycle are never accessible."""
+    labels = graph.vs["label"]
+    return tuple((labels[idx],frozenset(labels[pred] for pred in graph.predecessors(idx))) for idx in range(graph.vcount()))
+
+class CourseRegistry:
+    """Process-wide store of the courses in `XCHK_SOURCE_COURSES` and their graphs.
+
+    Everything is built once, normally from `AppConfig.ready`. Call `invalidate` after course modules have changed."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (courses, graphs, vertex indexes, prerequisites), replaced as a whole so readers never see a half-built registry
+        self._built = None
+
+    def build(self,reload_modules=False):
+        with self._lock:
+            course_dict = {}
+            for (k,v) in getattr(settings,'XCHK_SOURCE_COURSES',{}).items():
+                course_module = importlib.import_module(f'{v}.course')
+                if reload_modules:
+                    course_module = importlib.reload(course_module)
+                course = course_module.course
+                course_dict[course.uid] = course
+            graphs = {}
+            vertex_indexes = {}
+            prerequisites = {}
+            for (uid,course) in course_dict.items():
+                (graphs[uid],vertex_indexes[uid]) = build_course_graph(course)
+                prerequisites[uid] = course_prerequisites(graphs[uid])
+            self._built = (course_dict,graphs,vertex_indexes,prerequisites)
+            return self._built
+
+    def invalidate(self,reload_modules=False):
+        """Drops everything that was built. With `reload_modules`, course modules are reloaded and the registry is rebuilt immediately."""
+        with self._lock:
+            self._built = None
+        # reloaded modules define new content view classes under the same uids
+        cv.invalidate_contentview_registry()
+        if reload_modules:
+            self.build(reload_modules=True)
+
+    def _get_built(self):
+        return self._built or self.build()
+
+    def courses(self):
+        return self._get_built()[0]
+
+    def graphs(self):
+        return self._get_built()[1]
+
+    def vertex_index(self,course_uid):
+        return self._get_built()[2][course_uid]
+
+    def prerequisites(self,course_uid):
+        return self._get_built()[3][course_uid]
+
+registry = CourseRegistry()
+
 def courses():
-    course_dict = {}
-    for (k,v) in settings.XCHK_SOURCE_COURSES.items():
-        course_module = importlib.import_module(f'{v}.course')
-        course = course_module.course
-        course_dict[course.uid] = course
-    return course_dict
-
-# TODO: memoize?
+    return registry.courses()
+
 def course_graphs():
-    graphs = {}
-    print('begin cursussen')
-    for course in courses():
-        print(f'cursus is {course}')
-        graph = igraph.Graph(directed=True)
-        graphs[course] = graph
-        node_set = set()
-        for (dependent,dependencies) in courses()[course].structure:
-            node_set.add(dependent)
-            for dependency in dependencies:
-                node_set.add(dependency)
-        node_lst = list(node_set) # zo heeft alles meteen een nummer
-        graph.add_vertices(len(node_lst))
-        for (idx,content) in enumerate(node_lst):
-            graph.vs[idx]["contentview"] = content
-            graph.vs[idx]["label"] = content.uid
-        # edges toevoegen... lastig, want info is er niet meer
-        # zal gewoon nog eens moeten traversen
-        for (dependent,dependencies) in courses()[course].structure:
-            dependent_idx = [v.index for v in graph.vs if v["contentview"] == dependent][0]
-            for dependency in dependencies:
-                dependency_idx = [v.index for v in graph.vs if v["contentview"] == dependency][0]
-                graph.add_edges([(dependency_idx,dependent_idx)])
-    return graphs
+    """Graphs are shared by the whole process, so copy one before modifying it."""
+    return registry.graphs()
+
+def _accessibility(user,prerequisites,completed):
+    uids = frozenset(uid for (uid,_) in prerequisites)
+    completed = uids & completed
+    if user.is_superuser:
+        return Accessibility(completed,uids)
+    # a node is accessible once all of its direct prerequisites are completed
+    return Accessibility(completed,frozenset(uid for (uid,required) in prerequisites if required <= completed))
+
+def accessibility(user,course_uid):
+    """Returns the completed and accessible content uids of `user` in one course, using a single query.
+
+    Superusers can access everything, so their completions are not looked up."""
+    prerequisites = registry.prerequisites(course_uid)
+    if user.is_superuser:
+        completed = frozenset()
+    else:
+        uids = [uid for (uid,_) in prerequisites]
+        completed = frozenset(CompletedContent.objects.filter(user=user,content_uid__in=uids).values_list('content_uid',flat=True))
+    return _accessibility(user,prerequisites,completed)
+
+def accessibility_by_course(user):
+    """Like `accessibility`, for every course at once. Still a single query, or none for superusers."""
+    if user.is_superuser:
+        completed = frozenset()
+    else:
+        completed = frozenset(CompletedContent.objects.filter(user=user).values_list('content_uid',flat=True))
+    return {course_uid: _accessibility(user,registry.prerequisites(course_uid),completed) for course_uid in courses()}
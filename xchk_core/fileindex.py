@@ -0,0 +1,72 @@
+"""Snapshots of the files in a checkout, so file checks are set lookups instead of system calls.
+
+A `FileIndex` is taken once per checkout, either from the git tree of the checked out commit or by scanning the directory,
+and registered for that directory. Checks look it up with `lookup` and fall back to the filesystem when there is none.
+Checks that change the checkout have to `invalidate` its index.
+"""
+import fnmatch
+import os
+import threading
+from . import gitops
+
+class FileIndex:
+    """The relative paths (with `/` as separator) of all files and directories below a root directory."""
+
+    def __init__(self,paths):
+        self.paths = frozenset(paths)
+
+    @classmethod
+    def scan(cls,root):
+        """Takes the index with a single walk over `root`, skipping `.git`."""
+        paths = set()
+        for (dirpath,dirnames,filenames) in os.walk(root):
+            if dirpath == root and '.git' in dirnames:
+                dirnames.remove('.git')
+            relative_dir = os.path.relpath(dirpath,root)
+            for name in dirnames + filenames:
+                paths.add(name if relative_dir == os.curdir else f'{relative_dir}/{name}'.replace(os.sep,'/'))
+        # a file named .git in a worktree is not part of the submission either
+        paths.discard('.git')
+        return cls(paths)
+
+    @classmethod
+    def from_git_tree(cls,checkout,commit='HEAD'):
+        """Takes the index from the tree of `commit`, which is what a complete checkout of it contains, without touching the files."""
+        listing = gitops.run_git('ls-tree','-r','-t','-z','--name-only',commit,cwd=checkout)
+        return cls(path for path in listing.split('\0') if path)
+
+    @staticmethod
+    def _normalize(path):
+        path = os.path.normpath(path).replace(os.sep,'/')
+        if path == os.curdir or os.path.isabs(path) or path == os.pardir or path.startswith('../'):
+            return None
+        return path
+
+    def covers(self,path):
+        """Whether `path` is inside the indexed directory, so `exists` can answer for it."""
+        return self._normalize(path) is not None
+
+    def exists(self,path):
+        return self._normalize(path) in self.paths
+
+    def glob(self,pattern):
+        """Returns the indexed paths matching a `fnmatch` pattern, in which `*` also matches `/`."""
+        return sorted(fnmatch.filter(self.paths,pattern))
+
+    def with_extension(self,extension):
+        return sorted(path for path in self.paths if path.endswith(f'.{extension}'))
+
+_lock = threading.Lock()
+_indexes = {}
+
+def register(root,index):
+    with _lock:
+        _indexes[os.path.abspath(root)] = index
+
+def invalidate(root):
+    with _lock:
+        _indexes.pop(os.path.abspath(root),None)
+
+def lookup(root):
+    """Returns the index registered for `root`, or `None` if its files have to be checked on disk."""
+    return _indexes.get(os.path.abspath(root))
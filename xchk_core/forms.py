@@ -6,7 +6,7 @@ class CheckRequestForm(forms.Form):
 
     def __init__(self, exercises, user, *args, **kwargs):
         super(CheckRequestForm,self).__init__(*args,**kwargs)
-        numbered_exercises = [(node.pk,str(node)) for node in exercises] # if node.is_accessible_by(user)] uitgeschakeld zodat studenten Bruce alles kunnen checken
+        numbered_exercises = [(node.uid,node.uid) for node in exercises] # filteren op courses.accessibility_by_course(user) uitgeschakeld zodat studenten Bruce alles kunnen checken
         self.fields['exercise'] = forms.ChoiceField(choices=numbered_exercises)
 
 class BatchTypeForm(forms.Form):
@@ -0,0 +1,115 @@
+"""Thin git access layer used by the checking tasks.
+
+Git itself is only started for operations that need it (clone, fetch, worktrees) and never through a shell.
+Reading HEAD and filesystem operations are done in Python.
+"""
+import os
+import shutil
+import stat
+import subprocess
+
+CLONE_MODE_FULL = 'full'
+CLONE_MODE_PARTIAL = 'partial'
+CLONE_MODE_SHALLOW = 'shallow'
+
+class GitError(Exception):
+    """Raised when a git command fails or a repository cannot be read."""
+    pass
+
+def run_git(*args,cwd=None,input=None):
+    """Runs git with `args` and returns its stripped standard output."""
+    # never wait for credentials that will not come
+    env = dict(os.environ,GIT_TERMINAL_PROMPT='0')
+    completed = subprocess.run(['git',*args],cwd=cwd,env=env,capture_output=True,input=input)
+    if completed.returncode != 0:
+        raise GitError(f"git {' '.join(args)} faalde: {completed.stderr.decode('utf-8',errors='replace').strip()}")
+    return completed.stdout.decode('utf-8').strip()
+
+def clone_args(mode):
+    """Returns the extra `git clone` arguments for a clone mode.
+
+    A partial clone only downloads blobs when they are checked out; a shallow clone only has the tip commits."""
+    if mode == CLONE_MODE_PARTIAL:
+        return ['--filter=blob:none']
+    if mode == CLONE_MODE_SHALLOW:
+        return ['--depth','1']
+    return []
+
+def fetch_args(mode):
+    if mode == CLONE_MODE_SHALLOW:
+        return ['--depth','1']
+    return []
+
+def git_dir(path):
+    """Returns the git directory of a bare repository, a regular checkout or a worktree at `path`."""
+    dot_git = os.path.join(path,'.git')
+    if os.path.isfile(dot_git):
+        # worktrees have a .git file pointing to their own git directory
+        with open(dot_git) as fh:
+            content = fh.read().strip()
+        if not content.startswith('gitdir:'):
+            raise GitError(f'{dot_git} is geen geldig .git-bestand')
+        return os.path.normpath(os.path.join(path,content[len('gitdir:'):].strip()))
+    if os.path.isdir(dot_git):
+        return dot_git
+    if os.path.isfile(os.path.join(path,'HEAD')):
+        return path
+    raise GitError(f'{path} is geen git repository')
+
+def _common_dir(directory):
+    commondir_file = os.path.join(directory,'commondir')
+    if os.path.isfile(commondir_file):
+        with open(commondir_file) as fh:
+            return os.path.normpath(os.path.join(directory,fh.read().strip()))
+    return directory
+
+def _resolve_ref(directory,ref):
+    # loose refs of a worktree (HEAD) live in its own directory, shared refs in the common directory
+    for base in (directory,_common_dir(directory)):
+        ref_file = os.path.join(base,ref)
+        if os.path.isfile(ref_file):
+            with open(ref_file) as fh:
+                return fh.read().strip()
+    packed_refs = os.path.join(_common_dir(directory),'packed-refs')
+    if os.path.isfile(packed_refs):
+        with open(packed_refs) as fh:
+            for line in fh:
+                if line.startswith(('#','^')):
+                    continue
+                parts = line.split()
+                if len(parts) == 2 and parts[1] == ref:
+                    return parts[0]
+    return None
+
+def read_head(path):
+    """Returns the commit hash HEAD points to in the repository at `path`, reading the git files directly."""
+    directory = git_dir(path)
+    value = _resolve_ref(directory,'HEAD')
+    # follow symbolic refs, e.g. HEAD -> refs/heads/main
+    for _ in range(10):
+        if value is None:
+            break
+        if not value.startswith('ref:'):
+            if len(value) == 40:
+                return value
+            break
+        value = _resolve_ref(directory,value[len('ref:'):].strip())
+    raise GitError(f'HEAD van {path} wijst niet naar een commit')
+
+def _make_writable_and_retry(function,path,exc_info):
+    os.chmod(path,stat.S_IRWXU)
+    function(path)
+
+def remove_tree(path):
+    """Removes `path` if it exists, also when checks made files in it read-only."""
+    if os.path.lexists(path):
+        shutil.rmtree(path,onerror=_make_writable_and_retry)
+
+def make_world_writable(path):
+    """Equivalent of `chmod -R 777 path`, without starting a process."""
+    os.chmod(path,0o777)
+    for (dirpath,dirnames,filenames) in os.walk(path):
+        for name in dirnames + filenames:
+            entry = os.path.join(dirpath,name)
+            if not os.path.islink(entry):
+                os.chmod(entry,0o777)
@@ -0,0 +1,195 @@
+"""Opt-in timing of checking work.
+
+With `XCHK_METRICS` enabled, checking tasks record wall and CPU time of every evaluated check, of every exercise,
+of checking out the repositories and of the time a batch waited in its queue. The timings of a submission are stored
+as JSON in `SubmissionV2.timings` and every measurement is passed to the hooks in `XCHK_METRICS_HOOKS`:
+dotted paths of callables taking `(name, seconds, labels)`. By default, measurements go to `local_exporter`,
+which keeps per-process totals and, with `XCHK_METRICS_TEXTFILE_DIR`, writes them in the Prometheus text format
+after every batch, e.g. for the textfile collector of node_exporter. `StatsdHook` sends them to statsd instead.
+
+CPU time is that of the whole worker process, including threads running checks in parallel and subprocesses,
+e.g. compilers or test runners started by checks, once they have finished. Measurements that overlap in time,
+such as parallel checks, therefore include each other's CPU time.
+"""
+import json
+import logging
+import os
+import socket
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_HOOKS = ('xchk_core.metrics.local_exporter',)
+
+def enabled():
+    return getattr(settings,'XCHK_METRICS',False)
+
+_hooks = None
+
+def hooks():
+    global _hooks
+    if _hooks is None:
+        _hooks = [import_string(path) for path in getattr(settings,'XCHK_METRICS_HOOKS',DEFAULT_HOOKS)]
+    return _hooks
+
+def reset_hooks():
+    global _hooks
+    _hooks = None
+
+def emit(name,seconds,labels):
+    for hook in hooks():
+        try:
+            hook(name,seconds,labels)
+        except Exception as e:
+            # measuring must never break checking
+            logger.warning('Fout in metrics hook %s: %s',hook,e)
+
+def cpu_time():
+    """Returns the CPU time of this process, all threads included, plus that of its finished subprocesses."""
+    times = os.times()
+    return time.process_time() + times.children_user + times.children_system
+
+class TimingRecorder:
+    """Collects the timings of one batch, per submission, and emits every measurement."""
+
+    def __init__(self):
+        # timings of the batch as a whole, e.g. checking out
+        self.batch = {}
+        # content uid -> {'exercise': ..., 'checks': [...]}
+        self.exercises = {}
+
+    @contextmanager
+    def _measure(self):
+        wall_start = time.perf_counter()
+        cpu_start = cpu_time()
+        timing = {}
+        try:
+            yield timing
+        finally:
+            timing['wall'] = time.perf_counter() - wall_start
+            timing['cpu'] = cpu_time() - cpu_start
+
+    @contextmanager
+    def batch_phase(self,name):
+        with self._measure() as timing:
+            yield
+        self.batch[name] = timing
+        emit(f'xchk_{name}_wall_seconds',timing['wall'],{})
+
+    def record_batch(self,name,seconds):
+        self.batch[name] = {'wall': seconds}
+        emit(f'xchk_{name}_seconds',seconds,{})
+
+    @contextmanager
+    def exercise(self,content_uid):
+        with self._measure() as timing:
+            yield
+        self.exercises.setdefault(content_uid,{'checks': []})['exercise'] = timing
+        labels = {'exercise': content_uid}
+        emit('xchk_exercise_wall_seconds',timing['wall'],labels)
+        emit('xchk_exercise_cpu_seconds',timing['cpu'],labels)
+
+    @contextmanager
+    def check(self,content_uid,check,component_number):
+        with self._measure() as timing:
+            yield
+        timing.update(check=type(check).__name__,component=component_number)
+        self.exercises.setdefault(content_uid,{'checks': []})['checks'].append(timing)
+        labels = {'exercise': content_uid,'check': timing['check']}
+        emit('xchk_check_wall_seconds',timing['wall'],labels)
+        emit('xchk_check_cpu_seconds',timing['cpu'],labels)
+
+    def for_submission(self,content_uid):
+        """Returns the timings to store with a submission of `content_uid`, as JSON."""
+        return json.dumps(dict(self.exercises.get(content_uid,{}),batch=self.batch))
+
+_current = threading.local()
+
+def current_recorder():
+    """Returns the recorder of the batch running in this thread, or `None` when nothing is measured."""
+    return getattr(_current,'recorder',None)
+
+@contextmanager
+def recording():
+    """Yields a recorder that checks in this thread report to, or `None` if metrics are not enabled."""
+    if not enabled():
+        yield None
+        return
+    previous = current_recorder()
+    _current.recorder = TimingRecorder()
+    try:
+        yield _current.recorder
+    finally:
+        _current.recorder = previous
+
+def _escape_label(value):
+    return str(value).replace('\\','\\\\').replace('"','\\"').replace('\n','\\n')
+
+class LocalExporter:
+    """Keeps count and sum of every measurement in this process, rendered as Prometheus summaries."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._totals = {}
+
+    def __call__(self,name,seconds,labels):
+        key = (name,tuple(sorted(labels.items())))
+        with self._lock:
+            (count,total) = self._totals.get(key,(0,0.0))
+            self._totals[key] = (count + 1,total + seconds)
+
+    def prometheus_text(self):
+        with self._lock:
+            totals = sorted(self._totals.items())
+        lines = []
+        previous_name = None
+        for ((name,labels),(count,total)) in totals:
+            if name != previous_name:
+                lines.append(f'# TYPE {name} summary')
+                previous_name = name
+            label_text = ','.join(f'{key}="{_escape_label(value)}"' for (key,value) in labels)
+            label_text = f'{{{label_text}}}' if label_text else ''
+            lines.append(f'{name}_count{label_text} {count}')
+            lines.append(f'{name}_sum{label_text} {total!r}')
+        return '\n'.join(lines) + '\n' if lines else ''
+
+    def write_textfile(self,directory):
+        """Replaces `xchk-<pid>.prom` in `directory` with the current totals, atomically."""
+        (fd,tmp_path) = tempfile.mkstemp(dir=directory,prefix='.xchk-',suffix='.tmp')
+        with os.fdopen(fd,'w') as fh:
+            fh.write(self.prometheus_text())
+        os.chmod(tmp_path,0o644)
+        os.replace(tmp_path,os.path.join(directory,f'xchk-{os.getpid()}.prom'))
+
+local_exporter = LocalExporter()
+
+def flush():
+    """Called after a batch, writes the totals of `local_exporter` if `XCHK_METRICS_TEXTFILE_DIR` is set."""
+    directory = getattr(settings,'XCHK_METRICS_TEXTFILE_DIR',None)
+    if directory is None:
+        return
+    try:
+        local_exporter.write_textfile(directory)
+    except OSError as e:
+        logger.warning('Kon metrics niet wegschrijven: %s',e)
+
+def statsd_line(name,seconds,labels):
+    """Formats a measurement as a statsd timer in milliseconds, with labels as DogStatsD tags."""
+    tags = ','.join(f'{key}:{value}' for (key,value) in sorted(labels.items()))
+    return f"{name}:{seconds * 1000:.3f}|ms{'|#' + tags if tags else ''}"
+
+class StatsdHook:
+    """Sends every measurement to statsd over UDP, e.g. `XCHK_METRICS_HOOKS = ['myproject.metrics.statsd']`
+    with `statsd = StatsdHook('localhost', 8125)` in that module."""
+
+    def __init__(self,host='localhost',port=8125):
+        self.address = (host,port)
+        self._socket = socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
+
+    def __call__(self,name,seconds,labels):
+        self._socket.sendto(statsd_line(name,seconds,labels).encode('utf-8'),self.address)
@@ -0,0 +1,17 @@
+# Generated by Django 2.2.28 on 2026-10-18 13:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('xchk_core', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='submissionv2',
+            index=models.Index(fields=['submitter', 'timestamp'], name='xchk_sub_submitter_time_idx'),
+        ),
+    ]
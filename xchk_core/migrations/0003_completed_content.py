@@ -0,0 +1,46 @@
+# Generated by Django 2.2.28 on 2026-10-18 13:27
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+ACCEPTED = 0
+
+def record_existing_completions(apps, schema_editor):
+    SubmissionV2 = apps.get_model('xchk_core', 'SubmissionV2')
+    CompletedContent = apps.get_model('xchk_core', 'CompletedContent')
+    completions = SubmissionV2.objects.filter(state=ACCEPTED).values_list('submitter_id', 'content_uid').distinct()
+    CompletedContent.objects.bulk_create([CompletedContent(user_id=user_id, content_uid=content_uid) for (user_id, content_uid) in completions.iterator()],
+                                         batch_size=1000,
+                                         ignore_conflicts=True)
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('xchk_core', '0002_submission_submitter_timestamp_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CompletedContent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('content_uid', models.CharField(max_length=40)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='submissionv2',
+            index=models.Index(fields=['content_uid', 'submitter', 'state'], name='xchk_sub_uid_submitter_idx'),
+        ),
+        migrations.AddField(
+            model_name='completedcontent',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='completed_content', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterUniqueTogether(
+            name='completedcontent',
+            unique_together={('user', 'content_uid')},
+        ),
+        migrations.RunPython(record_existing_completions, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-18 13:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('xchk_core', '0003_completed_content'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='submissionv2',
+            name='timings',
+            field=models.TextField(blank=True, null=True),
+        ),
+    ]
@@ -56,6 +56,16 @@ class SubmissionV2(models.Model):
     submitter = models.ForeignKey(settings.AUTH_USER_MODEL, null=False, on_delete=models.CASCADE)
     feedback = models.TextField(null=True,blank=True)
     content_uid = models.CharField(max_length=40,null=False)
+    # JSON with the time spent on checking, only filled when metrics are enabled
+    timings = models.TextField(null=True,blank=True)
+
+    class Meta:
+        indexes = [
+            # recent submissions of a user, e.g. for rate limiting
+            models.Index(fields=['submitter','timestamp'],name='xchk_sub_submitter_time_idx'),
+            # attempts of a user at one exercise, e.g. to see whether it was accepted
+            models.Index(fields=['content_uid','submitter','state'],name='xchk_sub_uid_submitter_idx'),
+        ]
 
     def __str__(self):
         return f"poging van {self.submitter}" +\
@@ -63,3 +73,28 @@ class SubmissionV2(models.Model):
                f" gecontroleerd op {self.timestamp},"+\
                f" met checksum {self.checksum}"+\
                f" en feedback\n\n{self.feedback}"
+
+class CompletedContent(models.Model):
+    """Marks that `user` has an accepted submission for `content_uid`.
+
+    Derived from `SubmissionV2`, so access checks need a single indexed lookup. Kept up to date by `record_completions`
+    and by the signal handlers for single submissions."""
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='completed_content')
+    content_uid = models.CharField(max_length=40,null=False)
+
+    def __str__(self):
+        return f"{self.content_uid} voltooid door {self.user}"
+
+    class Meta:
+        unique_together = [['user','content_uid']]
+
+def record_completions(submissions):
+    """Records the accepted ones among `submissions`, e.g. after a `bulk_update`, which sends no signals."""
+    completions = {(submission.submitter_id,submission.content_uid) for submission in submissions if submission.state == SubmissionState.ACCEPTED}
+    CompletedContent.objects.bulk_create([CompletedContent(user_id=user_id,content_uid=content_uid) for (user_id,content_uid) in completions],
+                                         ignore_conflicts=True)
+
+def forget_completion_if_unaccepted(user_id,content_uid):
+    """Removes the completion of `content_uid` by the user, unless an accepted submission is left."""
+    if not SubmissionV2.objects.filter(content_uid=content_uid,submitter_id=user_id,state=SubmissionState.ACCEPTED).exists():
+        CompletedContent.objects.filter(user_id=user_id,content_uid=content_uid).delete()
@@ -0,0 +1,79 @@
+"""Rendered SVG overviews of course graphs.
+
+Rendering shells out to graphviz, so an overview is rendered on the first request for a course structure and URL map
+and then served from memory or from the Django cache named by `XCHK_OVERVIEW_CACHE_ALIAS`.
+"""
+import hashlib
+import json
+import tempfile
+import threading
+import graphviz as gv
+from django.conf import settings
+from django.core.cache import caches
+from django.urls import reverse
+from . import courses
+
+CACHE_KEY_PREFIX = 'xchk-overview'
+
+_lock = threading.Lock()
+# course uid -> (graph the key was computed for, key)
+_keys = {}
+# key -> svg
+_svgs = {}
+
+def course_url_map(graph):
+    url_map = {}
+    for v in graph.vs:
+        uid = v["contentview"].uid
+        if uid != 'impossible_node':
+            url_map[uid] = reverse(f'{uid}_view')
+        else:
+            url_map[uid] = reverse(f'checkerapp:{uid}_view')
+    return url_map
+
+def _structure_key(course_uid,graph,url_map):
+    structure = {'course': course_uid,
+                 'nodes': graph.vs["label"],
+                 'edges': sorted((graph.vs[source]["label"],graph.vs[target]["label"]) for (source,target) in graph.get_edgelist()),
+                 'urls': sorted(url_map.items())}
+    return hashlib.sha256(json.dumps(structure).encode('utf-8')).hexdigest()
+
+def overview_key(course_uid):
+    """Returns a hash of the structure and URL map of the course, which identifies its rendered overview."""
+    graph = courses.course_graphs()[course_uid]
+    cached = _keys.get(course_uid)
+    if cached is not None and cached[0] is graph:
+        return cached[1]
+    key = _structure_key(course_uid,graph,course_url_map(graph))
+    _keys[course_uid] = (graph,key)
+    return key
+
+def render_overview(graph,url_map):
+    graph = graph.copy()
+    for v in graph.vs:
+        v["URL"] = url_map[v["contentview"].uid]
+    # igraph only writes to real files, an anonymous one cannot be shared with other requests
+    with tempfile.TemporaryFile('w+') as fh:
+        graph.write_dot(fh)
+        fh.seek(0)
+        dotfile = fh.read()
+    return gv.Source(dotfile).pipe(format='svg').decode('utf-8')
+
+def _cache():
+    return caches[getattr(settings,'XCHK_OVERVIEW_CACHE_ALIAS','default')]
+
+def course_overview(course_uid):
+    """Returns `(key, svg)` for the course, rendering it only if neither memory nor the cache backend has it."""
+    key = overview_key(course_uid)
+    svg = _svgs.get(key)
+    if svg is None:
+        with _lock:
+            svg = _svgs.get(key)
+            if svg is None:
+                svg = _cache().get(f'{CACHE_KEY_PREFIX}-{key}')
+                if svg is None:
+                    graph = courses.course_graphs()[course_uid]
+                    svg = render_overview(graph,course_url_map(graph))
+                    _cache().set(f'{CACHE_KEY_PREFIX}-{key}',svg,None)
+                _svgs[key] = svg
+    return (key,svg)
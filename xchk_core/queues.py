@@ -0,0 +1,64 @@
+"""Routing of xchk tasks to Celery queues.
+
+Enable it in the Celery configuration of the project with `task_routes = ('xchk_core.queues.route_task',)`.
+Check batches go to one queue per course or per batch type, depending on `XCHK_CHECK_QUEUE_ROUTING`
+(`'course'`, `'batchtype'` or `None` for a single queue), so a burst of one course does not delay the others.
+A worker started with several queues consumes them in turn; combine this with `worker_prefetch_multiplier = 1`
+so no worker hoards the tasks of one queue. Retrieving submitted files and notifications each get a queue of their own,
+which should be served by workers that do not check, e.g. `celery worker -Q xchk-notify,xchk-files`.
+"""
+from django.conf import settings
+
+CHECK_TASK = 'xchk_core.tasks.check_submission_batch'
+# parts of a speculative batch go wherever the batch itself would go
+SPECULATIVE_TASKS = ('xchk_core.tasks.check_submission_speculatively','xchk_core.tasks.aggregate_speculative_batch')
+FILES_TASK = 'xchk_core.tasks.retrieve_submitted_files'
+NOTIFY_TASKS = ('xchk_core.tasks.notify_result','xchk_core.tasks.notify_submitted_files')
+
+ROUTE_BY_COURSE = 'course'
+ROUTE_BY_BATCHTYPE = 'batchtype'
+
+DEFAULT_CHECK_QUEUE = 'xchk-checks'
+DEFAULT_FILES_QUEUE = 'xchk-files'
+DEFAULT_NOTIFY_QUEUE = 'xchk-notify'
+
+def _check_queue_prefix():
+    return getattr(settings,'XCHK_CHECK_QUEUE',DEFAULT_CHECK_QUEUE)
+
+def check_queue(course=None,batchtype=None):
+    """Returns the queue for a check batch of `course` with batch type index `batchtype`."""
+    routing = getattr(settings,'XCHK_CHECK_QUEUE_ROUTING',None)
+    if routing == ROUTE_BY_COURSE and course is not None:
+        return f'{_check_queue_prefix()}-{course}'
+    if routing == ROUTE_BY_BATCHTYPE and batchtype is not None:
+        return f'{_check_queue_prefix()}-batchtype{batchtype}'
+    return _check_queue_prefix()
+
+def check_queues():
+    """Returns every queue check batches can be routed to, e.g. to start workers for all of them."""
+    from . import courses, strats
+    routing = getattr(settings,'XCHK_CHECK_QUEUE_ROUTING',None)
+    if routing == ROUTE_BY_COURSE:
+        names = [check_queue(course=course_uid) for course_uid in courses.courses()]
+    elif routing == ROUTE_BY_BATCHTYPE:
+        names = [check_queue(batchtype=idx) for idx in range(len(strats.batch_types))]
+    else:
+        names = []
+    # batches without a course or batch type still use the shared queue
+    return names + [_check_queue_prefix()]
+
+def fast_queues():
+    return [getattr(settings,'XCHK_NOTIFY_QUEUE',DEFAULT_NOTIFY_QUEUE),getattr(settings,'XCHK_FILES_QUEUE',DEFAULT_FILES_QUEUE)]
+
+def route_task(name,args,kwargs,options,task=None,**kw):
+    """Celery router for the xchk tasks. Returns `None` for other tasks, so later routers or the defaults apply."""
+    if name == CHECK_TASK:
+        batchtype = args[0] if args else kwargs.get('batchtype_id')
+        return {'queue': check_queue(course=kwargs.get('course'),batchtype=batchtype)}
+    if name in SPECULATIVE_TASKS:
+        return {'queue': check_queue(course=kwargs.get('course'),batchtype=kwargs.get('batchtype_id'))}
+    if name == FILES_TASK:
+        return {'queue': getattr(settings,'XCHK_FILES_QUEUE',DEFAULT_FILES_QUEUE)}
+    if name in NOTIFY_TASKS:
+        return {'queue': getattr(settings,'XCHK_NOTIFY_QUEUE',DEFAULT_NOTIFY_QUEUE)}
+    return None
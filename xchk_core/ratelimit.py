@@ -0,0 +1,153 @@
+"""Rate limiting of check requests.
+
+The limiter is chosen with `XCHK_RATE_LIMITER`, the dotted path of a `RateLimiter` subclass.
+The default `CacheRateLimiter` keeps token buckets in the Django cache named by `XCHK_RATE_LIMIT_CACHE_ALIAS`,
+so a request costs a few cache operations, however many submissions there are.
+Reading and writing a bucket happens under a lock taken with `cache.add`, so concurrent requests,
+e.g. from two tabs of the same student, cannot both spend the same token.
+Budgets are `(requests, seconds)` pairs: `XCHK_RATE_LIMIT_PER_USER` (default one request per fifteen seconds)
+and `XCHK_RATE_LIMIT_GLOBAL` (default `None`, no global limit). Students are told the budget of a user when they exceed it.
+Use a cache shared by all processes, e.g. memcached or redis, when running more than one.
+"""
+import datetime
+import time
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+
+DEFAULT_LIMITER = 'xchk_core.ratelimit.CacheRateLimiter'
+DEFAULT_PER_USER = (1,15)
+CACHE_KEY_PREFIX = 'xchk-ratelimit'
+# a lock outlives a crashed process by at most this many seconds
+LOCK_TIMEOUT = 5
+LOCK_ATTEMPTS = 20
+LOCK_WAIT = 0.005
+
+GLOBAL_LIMIT_MESSAGE = "de server is momenteel erg druk, probeer het zo meteen opnieuw"
+
+def user_limit_message(requests,seconds):
+    """Tells a student who exceeded a budget of `requests` per `seconds` how often they may check."""
+    return f"je mag maar {'één' if requests == 1 else requests} keer per {seconds} seconden checken"
+
+class TokenBucket:
+    """A bucket of at most `capacity` tokens, refilled with `capacity` tokens every `period` seconds.
+
+    The state is a `(tokens, timestamp)` pair, so buckets can be stored anywhere."""
+
+    def __init__(self,capacity,period):
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.period = period
+
+    def take(self,state,now):
+        """Returns whether a token is available in `state` at `now`, and the state after taking it."""
+        if state is None:
+            tokens = self.capacity
+        else:
+            (tokens,timestamp) = state
+            tokens = min(self.capacity,tokens + (now - timestamp) * self.rate)
+        if tokens >= 1:
+            return (True,(tokens - 1,now))
+        return (False,(tokens,now))
+
+class RateLimiter:
+
+    def check(self,user):
+        """Returns `None` if `user` may check now, otherwise the reason in a form fit for the student."""
+        raise NotImplementedError()
+
+class NoRateLimiter(RateLimiter):
+
+    def check(self,user):
+        return None
+
+class CacheRateLimiter(RateLimiter):
+
+    def __init__(self,per_user=None,global_budget=None,cache_alias=None):
+        per_user = per_user or getattr(settings,'XCHK_RATE_LIMIT_PER_USER',DEFAULT_PER_USER)
+        self.user_bucket = TokenBucket(*per_user)
+        self.user_limit_message = user_limit_message(*per_user)
+        global_budget = global_budget or getattr(settings,'XCHK_RATE_LIMIT_GLOBAL',None)
+        self.global_bucket = TokenBucket(*global_budget) if global_budget else None
+        self.cache_alias = cache_alias or getattr(settings,'XCHK_RATE_LIMIT_CACHE_ALIAS','default')
+
+    @staticmethod
+    def _lock(cache,key):
+        """Returns whether the lock on `key` was taken, waiting at most `LOCK_ATTEMPTS * LOCK_WAIT` seconds for it."""
+        for _ in range(LOCK_ATTEMPTS):
+            # add only succeeds for one process, in memcached and redis as well
+            if cache.add(f'{key}-lock',True,LOCK_TIMEOUT):
+                return True
+            time.sleep(LOCK_WAIT)
+        return False
+
+    def check(self,user,now=None):
+        if user.is_superuser:
+            return None
+        now = now if now is not None else time.time()
+        cache = caches[self.cache_alias]
+        user_key = f'{CACHE_KEY_PREFIX}-user{user.pk}'
+        global_key = f'{CACHE_KEY_PREFIX}-global'
+        if not self._lock(cache,user_key):
+            # another request of this user is being counted right now
+            return self.user_limit_message
+        try:
+            if self.global_bucket is None:
+                return self._take(cache,user_key,global_key,now)
+            if not self._lock(cache,global_key):
+                return GLOBAL_LIMIT_MESSAGE
+            try:
+                return self._take(cache,user_key,global_key,now)
+            finally:
+                cache.delete(f'{global_key}-lock')
+        finally:
+            cache.delete(f'{user_key}-lock')
+
+    def _take(self,cache,user_key,global_key,now):
+        states = cache.get_many([user_key,global_key])
+        # tokens are only taken once both budgets allow the request
+        (user_allowed,user_state) = self.user_bucket.take(states.get(user_key),now)
+        if not user_allowed:
+            return self.user_limit_message
+        new_states = {user_key: user_state}
+        if self.global_bucket is not None:
+            (global_allowed,global_state) = self.global_bucket.take(states.get(global_key),now)
+            if not global_allowed:
+                return GLOBAL_LIMIT_MESSAGE
+            new_states[global_key] = global_state
+        # an expired bucket is a full bucket
+        cache.set_many(new_states,int(max(self.user_bucket.period,self.global_bucket.period if self.global_bucket else 0)) + 1)
+        return None
+
+class DatabaseRateLimiter(RateLimiter):
+    """Refuses a request if the user submitted anything in the last `XCHK_RATE_LIMIT_PER_USER` seconds.
+
+    Only the period of that budget is used: a request stores a submission per exercise, so requests cannot be counted
+    and a user gets one request per period. Needs no shared cache, but costs an (indexed) query per request and has no global budget."""
+
+    def __init__(self,per_user=None):
+        (_,self.seconds) = per_user or getattr(settings,'XCHK_RATE_LIMIT_PER_USER',DEFAULT_PER_USER)
+        self.user_limit_message = user_limit_message(1,self.seconds)
+
+    def check(self,user):
+        from .models import SubmissionV2
+        if user.is_superuser:
+            return None
+        # submissions are timestamped with naive local times
+        since = datetime.datetime.now() - datetime.timedelta(seconds=self.seconds)
+        if SubmissionV2.objects.filter(submitter=user,timestamp__gte=since).exists():
+            return self.user_limit_message
+        return None
+
+_limiter = None
+
+def get_rate_limiter():
+    """Returns the process-wide limiter configured through `XCHK_RATE_LIMITER`."""
+    global _limiter
+    if _limiter is None:
+        _limiter = import_string(getattr(settings,'XCHK_RATE_LIMITER',DEFAULT_LIMITER))()
+    return _limiter
+
+def reset_rate_limiter():
+    global _limiter
+    _limiter = None
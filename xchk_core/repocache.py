@@ -0,0 +1,314 @@
+"""Local cache of bare git mirrors, shared by all checking workers on a host.
+
+Every remote repository (model solutions, student repositories) is mirrored once
+under `XCHK_REPO_CACHE_DIR`. Later checks only fetch what changed and get a cheap
+worktree checkout from the mirror instead of a full clone.
+Access is coordinated through `flock`, so several worker processes can share a cache.
+Fetching takes a mirror for itself, but checkouts and reads never wait for the network: they share the mirror
+and only (un)registering a worktree, which is local and quick, is done one at a time.
+So batches that use the same mirror, e.g. that of the model solutions, run side by side.
+"""
+import fcntl
+import hashlib
+import logging
+import os
+import subprocess
+import time
+from contextlib import contextmanager
+from django.conf import settings
+from . import gitops
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_DIR = '/tmp/xchk_repocache'
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+DEFAULT_MAX_AGE = 7 * 24 * 3600
+DEFAULT_EVICTION_INTERVAL = 600
+# a push that lands this soon after a fetch is only seen by a later check
+DEFAULT_FETCH_INTERVAL = 2
+
+LAST_USED_FILE = 'xchk-last-used'
+LAST_FETCHED_FILE = 'xchk-last-fetched'
+
+class RepoCacheError(gitops.GitError):
+    """Raised when a repository cannot be mirrored or checked out."""
+    pass
+
+def _git(*args,cwd=None):
+    try:
+        return gitops.run_git(*args,cwd=cwd)
+    except gitops.GitError as e:
+        raise RepoCacheError(str(e)) from e
+
+def _tree_size(path):
+    total = 0
+    for (dirpath,_,filenames) in os.walk(path):
+        for filename in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath,filename)).st_size
+            except OSError:
+                pass
+    return total
+
+class RepoCache:
+
+    def __init__(self,root=DEFAULT_CACHE_DIR,max_bytes=DEFAULT_MAX_BYTES,max_age=DEFAULT_MAX_AGE,eviction_interval=DEFAULT_EVICTION_INTERVAL,clone_mode=gitops.CLONE_MODE_PARTIAL,fetch_interval=DEFAULT_FETCH_INTERVAL):
+        """`clone_mode` is one of the `gitops.CLONE_MODE_*` values. Shallow mirrors only suit checks of the latest commit.
+
+        `head` does not fetch a mirror that was fetched less than `fetch_interval` seconds ago."""
+        self.root = root
+        self.fetch_interval = fetch_interval
+        self.clone_mode = clone_mode
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.eviction_interval = eviction_interval
+        self.mirrors_dir = os.path.join(root,'mirrors')
+        self.locks_dir = os.path.join(root,'locks')
+        os.makedirs(self.mirrors_dir,exist_ok=True)
+        os.makedirs(self.locks_dir,exist_ok=True)
+
+    @staticmethod
+    def key(url):
+        return hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+    def mirror_dir(self,url):
+        return os.path.join(self.mirrors_dir,f'{self.key(url)}.git')
+
+    @contextmanager
+    def _lock(self,key,kind,shared=False,blocking=True):
+        """Holds a `flock` on the lock file for `kind` ('fetch', 'worktrees' or 'use') of a mirror.
+
+        Yields whether the lock was acquired, which is always the case when `blocking`."""
+        with open(os.path.join(self.locks_dir,f'{key}.{kind}'),'a') as fh:
+            flags = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+            if not blocking:
+                flags |= fcntl.LOCK_NB
+            try:
+                fcntl.flock(fh,flags)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(fh,fcntl.LOCK_UN)
+
+    def _touch(self,mirror):
+        with open(os.path.join(mirror,LAST_USED_FILE),'a'):
+            pass
+        os.utime(os.path.join(mirror,LAST_USED_FILE))
+
+    def _last_used(self,mirror):
+        try:
+            return os.stat(os.path.join(mirror,LAST_USED_FILE)).st_mtime
+        except OSError:
+            return os.stat(mirror).st_mtime
+
+    def _fetched_within(self,mirror,interval):
+        try:
+            return time.time() - os.stat(os.path.join(mirror,LAST_FETCHED_FILE)).st_mtime < interval
+        except OSError:
+            return False
+
+    def _update_mirror(self,url):
+        """Creates the mirror for `url` or fetches what changed. Caller holds the fetch lock."""
+        mirror = self.mirror_dir(url)
+        if os.path.isdir(mirror):
+            _git('fetch','--prune','--quiet',*gitops.fetch_args(self.clone_mode),'origin',cwd=mirror)
+        else:
+            # clone next to the final location, so a failed clone never looks like a mirror
+            tmp_mirror = f'{mirror}.tmp{os.getpid()}'
+            gitops.remove_tree(tmp_mirror)
+            try:
+                # URLs of student repositories are typed in by students, so never let git read one as an option
+                _git('clone','--mirror','--quiet',*gitops.clone_args(self.clone_mode),'--',url,tmp_mirror)
+                os.rename(tmp_mirror,mirror)
+            finally:
+                gitops.remove_tree(tmp_mirror)
+        with open(os.path.join(mirror,LAST_FETCHED_FILE),'a'):
+            pass
+        os.utime(os.path.join(mirror,LAST_FETCHED_FILE))
+        self._touch(mirror)
+        return mirror
+
+    def _fetch(self,url,interval=0):
+        """Updates the mirror of `url` under the fetch lock, unless it was fetched less than `interval` seconds ago.
+
+        Caller holds the shared use lock."""
+        mirror = self.mirror_dir(url)
+        if interval and self._fetched_within(mirror,interval):
+            return mirror
+        with self._lock(self.key(url),'fetch'):
+            # batches that waited for the lock can use the fetch that held it
+            if interval and self._fetched_within(mirror,interval):
+                return mirror
+            return self._update_mirror(url)
+
+    def mirror(self,url):
+        """Makes sure an up-to-date mirror of `url` exists and returns its path."""
+        with self._lock(self.key(url),'fetch'):
+            return self._update_mirror(url)
+
+    def head(self,url):
+        """Brings the mirror of `url` up to date and returns the commit hash of its HEAD, without checking anything out.
+
+        A mirror that was fetched less than `fetch_interval` seconds ago is not fetched again."""
+        with self._lock(self.key(url),'use',shared=True):
+            mirror = self._fetch(url,interval=self.fetch_interval)
+            self._touch(mirror)
+            try:
+                return gitops.read_head(mirror)
+            except gitops.GitError as e:
+                raise RepoCacheError(str(e)) from e
+
+    @contextmanager
+    def worktree(self,url,dest,commit='HEAD',update=True,sparse_paths=None):
+        """Checks out `commit` of `url` at `dest` and yields the commit hash.
+
+        Without `update`, an existing mirror is used as is, e.g. for a commit that was just returned by `head`.
+        With `sparse_paths`, only those paths (relative to the root of the repository) are checked out,
+        so a partial mirror only downloads their blobs.
+        The mirror is protected against eviction until the context is left, at which point the worktree is removed."""
+        key = self.key(url)
+        with self._lock(key,'use',shared=True):
+            mirror = self.mirror_dir(url)
+            if update or not os.path.isdir(mirror):
+                self._fetch(url)
+            else:
+                self._touch(mirror)
+            gitops.remove_tree(dest)
+            # git reads the registrations of all worktrees when adding or removing one, so those run one at a time
+            # they do not touch what a fetch changes, so a fetch may run meanwhile
+            with self._lock(key,'worktrees'):
+                # --force also reuses the registration of a worktree whose directory was removed
+                if sparse_paths is None:
+                    _git('worktree','add','--detach','--force','--quiet',dest,commit,cwd=mirror)
+                else:
+                    _git('worktree','add','--detach','--force','--quiet','--no-checkout',dest,commit,cwd=mirror)
+                    # sparse patterns are stored per worktree, other checkouts of the mirror are not affected
+                    if sparse_paths:
+                        _git('sparse-checkout','set','--no-cone',*(f'/{path.lstrip("/")}' for path in sorted(sparse_paths)),cwd=dest)
+                        # the index is still empty, so fill it and the matching files
+                        _git('read-tree','-mu','HEAD',cwd=dest)
+            try:
+                yield gitops.read_head(dest)
+            finally:
+                with self._lock(key,'worktrees'):
+                    try:
+                        _git('worktree','remove','--force',dest,cwd=mirror)
+                    except RepoCacheError as e:
+                        logger.warning('Kon worktree %s niet opruimen: %s',dest,e)
+                        gitops.remove_tree(dest)
+                        _git('worktree','prune',cwd=mirror)
+
+    def _object_info(self,mirror,specs):
+        """Returns `(type, size)` or `None` for each object spec, using a single `git cat-file --batch-check`."""
+        output = gitops.run_git('cat-file','--batch-check',cwd=mirror,input=''.join(f'{spec}\n' for spec in specs).encode('utf-8'))
+        infos = []
+        for line in output.splitlines():
+            parts = line.split()
+            infos.append((parts[1],int(parts[2])) if len(parts) == 3 and not line.endswith(' missing') else None)
+        return infos
+
+    def read_files(self,url,commit,paths,max_size):
+        """Reads `paths` as they were at `commit` straight from the mirror of `url`, without a checkout.
+
+        Returns a list of `(path, size, content)`: size and content are `None` for paths that are not a file at that commit,
+        content is `None` for files larger than `max_size` bytes, which are never read."""
+        paths = list(paths)
+        specs = [f'{commit}:{path}' for path in paths]
+        key = self.key(url)
+        with self._lock(key,'use',shared=True):
+            mirror = self.mirror_dir(url)
+            if not os.path.isdir(mirror):
+                self._fetch(url)
+            infos = self._object_info(mirror,specs)
+            if paths and all(info is None for info in infos):
+                # commit may be newer than the mirror
+                self._fetch(url)
+                infos = self._object_info(mirror,specs)
+            wanted = [(path,spec,info) for (path,spec,info) in zip(paths,specs,infos) if info is not None and info[0] == 'blob' and info[1] <= max_size]
+            contents = {}
+            if wanted:
+                env = dict(os.environ,GIT_TERMINAL_PROMPT='0')
+                process = subprocess.Popen(['git','cat-file','--batch'],cwd=mirror,env=env,stdin=subprocess.PIPE,stdout=subprocess.PIPE)
+                try:
+                    process.stdin.write(''.join(f'{spec}\n' for (_,spec,_) in wanted).encode('utf-8'))
+                    process.stdin.close()
+                    for (path,_,(_,size)) in wanted:
+                        # header is "<sha> blob <size>", content is followed by a newline
+                        process.stdout.readline()
+                        contents[path] = process.stdout.read(size)
+                        process.stdout.read(1)
+                finally:
+                    process.stdout.close()
+                    process.wait()
+            self._touch(mirror)
+        return [(path,None,None) if info is None or info[0] != 'blob' else (path,info[1],contents.get(path))
+                for (path,info) in zip(paths,infos)]
+
+    def _remove_mirror(self,mirror):
+        key = os.path.basename(mirror)[:-len('.git')]
+        with self._lock(key,'use',blocking=False) as unused:
+            if not unused:
+                return False
+            with self._lock(key,'fetch'):
+                gitops.remove_tree(mirror)
+        return True
+
+    def evict(self,now=None):
+        """Removes mirrors unused for longer than `max_age`, then least recently used ones until the cache fits in `max_bytes`.
+
+        Mirrors with a checkout in progress are never removed. Returns the removed paths."""
+        now = now or time.time()
+        removed = []
+        mirrors = []
+        for entry in os.listdir(self.mirrors_dir):
+            mirror = os.path.join(self.mirrors_dir,entry)
+            if entry.endswith('.git') and os.path.isdir(mirror):
+                mirrors.append((self._last_used(mirror),mirror))
+        mirrors.sort()
+        remaining = []
+        for (last_used,mirror) in mirrors:
+            if now - last_used > self.max_age and self._remove_mirror(mirror):
+                removed.append(mirror)
+            else:
+                remaining.append((mirror,_tree_size(mirror)))
+        total = sum(size for (_,size) in remaining)
+        for (mirror,size) in remaining:
+            if total <= self.max_bytes:
+                break
+            if self._remove_mirror(mirror):
+                removed.append(mirror)
+                total -= size
+        return removed
+
+    def maybe_evict(self):
+        """Runs `evict` if it has not run in the last `eviction_interval` seconds."""
+        stamp = os.path.join(self.root,'last-eviction')
+        with self._lock('cache','evict',blocking=False) as acquired:
+            if not acquired:
+                return []
+            try:
+                if time.time() - os.stat(stamp).st_mtime < self.eviction_interval:
+                    return []
+            except OSError:
+                pass
+            with open(stamp,'a'):
+                pass
+            os.utime(stamp)
+            return self.evict()
+
+_repo_cache = None
+
+def get_repo_cache():
+    """Returns the process-wide cache configured through the `XCHK_REPO_CACHE_*` settings."""
+    global _repo_cache
+    if _repo_cache is None:
+        _repo_cache = RepoCache(root=getattr(settings,'XCHK_REPO_CACHE_DIR',DEFAULT_CACHE_DIR),
+                                max_bytes=getattr(settings,'XCHK_REPO_CACHE_MAX_BYTES',DEFAULT_MAX_BYTES),
+                                max_age=getattr(settings,'XCHK_REPO_CACHE_MAX_AGE',DEFAULT_MAX_AGE),
+                                eviction_interval=getattr(settings,'XCHK_REPO_CACHE_EVICTION_INTERVAL',DEFAULT_EVICTION_INTERVAL),
+                                clone_mode=getattr(settings,'XCHK_REPO_CACHE_CLONE_MODE',gitops.CLONE_MODE_PARTIAL),
+                                fetch_interval=getattr(settings,'XCHK_REPO_CACHE_FETCH_INTERVAL',DEFAULT_FETCH_INTERVAL))
+    return _repo_cache
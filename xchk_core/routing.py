@@ -3,6 +3,6 @@ from django.urls import re_path
 from . import consumers
 
 websocket_urlpatterns = [
-    re_path(r'ws/sock/$', consumers.CheckRequestConsumer),
-    re_path(r'ws/submissionsock/$', consumers.SubmittedFilesConsumer),
+    re_path(r'ws/sock/$', consumers.AsyncCheckRequestConsumer),
+    re_path(r'ws/submissionsock/$', consumers.AsyncSubmittedFilesConsumer),
 ]
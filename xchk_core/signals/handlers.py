@@ -1,10 +1,11 @@
 from django.conf import settings
 from django.utils.translation import ugettext_noop as _
-from django.db.models.signals import pre_save, post_migrate, post_save
+from django.db.models.signals import pre_save, post_delete, post_migrate, post_save
 from django.dispatch import receiver
-from ..models import FeedbackTicket, FeedbackType
+from ..models import FeedbackTicket, FeedbackType, SubmissionState, SubmissionV2, forget_completion_if_unaccepted, record_completions
 from pinax.notifications.models import send_now
 from django.core.exceptions import ObjectDoesNotExist
+from django.test.signals import setting_changed
 
 
 @receiver(post_migrate)
@@ -23,3 +24,36 @@ def notify_feedback_ticket(sender, instance, raw, using, update_fields, **kwargs
         from dbchecker.users.models import User
         owner = User.objects.get(pk = 1)
         send_now([owner],"new_feedback_ticket",{"feedback_ticket": instance, "message": instance.message})
+
+@receiver(post_save, sender=SubmissionV2)
+def update_completion(sender, instance, created, raw, **kwargs):
+    if raw:
+        return
+    if instance.state == SubmissionState.ACCEPTED:
+        record_completions([instance])
+    elif not created:
+        # e.g. an accepted submission that was refused by hand
+        forget_completion_if_unaccepted(instance.submitter_id,instance.content_uid)
+
+@receiver(post_delete, sender=SubmissionV2)
+def forget_completion(sender, instance, **kwargs):
+    if instance.state == SubmissionState.ACCEPTED:
+        forget_completion_if_unaccepted(instance.submitter_id,instance.content_uid)
+
+@receiver(setting_changed)
+def invalidate_course_registry(sender, setting, **kwargs):
+    if setting == "XCHK_SOURCE_COURSES":
+        from .. import courses
+        courses.registry.invalidate()
+
+@receiver(setting_changed)
+def reset_rate_limiter(sender, setting, **kwargs):
+    if setting.startswith("XCHK_RATE_LIMIT"):
+        from .. import ratelimit
+        ratelimit.reset_rate_limiter()
+
+@receiver(setting_changed)
+def reset_metrics_hooks(sender, setting, **kwargs):
+    if setting == "XCHK_METRICS_HOOKS":
+        from .. import metrics
+        metrics.reset_hooks()
@@ -1,7 +1,13 @@
+import concurrent.futures
+import functools
+import hashlib
 import logging
 import os
+import threading
+import types
 from collections import namedtuple
 from .models import SubmissionState
+from . import fileindex, metrics
 
 logger = logging.getLogger(__name__)
 
@@ -15,6 +21,99 @@ ALL_OF_TEXT = "Aan al volgende voorwaarden is voldaan:"
 
 # TODO: replace (negative_)instructions boilerplate for implicit case with something like a decorator?
 
+def _code_digest(code):
+    # nested code objects have a memory address in their repr, so digest them separately
+    consts = [_code_digest(c) if isinstance(c,types.CodeType) else repr(c) for c in code.co_consts]
+    return hashlib.sha1(code.co_code + repr(consts).encode('utf-8') + repr(code.co_names).encode('utf-8')).hexdigest()
+
+def memoize_per_exercise(method):
+    """Caches the result of an instructions method per exercise name on the check or strategy itself.
+
+    Checks and strategies are static class attributes of content views, so their instructions never change while running."""
+    cache_attr = f'_{method.__name__}_cache'
+    @functools.wraps(method)
+    def wrapper(self,exercise_name):
+        cache = self.__dict__.setdefault(cache_attr,{})
+        if exercise_name not in cache:
+            cache[exercise_name] = method(self,exercise_name)
+        return cache[exercise_name]
+    return wrapper
+
+# tells checks evaluated on behalf of a strategy how many child checks they may run in parallel
+_parallel_evaluation = threading.local()
+
+# children of a parallel check that run at the same time when the strategy sets no limit
+# a decided outcome only saves the work of children that have not started, so this should stay small
+DEFAULT_MAX_PARALLEL_CHECKS = 4
+
+def _check_children(children,deciding_outcome,parallel,submission,student_path,model_path,desired_outcome,init_check_number):
+    """Evaluates the children of a conjunction (`deciding_outcome` is `False`) or disjunction (`deciding_outcome` is `True`).
+
+    Returns the outcome, the components of the children that were evaluated and the successor component number.
+    Evaluation stops at the first child with the deciding outcome. Parallel evaluation yields exactly the same result."""
+    # every child has a fixed range of component numbers, whether it is evaluated or not
+    child_numbers = []
+    next_check_number = init_check_number + 1
+    for child in children:
+        child_numbers.append(next_check_number)
+        next_check_number += child.component_count()
+    # nested parallel checks are evaluated sequentially, so the limit set by the strategy holds
+    if parallel and len(children) > 1 and not getattr(_parallel_evaluation,'in_worker',False):
+        analyses = _check_children_in_parallel(children,child_numbers,deciding_outcome,submission,student_path,model_path,desired_outcome)
+    else:
+        analyses = []
+        for (child,child_number) in zip(children,child_numbers):
+            analyses.append(child.check_submission(submission,student_path,model_path,desired_outcome,child_number))
+            if analyses[-1].outcome == deciding_outcome:
+                break
+    components = [component for analysis in analyses for component in analysis.outcomes_components]
+    outcome = deciding_outcome if analyses and analyses[-1].outcome == deciding_outcome else not deciding_outcome
+    return (outcome,components,next_check_number)
+
+def _check_child_in_worker(child,*args):
+    _parallel_evaluation.in_worker = True
+    try:
+        return child.check_submission(*args)
+    finally:
+        _parallel_evaluation.in_worker = False
+
+def _check_children_in_parallel(children,child_numbers,deciding_outcome,submission,student_path,model_path,desired_outcome):
+    """Returns the analyses of the children up to and including the first one with the deciding outcome.
+
+    If a child raises and no earlier child has the deciding outcome, its error is raised, as in sequential evaluation.
+
+    Once the outcome is decided, children that have not started are cancelled. Children that are running cannot be stopped
+    and are waited for, so at most `max_workers` children run for nothing."""
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=getattr(_parallel_evaluation,'max_workers',None) or DEFAULT_MAX_PARALLEL_CHECKS)
+    try:
+        futures = [executor.submit(_check_child_in_worker,child,submission,student_path,model_path,desired_outcome,child_number)
+                   for (child,child_number) in zip(children,child_numbers)]
+        first_deciding = len(futures) - 1
+        pending = set(futures)
+        while any(future in pending for future in futures[:first_deciding+1]):
+            (done,pending) = concurrent.futures.wait(pending,return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                idx = futures.index(future)
+                # like a deciding child, a child that raises ends sequential evaluation
+                # its error is only raised below, once every earlier child turned out not to decide
+                if idx < first_deciding and (future.exception() is not None or future.result().outcome == deciding_outcome):
+                    first_deciding = idx
+                    # outcome is decided, children that have not started yet are not needed
+                    for later_future in futures[idx+1:]:
+                        later_future.cancel()
+            pending = {future for future in pending if not future.cancelled()}
+        return [future.result() for future in futures[:first_deciding+1]]
+    finally:
+        # children that are already running share the workspace, so let them finish
+        executor.shutdown(wait=True)
+
+def _fingerprint_part(value):
+    if isinstance(value,CheckingPredicate):
+        return value.fingerprint()
+    if isinstance(value,(list,tuple)):
+        return '[' + ','.join(_fingerprint_part(elem) for elem in value) + ']'
+    return repr(value)
+
 class CheckingPredicate:
 
     def __init__(self,implicit=False):
@@ -25,12 +124,14 @@ class CheckingPredicate:
         # most checks are atomic, so this is a sane default
         return self.implicit
 
+    @memoize_per_exercise
     def instructions(self,exercise_name):
         """Returns a hierarchical representation of the explicit conditions to be met for this check to return `True`."""
         if self.implicit:
             return []
         return [f"True"]
 
+    @memoize_per_exercise
     def negative_instructions(self,exercise_name):
         """Returns a hierarchical representation of the explicit conditions to be met for this check to return `False`."""
         if self.implicit:
@@ -40,6 +141,17 @@ class CheckingPredicate:
     def component_checks(self):
         return []
 
+    def component_count(self):
+        """Returns how many component numbers the analysis of this check uses, whether it is evaluated or not."""
+        return 1
+
+    def fingerprint(self):
+        """Returns a hash of the definition of this check, including the code that evaluates it."""
+        cls = type(self)
+        parts = [f'{cls.__module__}.{cls.__qualname__}',_code_digest(cls.check_submission.__code__)]
+        parts += [f'{k}={_fingerprint_part(v)}' for (k,v) in sorted(vars(self).items()) if not k.startswith('_')]
+        return hashlib.sha1('|'.join(parts).encode('utf-8')).hexdigest()
+
     def mentioned_files(self,exercise_name):
         """This is here so we can easily check submitted relevant files through UI."""
         return set()
@@ -48,7 +160,8 @@ class CheckingPredicate:
     # overschrijven is nodig om `in` te gebruiken op ondersteunde checks batch type
     def __eq__(self,obj):
         same_types = type(self) == type(obj)
-        same_vars = vars(self) == vars(obj)
+        # private attributes hold caches, not properties
+        same_vars = {k: v for (k,v) in vars(self).items() if not k.startswith('_')} == {k: v for (k,v) in vars(obj).items() if not k.startswith('_')}
         return same_types and same_vars
 
     def check_submission(self,submission,student_path,model_path,desired_outcome,init_check_number,parent_is_negation=False):
@@ -73,11 +186,13 @@ class Negation(CheckingPredicate):
     def has_implicit_components(self):
         return self.negated_predicate.has_implicit_components()
 
+    @memoize_per_exercise
     def negative_instructions(self,exercise_name):
         if self.implicit:
             return []
         return self.negated_predicate.instructions(exercise_name)
 
+    @memoize_per_exercise
     def instructions(self,exercise_name):
         if self.implicit:
             return []
@@ -90,6 +205,10 @@ class Negation(CheckingPredicate):
     def mentioned_files(self,exercise_name):
         return self.negated_predicate.mentioned_files(exercise_name)
 
+    def component_count(self):
+        # a negation has no component of its own
+        return self.negated_predicate.component_count()
+
     def check_submission(self,submission,student_path,model_path,desired_outcome,init_check_number,parent_is_negation=False):
         # cannot simply copy child analysis, because instructions are simplified through De Morgan
         # invert the desired outcome, but also invert the explanation in case of mismatch
@@ -99,9 +218,11 @@ class Negation(CheckingPredicate):
 
 class ConjunctiveCheck(CheckingPredicate):
 
-    def __init__(self,conjuncts,implicit=False):
+    def __init__(self,conjuncts,implicit=False,parallel=False):
+        """With `parallel`, conjuncts are evaluated at the same time. Only use this for conjuncts that do not depend on each other."""
         super().__init__(implicit)
         self.conjuncts = conjuncts
+        self.parallel = parallel
 
     def has_implicit_components(self):
         return any((c.has_implicit_components() for c in self.conjuncts))
@@ -109,6 +230,7 @@ class ConjunctiveCheck(CheckingPredicate):
     def mentioned_files(self,exercise_name):
         return set([fn for conjunct in self.conjuncts for fn in conjunct.mentioned_files(exercise_name)])
 
+    @memoize_per_exercise
     def instructions(self,exercise_name):
         if self.implicit:
             return []
@@ -119,6 +241,7 @@ class ConjunctiveCheck(CheckingPredicate):
         # TODO: indien maar één (expliciete) voorwaarde, dan kunnen we filteren
         return [ALL_OF_TEXT] + subinstructions
 
+    @memoize_per_exercise
     def negative_instructions(self,exercise_name):
         if self.implicit:
             return []
@@ -134,26 +257,22 @@ class ConjunctiveCheck(CheckingPredicate):
     def component_checks(self):
         return [c for conjunct in self.conjuncts for c in conjunct.component_checks()]
 
-    def check_submission(self,submission,student_path,model_path,desired_outcome,init_check_number,parent_is_negation=False):
-        exit_code = True # assume
-        next_check_number = init_check_number + 1
-        analysis_children = []
-        for conjunct in self.conjuncts:
-            if exit_code:
-                outcome_analysis_child = conjunct.check_submission(submission,student_path,model_path,desired_outcome,next_check_number)
-                analysis_children += outcome_analysis_child.components
-                exit_code = exit_code and outcome_analysis_child.outcome
-            else:
-                # still need to do this due to short circuiting and numbering, but don't run check
-                # could add non-SC variant later on...
-                (_,next_check_number) = conjunct.instructions(submission.content_uid)
+    def component_count(self):
+        return 1 + sum(conjunct.component_count() for conjunct in self.conjuncts)
+
+    def own_component(self,exit_code,desired_outcome,init_check_number,parent_is_negation):
+        """Returns the component describing the outcome of the conjunction itself."""
         error_msg = None
         if exit_code != desired_outcome:
             if not parent_is_negation:
                 error_msg = f"AND moest {desired_outcome} leveren, leverde {exit_code}"
             else:
                 error_msg = f"OR moest {not desired_outcome} leveren, leverde {not exit_code}"
-        return OutcomeAnalysis(outcome=exit_code,components=[OutcomeComponent(component_number=init_check_number,outcome=exit_code,desired_outcome=desired_outcome,renderer="text" if exit_code != desired_outcome else None,renderer_data=error_msg)] + analysis_children,successor_component_number=next_check_number)
+        return OutcomeComponent(component_number=init_check_number,outcome=exit_code,desired_outcome=desired_outcome,renderer="text" if exit_code != desired_outcome else None,renderer_data=error_msg)
+
+    def check_submission(self,submission,student_path,model_path,desired_outcome,init_check_number,parent_is_negation=False):
+        (exit_code,analysis_children,next_check_number) = _check_children(self.conjuncts,False,self.parallel,submission,student_path,model_path,desired_outcome,init_check_number)
+        return OutcomeAnalysis(outcome=exit_code,outcomes_components=[self.own_component(exit_code,desired_outcome,init_check_number,parent_is_negation)] + analysis_children,successor_component_number=next_check_number)
 
 class FileExistsCheck(CheckingPredicate):
 
@@ -166,13 +285,15 @@ class FileExistsCheck(CheckingPredicate):
         return f'{self.name or exercise_name}{"." if self.extension else ""}{self.extension or ""}'
 
     def mentioned_files(self,exercise_name):
-        return set(self.entry(exercise_name))
+        return {self.entry(exercise_name)}
 
+    @memoize_per_exercise
     def instructions(self,exercise_name):
         if self.implicit:
             return []
         return [f'Je hebt een bestand met naam {self.entry(exercise_name)}']
 
+    @memoize_per_exercise
     def negative_instructions(self,exercise_name):
         if self.implicit:
             return []
@@ -181,7 +302,11 @@ class FileExistsCheck(CheckingPredicate):
     def check_submission(self,submission,student_path,model_path,desired_outcome,init_check_number,parent_is_negation=False):
         exercise_name = submission.content_uid
         entry = self.entry(exercise_name)
-        outcome = os.path.exists(os.path.join(student_path,self.entry(exercise_name)))
+        index = fileindex.lookup(student_path)
+        if index is not None and index.covers(entry):
+            outcome = index.exists(entry)
+        else:
+            outcome = os.path.exists(os.path.join(student_path,entry))
         if outcome and not desired_outcome:
             extra_info = f"{entry} mag niet bestaan en bestaat toch"
         elif not outcome and desired_outcome:
@@ -197,9 +322,11 @@ class FileExistsCheck(CheckingPredicate):
 
 class DisjunctiveCheck(CheckingPredicate):
 
-    def __init__(self,disjuncts,implicit=False):
+    def __init__(self,disjuncts,implicit=False,parallel=False):
+        """With `parallel`, disjuncts are evaluated at the same time. Only use this for disjuncts that do not depend on each other."""
         super().__init__(implicit)
         self.disjuncts = disjuncts
+        self.parallel = parallel
 
     def has_implicit_components(self):
         return any((c.has_implicit_components() for c in self.disjuncts))
@@ -207,6 +334,7 @@ class DisjunctiveCheck(CheckingPredicate):
     def mentioned_files(self,exercise_name):
         return set([fn for disjunct in self.disjuncts for fn in disjunct.mentioned_files(exercise_name)])
 
+    @memoize_per_exercise
     def instructions(self,exercise_name):
         if self.implicit:
             return []
@@ -216,6 +344,7 @@ class DisjunctiveCheck(CheckingPredicate):
         # TODO: indien maar één (expliciete) voorwaarde, dan kunnen we filteren
         return [AT_LEAST_ONE_TEXT] + subinstructions
 
+    @memoize_per_exercise
     def negative_instructions(self,exercise_name):
         if self.implicit:
             return []
@@ -230,26 +359,115 @@ class DisjunctiveCheck(CheckingPredicate):
     def component_checks(self):
         return [c for disjunct in self.disjuncts for c in disjunct.component_checks()]
 
-    def check_submission(self,submission,student_path,model_path,desired_outcome,init_check_number,parent_is_negation=False):
-        exit_code = False # assume
-        next_check_number = init_check_number + 1
-        analysis_children = []
-        for disjunct in self.disjuncts:
-            if not exit_code:
-                outcome_analysis_child = disjunct.check_submission(submission,student_path,model_path,desired_outcome,next_check_number)
-                analysis_children += outcome_analysis_child.components
-                exit_code = exit_code or outcome_analysis_child.outcome
-            else:
-                # still need to do this due to short circuiting and numbering, but don't run check
-                # could add non-SC variant later on...
-                (_,next_check_number) = disjunct.instructions(submission.content_uid,next_check_number)
+    def component_count(self):
+        return 1 + sum(disjunct.component_count() for disjunct in self.disjuncts)
+
+    def own_component(self,exit_code,desired_outcome,init_check_number,parent_is_negation):
+        """Returns the component describing the outcome of the disjunction itself."""
         error_msg = None
         if exit_code != desired_outcome:
             if not parent_is_negation:
                 error_msg = f"OR moest {desired_outcome} leveren, leverde {exit_code}"
             else:
                 error_msg = f"AND moest {not desired_outcome} leveren, leverde {not exit_code}"
-        return OutcomeAnalysis(outcome=exit_code,components=[OutcomeComponent(component_number=init_check_number,outcome=exit_code,desired_outcome=desired_outcome,renderer="text" if exit_code != desired_outcome else None,renderer_data=error_msg)] + analysis_children,successor_component_number=next_check_number)
+        return OutcomeComponent(component_number=init_check_number,outcome=exit_code,desired_outcome=desired_outcome,renderer="text" if exit_code != desired_outcome else None,renderer_data=error_msg)
+
+    def check_submission(self,submission,student_path,model_path,desired_outcome,init_check_number,parent_is_negation=False):
+        (exit_code,analysis_children,next_check_number) = _check_children(self.disjuncts,True,self.parallel,submission,student_path,model_path,desired_outcome,init_check_number)
+        return OutcomeAnalysis(outcome=exit_code,outcomes_components=[self.own_component(exit_code,desired_outcome,init_check_number,parent_is_negation)] + analysis_children,successor_component_number=next_check_number)
+
+PlanStep = namedtuple('PlanStep', ['check','kind','component_number','desired_outcome','parent_is_negation','parent','end'])
+
+PLAN_LEAF = 'leaf'
+PLAN_NEGATION = 'negation'
+PLAN_CONJUNCTION = 'conjunction'
+PLAN_DISJUNCTION = 'disjunction'
+
+def _plan_kind(check):
+    # subclasses with their own evaluation and parallel checks are evaluated as a whole
+    if isinstance(check,Negation) and type(check).check_submission is Negation.check_submission:
+        return PLAN_NEGATION
+    if isinstance(check,ConjunctiveCheck) and type(check).check_submission is ConjunctiveCheck.check_submission and not check.parallel:
+        return PLAN_CONJUNCTION
+    if isinstance(check,DisjunctiveCheck) and type(check).check_submission is DisjunctiveCheck.check_submission and not check.parallel:
+        return PLAN_DISJUNCTION
+    return PLAN_LEAF
+
+class EvaluationPlan:
+    """Flat, precomputed form of a check tree, evaluated without recursion.
+
+    Steps are stored in depth-first order, so evaluated components come out in the same order as with `check_submission`.
+    Each step knows its component number, desired outcome, parent and where its subtree ends, so short-circuited subtrees are skipped in one jump."""
+
+    def __init__(self,check,desired_outcome,init_check_number):
+        self.steps = []
+        # (check, desired outcome, parent_is_negation, index of parent)
+        to_visit = [(check,desired_outcome,False,None)]
+        check_number = init_check_number
+        while to_visit:
+            (current,desired,parent_is_negation,parent) = to_visit.pop()
+            kind = _plan_kind(current)
+            idx = len(self.steps)
+            self.steps.append(PlanStep(current,kind,check_number,desired,parent_is_negation,parent,None))
+            if kind == PLAN_NEGATION:
+                to_visit.append((current.negated_predicate,not desired,True,idx))
+            elif kind in (PLAN_CONJUNCTION,PLAN_DISJUNCTION):
+                check_number += 1
+                children = current.conjuncts if kind == PLAN_CONJUNCTION else current.disjuncts
+                to_visit.extend((child,desired,False,idx) for child in reversed(children))
+            else:
+                check_number += current.component_count()
+        self.successor_component_number = check_number
+        # a subtree ends where the next step that is not a descendant starts
+        ends = [len(self.steps)] * len(self.steps)
+        open_steps = []
+        for (idx,step) in enumerate(self.steps):
+            while open_steps and open_steps[-1] != step.parent:
+                ends[open_steps.pop()] = idx
+            open_steps.append(idx)
+        self.steps = [step._replace(end=end) for (step,end) in zip(self.steps,ends)]
+
+    def check_submission(self,submission,student_path,model_path):
+        """Evaluates the plan, with the same outcome and components as `check_submission` of the original check."""
+        steps = self.steps
+        buffer = [None] * len(steps)
+        recorder = metrics.current_recorder()
+        idx = 0
+        while True:
+            step = steps[idx]
+            if step.kind == PLAN_LEAF:
+                if recorder is None:
+                    analysis = step.check.check_submission(submission,student_path,model_path,step.desired_outcome,step.component_number,step.parent_is_negation)
+                else:
+                    with recorder.check(submission.content_uid,step.check,step.component_number):
+                        analysis = step.check.check_submission(submission,student_path,model_path,step.desired_outcome,step.component_number,step.parent_is_negation)
+                buffer[idx] = analysis.outcomes_components
+                outcome = analysis.outcome
+            elif step.kind != PLAN_NEGATION and step.end == idx + 1:
+                # no child can decide an empty conjunction or disjunction
+                outcome = step.kind == PLAN_CONJUNCTION
+                buffer[idx] = [step.check.own_component(outcome,step.desired_outcome,step.component_number,step.parent_is_negation)]
+            else:
+                # composite steps are completed once their children are
+                idx += 1
+                continue
+            done = idx
+            while True:
+                parent_idx = steps[done].parent
+                if parent_idx is None:
+                    return OutcomeAnalysis(outcome=outcome,
+                                           outcomes_components=[component for components in buffer if components for component in components],
+                                           successor_component_number=self.successor_component_number)
+                parent = steps[parent_idx]
+                if parent.kind == PLAN_NEGATION:
+                    outcome = not outcome
+                elif outcome == (parent.kind == PLAN_DISJUNCTION) or steps[done].end == parent.end:
+                    # deciding outcome or last child: remaining children are skipped
+                    buffer[parent_idx] = [parent.check.own_component(outcome,parent.desired_outcome,parent.component_number,parent.parent_is_negation)]
+                else:
+                    idx = steps[done].end
+                    break
+                done = parent_idx
 
 class BatchType:
     """Elementair batchtype.
@@ -272,9 +490,15 @@ class BatchType:
 
 class Strategy:
 
-    def __init__(self,refusing_check=Negation(TrueCheck()),accepting_check=Negation(TrueCheck())):
+    def __init__(self,refusing_check=Negation(TrueCheck()),accepting_check=Negation(TrueCheck()),max_parallel_checks=None,full_checkout=False):
+        """`max_parallel_checks` limits how many checks of parallel conjunctions and disjunctions run at the same time,
+        `DEFAULT_MAX_PARALLEL_CHECKS` if it is `None`.
+
+        `full_checkout` is needed when checks use files that are not in `mentioned_files`, e.g. to compile a whole project."""
         self.refusing_check = refusing_check
         self.accepting_check = accepting_check
+        self.max_parallel_checks = max_parallel_checks
+        self.full_checkout = full_checkout
 
     def mentioned_files(self,exercise_name):
         return self.refusing_check.mentioned_files(exercise_name).union(self.accepting_check.mentioned_files(exercise_name))
@@ -282,6 +506,14 @@ class Strategy:
     def component_checks(self):
         return self.refusing_check.component_checks() + self.accepting_check.component_checks()
 
+    def fingerprint(self):
+        """Identifies this strategy in cached verdicts. Strategies are class attributes of content views, so this is computed once."""
+        if getattr(self,'_fingerprint',None) is None:
+            parts = [type(self).__qualname__,self.refusing_check.fingerprint(),self.accepting_check.fingerprint()]
+            self._fingerprint = hashlib.sha1('|'.join(parts).encode('utf-8')).hexdigest()
+        return self._fingerprint
+
+    @memoize_per_exercise
     def instructions(self,exercise_name):
         ref_instructions = self.refusing_check.instructions(exercise_name)
         acc_instructions = self.accepting_check.instructions(exercise_name)
@@ -291,20 +523,34 @@ class Strategy:
                 accepting=acc_instructions,
                 implicit_accepting_components=self.accepting_check.has_implicit_components())
  
+    def compiled(self):
+        """Returns the evaluation plans of the refusing and the accepting check, compiled on first use."""
+        if getattr(self,'_plans',None) is None:
+            refusing_plan = EvaluationPlan(self.refusing_check,desired_outcome=False,init_check_number=1)
+            accepting_plan = EvaluationPlan(self.accepting_check,desired_outcome=True,init_check_number=refusing_plan.successor_component_number)
+            self._plans = (refusing_plan,accepting_plan)
+        return self._plans
+
     def check_submission(self,submission,student_path,model_path):
-        (outcome_refusing,analysis_refusing) = (None,[])
-        (outcome_accepting,analysis_accepting) = (None,[])
+        (outcome_analysis_refusing,outcome_analysis_accepting) = (None,None)
+        _parallel_evaluation.max_workers = self.max_parallel_checks
         try:
-            outcome_analysis_refusing = self.refusing_check.check_submission(submission,student_path,model_path,desired_outcome=False,init_check_number=1)
+            (refusing_plan,accepting_plan) = self.compiled()
+            outcome_analysis_refusing = refusing_plan.check_submission(submission,student_path,model_path)
             if outcome_analysis_refusing.outcome:
-                return (SubmissionState.NEW_REFUSED,outcome_analysis_refusing.components)
-            outcome_analysis_accepting = self.accepting_check.check_submission(submission,student_path,model_path,desired_outcome=True,init_check_number=outcome_analysis_refusing.successor_component_number)
-            if outcome_accepting:
-                return (SubmissionState.ACCEPTED,outcome_analysis_accepting.components)
+                return (SubmissionState.NEW_REFUSED,outcome_analysis_refusing.outcomes_components)
+            outcome_analysis_accepting = accepting_plan.check_submission(submission,student_path,model_path)
+            if outcome_analysis_accepting.outcome:
+                return (SubmissionState.ACCEPTED,outcome_analysis_accepting.outcomes_components)
         except Exception as e:
             logger.exception('Fout bij controle submissie: %s',e)
+        finally:
+            _parallel_evaluation.max_workers = None
+        outcome_refusing = outcome_analysis_refusing.outcome if outcome_analysis_refusing else None
+        outcome_accepting = outcome_analysis_accepting.outcome if outcome_analysis_accepting else None
         logger.warning(f'Submissie die niet beslist kon worden. Outcome refusing was {outcome_refusing} en outcome accepting was {outcome_accepting}')
-        return (SubmissionState.PENDING,[OutcomeComponent(component_number=None,outcome=None,desired_outcome=None,renderer="text",renderer_data=f"Het systeem kan niet automatisch bepalen of je inzending klopt. De lector wordt verwittigd. Weigering was {outcome_analysis_refusing.outcome} en aanvaarding was {outcome_analysis_accepting.outcome}")] + outcome_analysis_refusing.components + outcome_analysis_accepting.components)
+        components = [component for analysis in (outcome_analysis_refusing,outcome_analysis_accepting) if analysis for component in analysis.outcomes_components]
+        return (SubmissionState.PENDING,[OutcomeComponent(component_number=None,outcome=None,desired_outcome=None,renderer="text",renderer_data=f"Het systeem kan niet automatisch bepalen of je inzending klopt. De lector wordt verwittigd. Weigering was {outcome_refusing} en aanvaarding was {outcome_accepting}")] + components)
 
 # order is important for selection dropdowns
 batch_types = [BatchType] + list(BatchType.__subclasses__())
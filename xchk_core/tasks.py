@@ -1,30 +1,41 @@
 from config import celery_app
+import celery
+from celery.exceptions import Ignore
 import channels.layers
 from asgiref.sync import async_to_sync
-from .models import Repo, SubmissionState, SubmissionV2
-from . import contentviews, courses, strats
+from .models import Repo, SubmissionState, SubmissionV2, record_completions
+from . import coalesce, contentviews, courses, fileindex, gitops, metrics, repocache, strats, verdicts, workspaces
 
 import os
-import subprocess
-from contextlib import redirect_stdout
+from contextlib import nullcontext, redirect_stdout
 import environ
 import logging
 import time
 from django.db import transaction
+from django.conf import settings
 
 logger = logging.getLogger(__name__)
 
-MODEL_SOLUTION_DIR = '/tmp/modeloplossingen'
-STUDENT_SOLUTION_DIR = '/tmp/studentrepo'
+DEFAULT_MAX_SUBMITTED_FILE_SIZE = 1024 ** 2
 
-############################################
-#              !!! OPGELET !!!             #
-# DEZE TASKS VERONDERSTELLEN CONCURRENCY 1 #
-#              !!! OPGELET !!!             #
-############################################
+# every task works in its own workspace, so workers can run with --concurrency=N
 
-def _check_submissions_in_commit(submissions,checksum,batchtype_id):
+def _publish_progress(group_name,submission,analysis):
+    """Tells the consumers in `group_name` how one submission of a running batch was decided."""
+    try:
+        channel_layer = channels.layers.get_channel_layer()
+        async_to_sync(channel_layer.group_send)(group_name,
+                {'type': 'progress',
+                 'content_uid': submission.content_uid,
+                 'state': int(submission.state),
+                 'analysis': analysis})
+    except Exception as e:
+        # progress is only a courtesy, the final result is still sent by notify_result
+        logger.warning('Kon voortgang niet doorsturen: %s',e)
+
+def _check_submissions_in_commit(submissions,checksum,batchtype_id,workspace,solutions_commit,progress_group=None):
     batchtype = strats.batch_types[batchtype_id]
+    recorder = metrics.current_recorder()
     (exit_code, analysis) = (None,None)
     first_failed_or_unreached_submission = None
     for submission in submissions:
@@ -32,9 +43,9 @@ def _check_submissions_in_commit(submissions,checksum,batchtype_id):
         # kan zijn dat foute UID is ingegeven (weliswaar alleen door geknoei van studenten of update server)
         # is_accessible_by kan niet meer per node voorzien worden
         # maar kan wel per contentview voorzien worden
-        eligible_exercises = [content for content in contentviews.all_contentviews if content.uid == submission.content_uid]
-        exercise = eligible_exercises[0]
+        submission_analysis = []
         try:
+            exercise = contentviews.get_contentview(submission.content_uid)
             submission.checksum = checksum
             if exit_code is None or exit_code == SubmissionState.ACCEPTED:
                 strategy = exercise.strat
@@ -50,10 +61,23 @@ def _check_submissions_in_commit(submissions,checksum,batchtype_id):
                         # 3) format name for extra explanation (or None if explanation is None)
                         # 4) explanation in said format (or None)
                         (exit_code,analysis) = (SubmissionState.NOT_REACHED,[(None,None,None,"text","Minstens één uit te voeren controle is niet toegelaten door het batchtype.")])
+                        submission.state = exit_code
+                        submission_analysis = analysis
                 # if all checks are allowed, check this submission
                 if exit_code is None or exit_code == SubmissionState.ACCEPTED:
-                    (exit_code,analysis) = exercise.strat.check_submission(submission,STUDENT_SOLUTION_DIR,MODEL_SOLUTION_DIR)
+                    verdict = verdicts.get_verdict(checksum,submission.content_uid,solutions_commit,strategy)
+                    if verdict is None:
+                        # workspace is only filled once something really has to be checked
+                        workspace.prepare()
+                        if strategy.component_checks():
+                            # checks with side effects may change the files, so they are no longer indexed
+                            fileindex.invalidate(workspace.student_dir)
+                        with recorder.exercise(submission.content_uid) if recorder else nullcontext():
+                            verdict = strategy.check_submission(submission,workspace.student_dir,workspace.model_dir)
+                        verdicts.store_verdict(checksum,submission.content_uid,solutions_commit,strategy,*verdict)
+                    (exit_code,analysis) = verdict
                     submission.state = exit_code
+                    submission_analysis = analysis
                 if exit_code is not None and exit_code != SubmissionState.ACCEPTED:
                     first_failed_or_unreached_submission = submission
             else:
@@ -62,66 +86,309 @@ def _check_submissions_in_commit(submissions,checksum,batchtype_id):
             logger.exception('Fout bij controle submissie: %s',e)
             analysis = [(None,None,None,"text","Er is iets fout gelopen, meld aan de lector.")]
             submission.state = SubmissionState.NOT_REACHED
+            submission_analysis = analysis
             if not first_failed_or_unreached_submission:
                 first_failed_or_unreached_submission = submission
-        finally:
-            submission.save()
-    batchtype.cleanup(STUDENT_SOLUTION_DIR,MODEL_SOLUTION_DIR)
+        if progress_group is not None:
+            _publish_progress(progress_group,submission,submission_analysis)
+    if recorder is not None:
+        for submission in submissions:
+            submission.timings = recorder.for_submission(submission.content_uid)
+    return _store_batch(submissions,first_failed_or_unreached_submission,analysis)
+
+def _store_batch(submissions,first_failed_or_unreached_submission,analysis):
+    # one write for the whole batch, whether submissions were checked or not
+    fields = ['state','checksum']
+    if any(submission.timings is not None for submission in submissions):
+        fields.append('timings')
+    with transaction.atomic():
+        SubmissionV2.objects.bulk_update(submissions,fields)
+        record_completions(submissions)
     if first_failed_or_unreached_submission is not None:
         # TODO: zou beter zijn hier een titel te voorzien, maar oké
         return (first_failed_or_unreached_submission.content_uid,analysis)
     else:
         return (submissions[-1].content_uid,[]) # empty analysis if everything is okay
 
+def _sparse_checkout_paths(submissions):
+    """Returns the files the exercises of a batch depend on, or `None` if the student repository has to be checked out completely."""
+    if not getattr(settings,'XCHK_SPARSE_CHECKOUTS',False):
+        return None
+    paths = set()
+    for submission in submissions:
+        try:
+            strategy = contentviews.get_contentview(submission.content_uid).strat
+        except KeyError:
+            return None
+        if strategy.full_checkout:
+            return None
+        paths |= strategy.mentioned_files(submission.content_uid)
+    return paths
+
+def _check_batch(batchtype_id,repo,submissions,group_name):
+    repo_cache = repocache.get_repo_cache()
+    solutions_url = courses.courses()[repo.course].solutions_url
+    recorder = metrics.current_recorder()
+    try:
+        # batch type cleanup and removal of checkouts are handled by the workspace
+        with recorder.batch_phase('fetch') if recorder else nullcontext():
+            solutions_commit = repo_cache.head(solutions_url)
+            checksum = repo_cache.head(repo.url)
+        with workspaces.Workspace(batchtype=strats.batch_types[batchtype_id]) as workspace:
+            def checkout_commits():
+                with recorder.batch_phase('checkout') if recorder else nullcontext():
+                    workspace.checkout(repo_cache,solutions_url,workspace.model_dir,commit=solutions_commit,update=False)
+                    sparse_paths = _sparse_checkout_paths(submissions)
+                    workspace.checkout(repo_cache,repo.url,workspace.student_dir,commit=checksum,update=False,sparse_paths=sparse_paths)
+                    gitops.make_world_writable(workspace.student_dir)
+                    # file checks of the whole batch look at this instead of the disk
+                    workspace.index_files(workspace.student_dir,from_git_tree=sparse_paths is None)
+            workspace.defer(checkout_commits)
+            print('gaan over naar subtaak')
+            return _check_submissions_in_commit(submissions,checksum,batchtype_id,workspace,solutions_commit,progress_group=group_name)
+    except repocache.RepoCacheError as e:
+        logger.warning('Repository niet opgehaald: %s',e)
+        for submission in submissions:
+            submission.state = SubmissionState.NOT_REACHED
+        with transaction.atomic():
+            SubmissionV2.objects.bulk_update(submissions,['state'])
+        return ("geen oefening bereikt",[(None,None,None,"text",f"Probleem bij het ophalen van je repository. Klopt de URL en bevat de repository minstens één bestand?")])
+    finally:
+        repo_cache.maybe_evict()
+
+def publish_check(batchtype_id,repo,submission_ids,group_name,coalesce_token=None):
+    # need to represent repo / submission through their IDs because of serialization
+    check_submission_batch.apply_async(args=[batchtype_id,repo.id,list(submission_ids)],
+                                       # the course picks the queue when checks are routed per course
+                                       kwargs={'group_name': group_name,'course': repo.course,'coalesce_token': coalesce_token,'enqueued_at': time.time()},
+                                       link=notify_result.s(group_name),
+                                       expires=coalesce.BATCH_EXPIRES)
+
+def _share_result(coalesce_token,batchtype_id,repo,submissions,result):
+    """Gives the subscribers of a coalesced batch its result, or a batch of their own if the result does not apply to them."""
+    checksum = submissions[0].checksum if submissions else None
+    current_head = None
+    for subscriber in coalesce.finish(coalesce_token):
+        reusable = result is not None
+        if reusable and subscriber['verify_head']:
+            try:
+                current_head = current_head or repocache.get_repo_cache().head(repo.url)
+            except repocache.RepoCacheError:
+                current_head = None
+            reusable = current_head is not None and current_head == checksum
+        if not reusable:
+            publish_check(batchtype_id,repo,subscriber['submission_ids'],subscriber['group_name'])
+            continue
+        subscriber_submissions_by_id = SubmissionV2.objects.in_bulk(subscriber['submission_ids'])
+        subscriber_submissions = [subscriber_submissions_by_id[submission_id] for submission_id in subscriber['submission_ids']]
+        # identical requests have the same exercises in the same order
+        for (submission,subscriber_submission) in zip(submissions,subscriber_submissions):
+            subscriber_submission.state = submission.state
+            subscriber_submission.checksum = submission.checksum
+        with transaction.atomic():
+            SubmissionV2.objects.bulk_update(subscriber_submissions,['state','checksum'])
+            record_completions(subscriber_submissions)
+        notify_result.delay(result,subscriber['group_name'])
+
+def _speculative_batch(submissions):
+    """Whether the submissions of a batch may be checked side by side, which requires checks without side effects."""
+    if not getattr(settings,'XCHK_SPECULATIVE_BATCHES',False) or len(submissions) < 2:
+        return False
+    for submission in submissions:
+        try:
+            strategy = contentviews.get_contentview(submission.content_uid).strat
+        except KeyError:
+            return False
+        if strategy.component_checks():
+            return False
+    return True
+
+def _checkout_pinned(workspace,repo_cache,url,dest,commit,sparse_paths=None):
+    # the commit was resolved by the batch, possibly on another host whose mirror is further along
+    try:
+        return workspace.checkout(repo_cache,url,dest,commit=commit,update=False,sparse_paths=sparse_paths)
+    except repocache.RepoCacheError:
+        return workspace.checkout(repo_cache,url,dest,commit=commit,update=True,sparse_paths=sparse_paths)
+
+@celery_app.task(priority=0)
+def check_submission_speculatively(submission_id,checksum,solutions_commit,*args,batchtype_id=0,course=None,**kwargs):
+    """Checks a single submission of a speculative batch at the commits resolved by the batch.
+
+    Nothing is stored, `aggregate_speculative_batch` decides which verdicts count. Returns `(state, analysis, timings)`.
+    `batchtype_id` and `course` are keywords, so `queues.route_task` can find them."""
+    submission = SubmissionV2.objects.select_related('repo').get(id=submission_id)
+    submission.checksum = checksum
+    with metrics.recording() as recorder:
+        (state,analysis) = _check_speculatively(batchtype_id,submission,checksum,solutions_commit)
+    if recorder is not None:
+        metrics.flush()
+    return (int(state),analysis,recorder.for_submission(submission.content_uid) if recorder else None)
+
+def _check_speculatively(batchtype_id,submission,checksum,solutions_commit):
+    repo = submission.repo
+    try:
+        strategy = contentviews.get_contentview(submission.content_uid).strat
+        verdict = verdicts.get_verdict(checksum,submission.content_uid,solutions_commit,strategy)
+        if verdict is None:
+            repo_cache = repocache.get_repo_cache()
+            with workspaces.Workspace(batchtype=strats.batch_types[batchtype_id]) as workspace:
+                sparse_paths = _sparse_checkout_paths([submission])
+                _checkout_pinned(workspace,repo_cache,courses.courses()[repo.course].solutions_url,workspace.model_dir,solutions_commit)
+                _checkout_pinned(workspace,repo_cache,repo.url,workspace.student_dir,checksum,sparse_paths=sparse_paths)
+                gitops.make_world_writable(workspace.student_dir)
+                workspace.index_files(workspace.student_dir,from_git_tree=sparse_paths is None)
+                recorder = metrics.current_recorder()
+                with recorder.exercise(submission.content_uid) if recorder else nullcontext():
+                    verdict = strategy.check_submission(submission,workspace.student_dir,workspace.model_dir)
+            verdicts.store_verdict(checksum,submission.content_uid,solutions_commit,strategy,*verdict)
+        return verdict
+    except Exception as e:
+        logger.exception('Fout bij controle submissie: %s',e)
+        return (SubmissionState.NOT_REACHED,[(None,None,None,"text","Er is iets fout gelopen, meld aan de lector.")])
+
 @celery_app.task(priority=0)
-def check_submission_batch(batchtype_id,repo_id,submission_ids,*args,**kwargs):
+def aggregate_speculative_batch(speculative_verdicts,repo_id,submission_ids,checksum,*args,batchtype_id=0,course=None,group_name=None,coalesce_token=None,**kwargs):
+    """Applies the verdicts of a speculative batch as if its submissions had been checked one by one.
+
+    Only verdicts up to the first submission that was not accepted count, later submissions are not reached."""
+    repo = Repo.objects.get(id=repo_id)
+    submissions_by_id = SubmissionV2.objects.in_bulk(submission_ids)
+    submissions = [submissions_by_id[submission_id] for submission_id in submission_ids]
+    result = None
+    try:
+        (exit_code,analysis) = (None,None)
+        first_failed_or_unreached_submission = None
+        # a chord keeps the order of its header
+        for (submission,(state,submission_analysis,timings)) in zip(submissions,speculative_verdicts):
+            submission.checksum = checksum
+            submission.timings = timings
+            if exit_code is None or exit_code == SubmissionState.ACCEPTED:
+                (exit_code,analysis) = (SubmissionState(state),submission_analysis)
+                submission.state = exit_code
+                if exit_code != SubmissionState.ACCEPTED:
+                    first_failed_or_unreached_submission = submission
+            else:
+                submission.state = SubmissionState.NOT_REACHED
+                submission_analysis = []
+            if group_name is not None:
+                _publish_progress(group_name,submission,submission_analysis)
+        result = _store_batch(submissions,first_failed_or_unreached_submission,analysis)
+        return result
+    finally:
+        if coalesce_token is not None:
+            _share_result(coalesce_token,batchtype_id,repo,submissions,result)
+
+@celery_app.task(priority=0)
+def fail_speculative_batch(request,exc,traceback,repo_id,submission_ids,checksum,*args,batchtype_id=0,course=None,group_name=None,coalesce_token=None,**kwargs):
+    """Error handler of a speculative batch, for when a check or the aggregation failed instead of returning a verdict.
+
+    Stores every submission as not reached and tells the student, so nothing stays pending."""
+    logger.error('Speculatieve batch mislukt: %s',exc)
+    repo = Repo.objects.get(id=repo_id)
+    submissions_by_id = SubmissionV2.objects.in_bulk(submission_ids)
+    submissions = [submissions_by_id[submission_id] for submission_id in submission_ids if submission_id in submissions_by_id]
+    result = None
+    try:
+        if not submissions:
+            return None
+        analysis = [(None,None,None,"text","Er is iets fout gelopen, meld aan de lector.")]
+        for submission in submissions:
+            submission.state = SubmissionState.NOT_REACHED
+            submission.checksum = checksum
+            if group_name is not None:
+                _publish_progress(group_name,submission,analysis)
+        result = _store_batch(submissions,submissions[0],analysis)
+        if group_name is not None:
+            # the callbacks of the batch are linked to the aggregation, which did not run
+            notify_result.delay(result,group_name)
+        return result
+    finally:
+        if coalesce_token is not None:
+            _share_result(coalesce_token,batchtype_id,repo,submissions,result)
+
+def _speculative_chord(batchtype_id,repo,submissions,group_name,coalesce_token):
+    repo_cache = repocache.get_repo_cache()
+    # every submission is checked at the same commits, whichever worker runs it
+    solutions_commit = repo_cache.head(courses.courses()[repo.course].solutions_url)
+    checksum = repo_cache.head(repo.url)
+    submission_ids = [submission.id for submission in submissions]
+    batch_kwargs = {'batchtype_id': batchtype_id,'course': repo.course,'group_name': group_name,'coalesce_token': coalesce_token}
+    aggregation = aggregate_speculative_batch.s(repo.id,submission_ids,checksum,**batch_kwargs)
+    # a failing check keeps the aggregation from running at all
+    aggregation.link_error(fail_speculative_batch.s(repo.id,submission_ids,checksum,**batch_kwargs))
+    return celery.chord([check_submission_speculatively.s(submission_id,checksum,solutions_commit,batchtype_id=batchtype_id,course=repo.course)
+                         for submission_id in submission_ids],
+                        aggregation)
+
+@celery_app.task(bind=True,priority=0)
+def check_submission_batch(self,batchtype_id,repo_id,submission_ids,*args,group_name=None,course=None,coalesce_token=None,enqueued_at=None,**kwargs):
+    """With a `group_name`, every decided submission is also reported to that channel layer group while the batch runs.
+
+    `course` is only used by `queues.route_task`. With a `coalesce_token`, the result is shared with identical requests made in the meantime.
+    `enqueued_at` is the `time.time()` at which the batch was published, to measure how long it waited.
+    With `XCHK_SPECULATIVE_BATCHES`, a batch without side effects is replaced by a chord that checks its submissions side by side,
+    which needs a Celery result backend. Eager apps always check the regular way."""
     # all id's have been queried by consumer, so assume they are okay
     # batchtype = strats.batch_types[batchtype_id]
     repo = Repo.objects.get(id=repo_id)
-    subprocess.run(f'rm -rf {MODEL_SOLUTION_DIR}',shell=True)
-    subprocess.run(f'rm -rf {STUDENT_SOLUTION_DIR}',shell=True)
-    cmd = f'git clone {courses.courses[repo.course].solutions_url} {MODEL_SOLUTION_DIR}'
-    print(courses.courses[repo.course].description)
-    print(courses.courses[repo.course].solutions_url)
-    print(cmd)
-    subprocess.run(cmd,shell=True)
-    subprocess.run(f'git clone {repo.url} {STUDENT_SOLUTION_DIR}',shell=True)
-    subprocess.run(f'chmod -R 777 {STUDENT_SOLUTION_DIR}',shell=True)
-    checksum = subprocess.run(f'cd {STUDENT_SOLUTION_DIR} ; git rev-parse HEAD',\
-                              shell=True,\
-                              capture_output=True).stdout.decode('utf-8').strip()
-    submissions = [SubmissionV2.objects.get(id=submission_id) for submission_id in submission_ids]
-    print('gaan over naar subtaak')
-    if len(checksum) == 40:
-        return _check_submissions_in_commit(submissions,checksum,batchtype_id)
-    else:
-        with transaction.atomic():
-            for submission in submissions:
-                submission.state = SubmissionState.NOT_REACHED
-                submission.save()
-        return ("geen oefening bereikt",[(None,None,None,"text",f"Probleem bij het ophalen van je repository. Klopt de URL en bevat de repository minstens één bestand?")])
+    submissions_by_id = SubmissionV2.objects.in_bulk(submission_ids)
+    submissions = [submissions_by_id[submission_id] for submission_id in submission_ids]
+    with metrics.recording() as recorder:
+        if coalesce_token is not None:
+            coalesce.mark_running(coalesce_token)
+        result = None
+        shared_here = coalesce_token is not None
+        try:
+            if recorder is not None and enqueued_at is not None:
+                recorder.record_batch('queue_wait',max(0.0,time.time() - enqueued_at))
+            # an eager app would have to wait for the chord inside this task, which Celery does not allow
+            if not self.request.is_eager and _speculative_batch(submissions):
+                try:
+                    speculative_chord = _speculative_chord(batchtype_id,repo,submissions,group_name,coalesce_token)
+                except repocache.RepoCacheError:
+                    # the regular path reports the problem to the student
+                    speculative_chord = None
+                if speculative_chord is not None:
+                    try:
+                        return self.replace(speculative_chord)
+                    except Ignore:
+                        # replaced, the aggregating task or its error handler shares the result
+                        shared_here = False
+                        raise
+            result = _check_batch(batchtype_id,repo,submissions,group_name)
+            return result
+        finally:
+            if shared_here:
+                _share_result(coalesce_token,batchtype_id,repo,submissions,result)
+            if recorder is not None:
+                metrics.flush()
 
 @celery_app.task(priority=1)
 def retrieve_submitted_files(submission_id,*args,**kwargs):
-    submission = Submission.objects.get(id=submission_id)
-    node = submission.exercise
+    submission = SubmissionV2.objects.select_related('repo').get(id=submission_id)
     repo = submission.repo
-    subprocess.run(f'rm -rf /tmp/submission{submission_id}',shell=True)
-    subprocess.run(f'git clone {repo.url} /tmp/submission{submission_id}',shell=True)
-    subprocess.run(f'cd /tmp/submission{submission_id}; git checkout {submission.checksum}',shell=True)
+    max_size = getattr(settings,'XCHK_MAX_SUBMITTED_FILE_SIZE',DEFAULT_MAX_SUBMITTED_FILE_SIZE)
     try:
+        exercise = contentviews.get_contentview(submission.content_uid)
+        repo_cache = repocache.get_repo_cache()
+        # a submission that was not checked yet has no commit, so show what was pushed last
+        commit = submission.checksum or repo_cache.head(repo.url)
+        # blobs are read from the cached mirror, nothing is checked out
+        files = repo_cache.read_files(repo.url,
+                                      commit,
+                                      exercise.strat.mentioned_files(submission.content_uid),
+                                      max_size)
         result = []
-        for mentioned_file in node.mentioned_files():
-            mentioned_path = os.path.join(f'/tmp/submission{submission_id}',mentioned_file)
-            if os.path.exists(mentioned_path):
-                with open(mentioned_path) as fh:
-                    single_file_result = (mentioned_file,'codelines',fh.readlines()) # code = algemene renderingstrategie? kan bv. zijn 'pygments',...
-                result.append(single_file_result)
-            else:
+        for (mentioned_file,size,content) in files:
+            if size is None:
                 result.append((mentioned_file,'',False)) # dus file is er gewoon niet
+            elif content is None:
+                result.append((mentioned_file,'codelines',[f'Bestand is te groot om te tonen ({size} bytes, maximum {max_size}).\n']))
+            else:
+                result.append((mentioned_file,'codelines',content.decode('utf-8',errors='replace').splitlines(keepends=True))) # code = algemene renderingstrategie? kan bv. zijn 'pygments',...
         return result
     except Exception as e:
-        print(e)
+        logger.exception('Fout bij ophalen van ingediende bestanden')
         return "Iets misgelopen bij het ophalen van de verplichte bestanden. Kan een verkeerde filename zijn, kan een fout bij uitlezen files zijn."
 
 # top priority for notification task
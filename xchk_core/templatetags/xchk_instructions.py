@@ -1,54 +1,75 @@
 from django import template
 from django.utils.html import conditional_escape
 from django.utils.safestring import mark_safe
-import functools
+import threading
+from collections import OrderedDict
 from xchk_core.strats import StratInstructions
 
 register = template.Library()
 
-def iterable(obj):
-    try:
-        iter(obj)
-    except Exception:
-        return False
-    else:
-        return True
+# strategies return the same instructions object for every request, so rendered HTML is cached per object
+# (id(instructions), autoescape) -> (instructions, html); keeping the object alive keeps its id unique
+MAX_RENDERED_INSTRUCTIONS = 1024
+_rendered_instructions = OrderedDict()
+_rendered_instructions_lock = threading.Lock()
 
-def _node_instructions_2_ul(instructions):
-    instructions = StratInstructions(*instructions)
-    def _folded(acc,elem):
-        (acc_txt,before_ctr) = acc
-        (elem_txt,after_ctr) = _aux(elem,before_ctr)
-        return (acc_txt + elem_txt,after_ctr)
-    def _aux(lst_or_str,li_counter):
-        if isinstance(lst_or_str,str):
-            return (f'<li><a href="#explanation-{li_counter}">{lst_or_str}</a></li>',li_counter+1)
-        elif len(lst_or_str) == 1:
-            return _aux(lst_or_str[0],li_counter)
+def _unescaped(value):
+    return value
+
+def _escaped(value):
+    return conditional_escape(value) if isinstance(value,str) else value
+
+def _append_items(buffer,instructions,li_counter,escape):
+    """Appends the list items of a nested instructions list to `buffer`, numbered from `li_counter`, and returns the next number.
+
+    A string is an item, a list is a heading item followed by its sub-items, a list with a single element is just that element."""
+    # explicit stack instead of recursion, so deeply nested strategies cannot exceed the recursion limit
+    # None closes the sub-list of a heading
+    stack = [instructions]
+    while stack:
+        node = stack.pop()
+        if node is None:
+            buffer.append('</ul></li>')
+            continue
+        while not isinstance(node,str) and len(node) == 1:
+            node = node[0]
+        if isinstance(node,str):
+            buffer.append(f'<li><a href="#explanation-{li_counter}">{escape(node)}</a></li>')
         else:
-            (rec_txt,rec_ctr) = functools.reduce(_folded,lst_or_str[1:],("",li_counter+1))
-            return (f'<li><a href="#explanation-{li_counter}">{lst_or_str[0]}</a><ul>{rec_txt}</ul></li>',rec_ctr)
-    (ref_elems,ctr) = _aux(instructions.refusing,1)
+            buffer.append(f'<li><a href="#explanation-{li_counter}">{escape(node[0])}</a><ul>')
+            stack.append(None)
+            stack.extend(reversed(node[1:]))
+        li_counter += 1
+    return li_counter
+
+def _node_instructions_2_ul(instructions,autoescape=True):
+    instructions = StratInstructions(*instructions)
+    escape = _escaped if autoescape else _unescaped
+    buffer = ['<ul><li>Je oefening wordt geweigerd als:<ul>']
+    ctr = _append_items(buffer,instructions.refusing,1,escape)
+    buffer.append('</ul></li>')
     if instructions.implicit_refusing_components:
+        # the implicit components of the refusing check share a single number
+        buffer.append(f'<li><a href="#explanation-{ctr}">Impliciete voorwaarden voor weigering zijn voldaan</a></li>')
         ctr += 1
-    (acc_elems,ctr) = _aux(instructions.accepting,ctr)
-    return f'''<ul>
-                 <li>Je oefening wordt geweigerd als:<ul>{ref_elems}</ul></li>
-                 {'<li><a href="#explanation-{ctr}">Impliciete voorwaarden voor weigering zijn voldaan</a></li>'if instructions.implicit_refusing_components else ''}
-                 <li>Je oefening wordt aanvaard als:<ul>{acc_elems}</ul></li>
-                 {'<li><a href="#explanation-{ctr}">Impliciete voorwaarden voor aanvaarding zijn voldaan</a></li>'if instructions.implicit_accepting_components else ''}
-               </ul>'''
-
-def _nested_conditional_escape(lst):
-    return [conditional_escape(e) if isinstance(e,str)\
-                                  else _nested_conditional_escape(e) if iterable(e)\
-                                  else e\
-            for e in lst]
+    buffer.append('<li>Je oefening wordt aanvaard als:<ul>')
+    ctr = _append_items(buffer,instructions.accepting,ctr,escape)
+    buffer.append('</ul></li>')
+    if instructions.implicit_accepting_components:
+        buffer.append(f'<li><a href="#explanation-{ctr}">Impliciete voorwaarden voor aanvaarding zijn voldaan</a></li>')
+    buffer.append('</ul>')
+    return ''.join(buffer)
 
 @register.filter(needs_autoescape=True)
 def node_instructions_2_ul(value, autoescape=True):
-    if autoescape:
-        escaped_value = _nested_conditional_escape(value)
-    else:
-        escaped_value = value
-    return mark_safe(_node_instructions_2_ul(escaped_value))
+    key = (id(value),autoescape)
+    cached = _rendered_instructions.get(key)
+    if cached is not None and cached[0] is value:
+        return cached[1]
+    # escaped while rendering, in the same pass
+    html = mark_safe(_node_instructions_2_ul(value,autoescape))
+    with _rendered_instructions_lock:
+        _rendered_instructions[key] = (value,html)
+        if len(_rendered_instructions) > MAX_RENDERED_INSTRUCTIONS:
+            _rendered_instructions.popitem(last=False)
+    return html
@@ -1,10 +1,32 @@
 import unittest
-from django.test import TestCase
+import os
+import random
+import shutil
+import subprocess
+import tempfile
+import threading
+import gc
+import sys
+import time
+import types
+import datetime
+import json
+from django.test import TestCase, override_settings
 from unittest.mock import Mock, patch, MagicMock
 from bs4 import BeautifulSoup
-from xchk_core.models import SubmissionV2
+from xchk_core.models import CompletedContent, Repo, SubmissionV2, record_completions
 from xchk_core.strats import *
 from xchk_core.templatetags.xchk_instructions import node_instructions_2_ul
+from xchk_core.repocache import RepoCache, RepoCacheError
+from xchk_core.workspaces import Workspace
+from xchk_core import gitops
+from xchk_core import coalesce, courses, fileindex, metrics, overviews, queues, ratelimit, verdicts
+from xchk_core.models import SubmissionState
+from xchk_core.contentviews import ContentView, ImpossibleNodeView, contentview_registry, get_contentview, invalidate_contentview_registry
+from django.core.exceptions import ImproperlyConfigured
+from django.core.cache import caches
+from django.db import connection
+from asgiref.sync import async_to_sync
 
 class TrueCheckInstructionGenerationTest(TestCase):
 
@@ -30,6 +52,10 @@ class TrueCheckInstructionGenerationTest(TestCase):
 
 class FileExistsCheckInstructionGenerationTest(TestCase):
 
+    def test_mentioned_files(self):
+        chk = ConjunctiveCheck([FileExistsCheck('myfile','txt'),Negation(FileExistsCheck(extension='py'))])
+        self.assertEqual(chk.mentioned_files('ex'),{'myfile.txt','ex.py'})
+
     def test_standard_file_exists_instruction(self):
         chk = FileExistsCheck('myfile','txt')
         self.assertEqual(chk.instructions(None),["Je hebt een bestand met naam myfile.txt"])
@@ -179,6 +205,1245 @@ class Instructions2HtmlTest(TestCase):
         soup2 = BeautifulSoup(intended,'html.parser')
         self.assertEqual(soup1.prettify(),soup2.prettify())
 
+    def _anchors(self,html):
+        return [(a['href'],a.text) for a in BeautifulSoup(html,'html.parser').find_all('a')]
+
+    def test_implicit_components_are_numbered(self):
+        instructions = StratInstructions(refusing=["<False>"],implicit_refusing_components=True,accepting=[ALL_OF_TEXT,"a","b"],implicit_accepting_components=True)
+        self.assertEqual(self._anchors(node_instructions_2_ul(instructions)),
+                         [('#explanation-1','<False>'),
+                          ('#explanation-2','Impliciete voorwaarden voor weigering zijn voldaan'),
+                          ('#explanation-3',ALL_OF_TEXT),('#explanation-4','a'),('#explanation-5','b'),
+                          ('#explanation-6','Impliciete voorwaarden voor aanvaarding zijn voldaan')])
+        self.assertIn('&lt;False&gt;',node_instructions_2_ul(instructions))
+        self.assertIn('<False>',node_instructions_2_ul(instructions,autoescape=False))
+
+    def test_large_instructions(self):
+        deep = "leaf"
+        for _ in range(5000):
+            deep = [ALL_OF_TEXT,deep,"sibling"]
+        wide = [AT_LEAST_ONE_TEXT] + [f"item {idx}" for idx in range(20000)]
+        instructions = StratInstructions(refusing=deep,implicit_refusing_components=False,accepting=wide,implicit_accepting_components=False)
+        start = time.perf_counter()
+        html = node_instructions_2_ul(instructions)
+        self.assertLess(time.perf_counter() - start,2)
+        self.assertEqual(html.count('<ul>'),5000 + 4)
+        self.assertEqual(html.count('<ul>'),html.count('</ul>'))
+        self.assertIn('<a href="#explanation-5001">leaf</a>',html)
+        self.assertIn('<a href="#explanation-10001">sibling</a>',html)
+        self.assertIn('<a href="#explanation-10002">Aan minstens',html)
+        self.assertIn('<a href="#explanation-30002">item 19999</a>',html)
+
+def _make_local_repo(path,files):
+    """Creates a git repository at `path` with one commit containing `files` (name -> content)."""
+    subprocess.run(['git','init','--quiet',path],check=True)
+    _commit_files(path,files)
+
+def _commit_files(path,files):
+    for (name,content) in files.items():
+        os.makedirs(os.path.dirname(os.path.join(path,name)),exist_ok=True)
+        with open(os.path.join(path,name),'w') as fh:
+            fh.write(content)
+    subprocess.run(['git','add','-A'],cwd=path,check=True)
+    subprocess.run(['git','-c','user.name=xchk','-c','user.email=xchk@example.com','commit','--quiet','-m','commit'],cwd=path,check=True)
+    return subprocess.run(['git','rev-parse','HEAD'],cwd=path,check=True,capture_output=True).stdout.decode('utf-8').strip()
+
+class RepoCacheTest(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.origin = os.path.join(self.tmp,'origin')
+        _make_local_repo(self.origin,{'oefening.txt':'eerste versie'})
+        self.url = f'file://{self.origin}'
+        self.cache = RepoCache(root=os.path.join(self.tmp,'cache'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp,ignore_errors=True)
+
+    def test_worktree_checks_out_head(self):
+        dest = os.path.join(self.tmp,'checkout')
+        with self.cache.worktree(self.url,dest) as commit:
+            self.assertEqual(len(commit),40)
+            with open(os.path.join(dest,'oefening.txt')) as fh:
+                self.assertEqual(fh.read(),'eerste versie')
+        self.assertFalse(os.path.exists(dest))
+
+    def test_worktree_fetches_new_commits(self):
+        dest = os.path.join(self.tmp,'checkout')
+        with self.cache.worktree(self.url,dest):
+            pass
+        new_commit = _commit_files(self.origin,{'oefening.txt':'tweede versie'})
+        with self.cache.worktree(self.url,dest) as commit:
+            self.assertEqual(commit,new_commit)
+            with open(os.path.join(dest,'oefening.txt')) as fh:
+                self.assertEqual(fh.read(),'tweede versie')
+
+    def test_read_files_from_mirror(self):
+        first_commit = gitops.read_head(self.origin)
+        _commit_files(self.origin,{'oefening.txt':'tweede versie','groot.txt':'x' * 100,'map/bestand.txt':'in map'})
+        files = self.cache.read_files(self.url,'HEAD',['oefening.txt','groot.txt','map','map/bestand.txt','ontbreekt.txt'],max_size=50)
+        self.assertEqual(files,[('oefening.txt',len('tweede versie'),b'tweede versie'),
+                                ('groot.txt',100,None),
+                                ('map',None,None),
+                                ('map/bestand.txt',len('in map'),b'in map'),
+                                ('ontbreekt.txt',None,None)])
+        self.assertEqual(self.cache.read_files(self.url,first_commit,['oefening.txt'],max_size=50),
+                         [('oefening.txt',len('eerste versie'),b'eerste versie')])
+
+    def test_read_files_fetches_unknown_commit(self):
+        self.cache.mirror(self.url)
+        new_commit = _commit_files(self.origin,{'oefening.txt':'tweede versie'})
+        self.assertEqual(self.cache.read_files(self.url,new_commit,['oefening.txt'],max_size=50),
+                         [('oefening.txt',len('tweede versie'),b'tweede versie')])
+
+    def test_head_without_checkout(self):
+        new_commit = _commit_files(self.origin,{'oefening.txt':'tweede versie'})
+        self.assertEqual(self.cache.head(self.url),new_commit)
+        dest = os.path.join(self.tmp,'checkout')
+        with self.cache.worktree(self.url,dest,commit=new_commit,update=False) as commit:
+            self.assertEqual(commit,new_commit)
+
+    def test_head_reuses_recent_fetch(self):
+        first_commit = self.cache.head(self.url)
+        new_commit = _commit_files(self.origin,{'oefening.txt':'tweede versie'})
+        self.cache.fetch_interval = 60
+        self.assertEqual(self.cache.head(self.url),first_commit)
+        self.cache.fetch_interval = 0
+        self.assertEqual(self.cache.head(self.url),new_commit)
+
+    def test_checkouts_do_not_wait_for_fetch(self):
+        commit = self.cache.head(self.url)
+        self.cache.fetch_interval = 60
+        results = []
+        def check_out(idx):
+            with self.cache.worktree(self.url,os.path.join(self.tmp,f'checkout{idx}'),commit=commit,update=False) as checked_out:
+                results.append((self.cache.head(self.url),checked_out))
+        # as if another worker were fetching the mirror
+        with self.cache._lock(RepoCache.key(self.url),'fetch'):
+            threads = [threading.Thread(target=check_out,args=(idx,)) for idx in range(3)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join(timeout=10)
+            self.assertFalse(any(thread.is_alive() for thread in threads))
+        self.assertEqual(results,[(commit,commit)] * 3)
+        self.assertEqual(gitops.run_git('worktree','list','--porcelain',cwd=self.cache.mirror_dir(self.url)).count('worktree '),1)
+
+    def test_sparse_worktree(self):
+        _commit_files(self.origin,{'map/nodig.txt':'x','map/onnodig.txt':'y','groot.bin':'z'})
+        dest = os.path.join(self.tmp,'checkout')
+        with self.cache.worktree(self.url,dest,sparse_paths={'map/nodig.txt','oefening.txt'}):
+            found = {os.path.relpath(os.path.join(dirpath,filename),dest) for (dirpath,_,filenames) in os.walk(dest) for filename in filenames if '.git' not in filename}
+            self.assertEqual(found,{'map/nodig.txt','oefening.txt'})
+        # other worktrees of the same mirror are complete
+        with self.cache.worktree(self.url,dest):
+            self.assertTrue(os.path.exists(os.path.join(dest,'groot.bin')))
+        with self.cache.worktree(self.url,dest,sparse_paths=set()):
+            self.assertEqual(os.listdir(dest),['.git'])
+
+    def test_unreachable_repo(self):
+        with self.assertRaises(RepoCacheError):
+            with self.cache.worktree(f'file://{self.tmp}/bestaat_niet',os.path.join(self.tmp,'checkout')):
+                pass
+        self.assertEqual(os.listdir(self.cache.mirrors_dir),[])
+
+    def test_url_is_never_an_option(self):
+        marker = os.path.join(self.tmp,'uitgevoerd')
+        url = f'--upload-pack=touch {marker}; git-upload-pack'
+        # git looks for a repository of that name instead of running the command
+        with self.assertRaisesRegex(RepoCacheError,"repository '--upload-pack=touch"):
+            self.cache.head(url)
+        self.assertFalse(os.path.exists(marker))
+
+    def test_age_based_eviction(self):
+        mirror = self.cache.mirror(self.url)
+        self.assertEqual(self.cache.evict(now=time.time()),[])
+        self.assertEqual(self.cache.evict(now=time.time() + self.cache.max_age + 1),[mirror])
+        self.assertFalse(os.path.exists(mirror))
+
+    def test_size_based_eviction_spares_mirrors_in_use(self):
+        other_origin = os.path.join(self.tmp,'other')
+        _make_local_repo(other_origin,{'ander.txt':'x'})
+        old_mirror = self.cache.mirror(f'file://{other_origin}')
+        os.utime(os.path.join(old_mirror,'xchk-last-used'),(0,0))
+        self.cache.max_age = float('inf')
+        self.cache.max_bytes = 0
+        with self.cache.worktree(self.url,os.path.join(self.tmp,'checkout')):
+            self.assertEqual(self.cache.evict(),[old_mirror])
+        self.assertTrue(os.path.exists(self.cache.mirror_dir(self.url)))
+
+class WorkspaceTest(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.origin = os.path.join(self.tmp,'origin')
+        _make_local_repo(self.origin,{'oefening.txt':'inhoud'})
+        self.cache = RepoCache(root=os.path.join(self.tmp,'cache'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp,ignore_errors=True)
+
+    def test_workspaces_are_isolated(self):
+        with Workspace() as ws1, Workspace() as ws2:
+            self.assertNotEqual(ws1.root,ws2.root)
+            self.assertNotEqual(ws1.student_dir,ws2.student_dir)
+            ws1.checkout(self.cache,f'file://{self.origin}',ws1.student_dir)
+            ws2.checkout(self.cache,f'file://{self.origin}',ws2.student_dir)
+            self.assertTrue(os.path.exists(os.path.join(ws1.student_dir,'oefening.txt')))
+            self.assertTrue(os.path.exists(os.path.join(ws2.student_dir,'oefening.txt')))
+        self.assertFalse(os.path.exists(ws1.root))
+        self.assertFalse(os.path.exists(ws2.root))
+
+    def test_batchtype_cleanup_runs_on_failure(self):
+        batchtype = MagicMock()
+        with self.assertRaises(ValueError):
+            with Workspace(batchtype=batchtype) as ws:
+                ws.checkout(self.cache,f'file://{self.origin}',ws.student_dir)
+                raise ValueError()
+        batchtype.cleanup.assert_called_once_with(ws.student_dir,ws.model_dir)
+        self.assertFalse(os.path.exists(ws.root))
+
+    def test_failed_preparation_is_raised_again(self):
+        preparation = Mock(side_effect=RepoCacheError('checkout mislukt'))
+        with Workspace() as ws:
+            ws.defer(preparation)
+            for _ in range(2):
+                with self.assertRaises(RepoCacheError):
+                    ws.prepare()
+        preparation.assert_called_once_with()
+
+def _install_course_module(module_name,course):
+    """Makes `course` importable as `{module_name}.course`, like a real course in `XCHK_SOURCE_COURSES`."""
+    course_module = types.ModuleType(f'{module_name}.course')
+    course_module.course = course
+    sys.modules[f'{module_name}.course'] = course_module
+
+class CourseNodeA(ContentView):
+    uid = 'course_node_a'
+
+class CourseNodeB(ContentView):
+    uid = 'course_node_b'
+
+class CourseNodeC(ContentView):
+    uid = 'course_node_c'
+
+class CourseRegistryTest(TestCase):
+
+    def setUp(self):
+        course = courses.Course('testcursus','cursus voor tests',[(CourseNodeB,[CourseNodeA]),(CourseNodeC,[CourseNodeA,CourseNodeB])],'file:///dev/null')
+        _install_course_module('xchk_test_course',course)
+        self.settings_override = override_settings(XCHK_SOURCE_COURSES={'testcursus': 'xchk_test_course'})
+        self.settings_override.enable()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        del sys.modules['xchk_test_course.course']
+
+    def test_graph_structure(self):
+        graph = courses.course_graphs()['testcursus']
+        index = courses.registry.vertex_index('testcursus')
+        self.assertEqual(set(index.keys()),{'course_node_a','course_node_b','course_node_c'})
+        self.assertEqual(graph.vs[index['course_node_b']]['contentview'],CourseNodeB)
+        self.assertEqual(set(graph.vs[graph.predecessors(index['course_node_c'])]['label']),{'course_node_a','course_node_b'})
+        self.assertEqual(graph.predecessors(index['course_node_a']),[])
+
+    def test_graphs_are_built_once(self):
+        self.assertIs(courses.course_graphs()['testcursus'],courses.course_graphs()['testcursus'])
+        self.assertIs(courses.courses(),courses.courses())
+
+    def test_invalidate(self):
+        graph = courses.course_graphs()['testcursus']
+        courses.registry.invalidate()
+        self.assertIsNot(courses.course_graphs()['testcursus'],graph)
+
+    def test_cyclic_structure(self):
+        course = courses.Course('testcursus','cursus met een cyclus',[(CourseNodeB,[CourseNodeA,CourseNodeC]),(CourseNodeC,[CourseNodeB])],'file:///dev/null')
+        _install_course_module('xchk_test_course',course)
+        courses.registry.invalidate()
+        self.addCleanup(courses.registry.invalidate)
+        self.assertEqual(dict(courses.registry.prerequisites('testcursus')),
+                         {'course_node_a': frozenset(),
+                          'course_node_b': frozenset({'course_node_a','course_node_c'}),
+                          'course_node_c': frozenset({'course_node_b'})})
+
+    def test_invalidate_drops_replaced_contentviews(self):
+        old_view = type('ReloadedContentView',(ContentView,),{'uid': 'reloaded_node','__module__': __name__})
+        self.assertIs(get_contentview('reloaded_node'),old_view)
+        # what reloading the module of the view leaves behind
+        new_view = type('ReloadedContentView',(ContentView,),{'uid': 'reloaded_node','__module__': __name__})
+        try:
+            courses.registry.invalidate()
+            self.assertIs(get_contentview('reloaded_node'),new_view)
+        finally:
+            del old_view, new_view
+            gc.collect()
+            invalidate_contentview_registry()
+
+@patch('xchk_core.overviews.course_url_map',lambda graph: {uid: f'/{uid}' for uid in graph.vs["label"]})
+class CourseOverviewTest(TestCase):
+
+    def setUp(self):
+        self.course = courses.Course('overzichtcursus','cursus voor tests',[(CourseNodeB,[CourseNodeA])],'file:///dev/null')
+        _install_course_module('xchk_overview_course',self.course)
+        self.settings_override = override_settings(XCHK_SOURCE_COURSES={'overzichtcursus': 'xchk_overview_course'})
+        self.settings_override.enable()
+        overviews._svgs.clear()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        del sys.modules['xchk_overview_course.course']
+
+    @patch('xchk_core.overviews.render_overview',return_value='<svg/>')
+    def test_rendered_once(self,render_mock):
+        (key1,svg1) = overviews.course_overview('overzichtcursus')
+        (key2,svg2) = overviews.course_overview('overzichtcursus')
+        overviews._svgs.clear()
+        (key3,svg3) = overviews.course_overview('overzichtcursus')
+        self.assertEqual(render_mock.call_count,1)
+        self.assertEqual(key1,key2)
+        self.assertEqual(key1,key3)
+        self.assertEqual(svg3,'<svg/>')
+
+    @patch('xchk_core.overviews.render_overview',return_value='<svg/>')
+    def test_key_follows_structure(self,render_mock):
+        key1 = overviews.overview_key('overzichtcursus')
+        self.course.structure = [(CourseNodeB,[CourseNodeA]),(CourseNodeC,[CourseNodeB])]
+        courses.registry.invalidate()
+        key2 = overviews.overview_key('overzichtcursus')
+        self.assertNotEqual(key1,key2)
+        overviews.course_overview('overzichtcursus')
+        self.assertEqual(render_mock.call_count,1)
+
+class IntermediateContentView(ContentView):
+    pass
+
+class IndirectContentView(IntermediateContentView):
+    uid = 'indirect_node'
+
+class ContentViewRegistryTest(TestCase):
+
+    def tearDown(self):
+        invalidate_contentview_registry()
+
+    def test_direct_and_indirect_subclasses(self):
+        registry = contentview_registry()
+        self.assertIs(registry['impossible_node'],ImpossibleNodeView)
+        self.assertIs(registry['indirect_node'],IndirectContentView)
+        self.assertNotIn('aanvullen',registry)
+
+    def test_registry_is_read_only(self):
+        with self.assertRaises(TypeError):
+            contentview_registry()['nieuw'] = ContentView
+
+    def test_lookup_of_view_defined_later(self):
+        contentview_registry()
+        class LateContentView(ContentView):
+            uid = 'late_node'
+        try:
+            self.assertIs(get_contentview('late_node'),LateContentView)
+            with self.assertRaises(KeyError):
+                get_contentview('onbestaand')
+        finally:
+            del LateContentView
+            gc.collect()
+
+    def test_duplicate_uids(self):
+        class Duplicate(ContentView):
+            uid = 'indirect_node'
+        invalidate_contentview_registry()
+        try:
+            with self.assertRaises(ImproperlyConfigured):
+                contentview_registry()
+        finally:
+            del Duplicate
+            gc.collect()
+
+class SideEffectCheck(TrueCheck):
+
+    def component_checks(self):
+        return [self]
+
+class VerdictCacheTest(TestCase):
+
+    def setUp(self):
+        self.strat = Strategy(refusing_check=Negation(FileExistsCheck('a','txt')),accepting_check=FileExistsCheck('a','txt'))
+        self.analysis = [OutcomeComponent(component_number=2,outcome=True,desired_outcome=True,renderer=None,renderer_data=None)]
+
+    def tearDown(self):
+        caches['default'].clear()
+
+    def test_fingerprint_follows_definition(self):
+        same_strat = Strategy(refusing_check=Negation(FileExistsCheck('a','txt')),accepting_check=FileExistsCheck('a','txt'))
+        other_strat = Strategy(refusing_check=Negation(FileExistsCheck('a','txt')),accepting_check=FileExistsCheck('b','txt'))
+        self.assertEqual(self.strat.fingerprint(),same_strat.fingerprint())
+        self.assertNotEqual(self.strat.fingerprint(),other_strat.fingerprint())
+
+    def test_hit_and_misses(self):
+        verdicts.store_verdict('c1','ex','s1',self.strat,SubmissionState.ACCEPTED,self.analysis)
+        self.assertEqual(verdicts.get_verdict('c1','ex','s1',self.strat),(SubmissionState.ACCEPTED,self.analysis))
+        self.assertIsNone(verdicts.get_verdict('c2','ex','s1',self.strat))
+        self.assertIsNone(verdicts.get_verdict('c1','ander','s1',self.strat))
+        self.assertIsNone(verdicts.get_verdict('c1','ex','s2',self.strat))
+        other_strat = Strategy(accepting_check=FileExistsCheck('a','txt'))
+        self.assertIsNone(verdicts.get_verdict('c1','ex','s1',other_strat))
+
+    def test_undecided_verdicts_are_not_stored(self):
+        verdicts.store_verdict('c1','ex','s1',self.strat,SubmissionState.PENDING,self.analysis)
+        self.assertIsNone(verdicts.get_verdict('c1','ex','s1',self.strat))
+
+    def test_checks_with_side_effects_are_not_cached(self):
+        strat = Strategy(accepting_check=SideEffectCheck())
+        verdicts.store_verdict('c1','ex','s1',strat,SubmissionState.ACCEPTED,self.analysis)
+        self.assertIsNone(verdicts.get_verdict('c1','ex','s1',strat))
+
+    @override_settings(XCHK_VERDICT_CACHE_ALIAS=None)
+    def test_disabled(self):
+        verdicts.store_verdict('c1','ex','s1',self.strat,SubmissionState.ACCEPTED,self.analysis)
+        self.assertIsNone(verdicts.get_verdict('c1','ex','s1',self.strat))
+
+class FixedOutcomeCheck(CheckingPredicate):
+    """Leaf check with a predetermined outcome, which records that it was evaluated. An exception as outcome is raised."""
+
+    def __init__(self,outcome,delay=0,log=None):
+        super().__init__()
+        self.outcome = outcome
+        self.delay = delay
+        self.log = log if log is not None else []
+
+    def check_submission(self,submission,student_path,model_path,desired_outcome,init_check_number,parent_is_negation=False):
+        time.sleep(self.delay)
+        self.log.append(init_check_number)
+        if isinstance(self.outcome,Exception):
+            raise self.outcome
+        return OutcomeAnalysis(outcome=self.outcome,
+                               outcomes_components=[OutcomeComponent(component_number=init_check_number,outcome=self.outcome,desired_outcome=desired_outcome,renderer=None,renderer_data=None)],
+                               successor_component_number=init_check_number+1)
+
+class CheckEvaluationTest(TestCase):
+
+    def _numbers(self,analysis):
+        return [component.component_number for component in analysis.outcomes_components]
+
+    def _trees(self,parallel):
+        return [ConjunctiveCheck([FixedOutcomeCheck(True),DisjunctiveCheck([FixedOutcomeCheck(False),FixedOutcomeCheck(True)],parallel=parallel),FixedOutcomeCheck(True)],parallel=parallel),
+                ConjunctiveCheck([FixedOutcomeCheck(False),ConjunctiveCheck([FixedOutcomeCheck(True),FixedOutcomeCheck(True)]),FixedOutcomeCheck(True)],parallel=parallel),
+                DisjunctiveCheck([FixedOutcomeCheck(False),Negation(FixedOutcomeCheck(False)),FixedOutcomeCheck(True)],parallel=parallel)]
+
+    def test_numbering(self):
+        (full,short_circuited,disjunction) = [tree.check_submission(None,None,None,True,1) for tree in self._trees(False)]
+        self.assertTrue(full.outcome)
+        self.assertEqual(self._numbers(full),[1,2,3,4,5,6])
+        self.assertEqual(full.successor_component_number,7)
+        self.assertFalse(short_circuited.outcome)
+        self.assertEqual(self._numbers(short_circuited),[1,2])
+        self.assertEqual(short_circuited.successor_component_number,7)
+        self.assertTrue(disjunction.outcome)
+        self.assertEqual(self._numbers(disjunction),[1,2,3])
+        self.assertEqual(disjunction.successor_component_number,5)
+
+    def test_parallel_matches_sequential(self):
+        for (sequential,parallel) in zip(self._trees(False),self._trees(True)):
+            self.assertEqual(sequential.check_submission(None,None,None,True,1),parallel.check_submission(None,None,None,True,1))
+        for parallel in (False,True):
+            # the error of a child is irrelevant when a slower, earlier child decides
+            chk = DisjunctiveCheck([FixedOutcomeCheck(True,delay=0.1),FixedOutcomeCheck(RuntimeError('fout')),FixedOutcomeCheck(False)],parallel=parallel)
+            self.assertTrue(chk.check_submission(None,None,None,True,1).outcome)
+            chk = DisjunctiveCheck([FixedOutcomeCheck(False,delay=0.1),FixedOutcomeCheck(RuntimeError('fout')),FixedOutcomeCheck(True)],parallel=parallel)
+            with self.assertRaises(RuntimeError):
+                chk.check_submission(None,None,None,True,1)
+
+    def test_parallel_children_overlap(self):
+        chk = ConjunctiveCheck([FixedOutcomeCheck(True,delay=0.2) for _ in range(4)],parallel=True)
+        start = time.perf_counter()
+        self.assertTrue(chk.check_submission(None,None,None,True,1).outcome)
+        self.assertLess(time.perf_counter() - start,0.6)
+
+    def test_parallel_short_circuit_and_limit(self):
+        log = []
+        chk = ConjunctiveCheck([FixedOutcomeCheck(False,delay=0.1,log=log)] + [FixedOutcomeCheck(True,log=log) for _ in range(3)],parallel=True)
+        strat = Strategy(refusing_check=Negation(TrueCheck()),accepting_check=chk,max_parallel_checks=1)
+        submission = SubmissionV2(content_uid='ex')
+        (state,analysis) = strat.check_submission(submission,None,None)
+        self.assertEqual(state,SubmissionState.PENDING)
+        # the worker may already have picked up the next child, but not all of them
+        self.assertEqual(log[0],3)
+        self.assertLess(len(log),4)
+        self.assertEqual([component.component_number for component in analysis[1:]],[1,2,3])
+
+    def test_parallel_limit_by_default(self):
+        log = []
+        chk = ConjunctiveCheck([FixedOutcomeCheck(False,log=log)] + [FixedOutcomeCheck(True,delay=0.1,log=log) for _ in range(12)],parallel=True)
+        self.assertFalse(chk.check_submission(None,None,None,True,1).outcome)
+        # children that had not started when the first one failed were cancelled
+        self.assertLessEqual(len(log),DEFAULT_MAX_PARALLEL_CHECKS + 1)
+
+    def test_strategy_verdicts(self):
+        submission = SubmissionV2(content_uid='ex')
+        accepting = Strategy(refusing_check=FixedOutcomeCheck(False),accepting_check=FixedOutcomeCheck(True))
+        refusing = Strategy(refusing_check=FixedOutcomeCheck(True),accepting_check=FixedOutcomeCheck(True))
+        self.assertEqual(accepting.check_submission(submission,None,None)[0],SubmissionState.ACCEPTED)
+        self.assertEqual(accepting.check_submission(submission,None,None)[1][0].component_number,2)
+        self.assertEqual(refusing.check_submission(submission,None,None)[0],SubmissionState.NEW_REFUSED)
+
+def _random_check_tree(rng,depth):
+    if depth == 0 or rng.random() < 0.25:
+        return FixedOutcomeCheck(rng.random() < 0.5)
+    kind = rng.choice(['negation','conjunction','disjunction'])
+    if kind == 'negation':
+        return Negation(_random_check_tree(rng,depth-1))
+    children = [_random_check_tree(rng,depth-1) for _ in range(rng.randint(0,4))]
+    return ConjunctiveCheck(children) if kind == 'conjunction' else DisjunctiveCheck(children)
+
+class EvaluationPlanTest(TestCase):
+
+    def test_plan_matches_recursive_evaluation(self):
+        rng = random.Random(42)
+        for _ in range(200):
+            tree = _random_check_tree(rng,4)
+            for desired_outcome in (True,False):
+                self.assertEqual(EvaluationPlan(tree,desired_outcome,3).check_submission(None,None,None),
+                                 tree.check_submission(None,None,None,desired_outcome,3))
+
+    def test_empty_composites(self):
+        for tree in (ConjunctiveCheck([]),DisjunctiveCheck([]),Negation(DisjunctiveCheck([])),
+                     ConjunctiveCheck([ConjunctiveCheck([]),TrueCheck()]),DisjunctiveCheck([DisjunctiveCheck([]),ConjunctiveCheck([])])):
+            for desired_outcome in (True,False):
+                self.assertEqual(EvaluationPlan(tree,desired_outcome,1).check_submission(None,None,None),
+                                 tree.check_submission(None,None,None,desired_outcome,1))
+        analysis = EvaluationPlan(ConjunctiveCheck([ConjunctiveCheck([]),TrueCheck()]),True,1).check_submission(None,None,None)
+        self.assertEqual([component.component_number for component in analysis.outcomes_components],[1,2,3])
+
+    def test_short_circuited_subtree_is_skipped(self):
+        log = []
+        tree = DisjunctiveCheck([FixedOutcomeCheck(True,log=log),ConjunctiveCheck([FixedOutcomeCheck(True,log=log)]),FixedOutcomeCheck(True,log=log)])
+        analysis = EvaluationPlan(tree,True,1).check_submission(None,None,None)
+        self.assertEqual(log,[2])
+        self.assertEqual(analysis.successor_component_number,6)
+
+    def test_plans_are_compiled_once(self):
+        strat = Strategy(refusing_check=FixedOutcomeCheck(False),accepting_check=ConjunctiveCheck([FixedOutcomeCheck(True),FixedOutcomeCheck(True)]))
+        self.assertIs(strat.compiled(),strat.compiled())
+        self.assertEqual(strat.compiled()[1].steps[0].component_number,2)
+
+class InstructionsCacheTest(TestCase):
+
+    def test_instructions_computed_once(self):
+        chk = ConjunctiveCheck([TrueCheck(),FileExistsCheck(extension='txt')])
+        self.assertIs(chk.instructions('ex'),chk.instructions('ex'))
+        self.assertIsNot(chk.instructions('ex'),chk.instructions('ander'))
+        self.assertEqual(chk.instructions('ander'),[ALL_OF_TEXT,["True"],["Je hebt een bestand met naam ander.txt"]])
+
+    def test_cache_does_not_affect_equality(self):
+        chk1 = FileExistsCheck('myfile','txt')
+        chk2 = FileExistsCheck('myfile','txt')
+        chk1.instructions('ex')
+        self.assertEqual(chk1,chk2)
+
+    def test_rendered_html_is_reused(self):
+        strat = Strategy(refusing_check=Negation(TrueCheck()),accepting_check=TrueCheck())
+        instructions = strat.instructions('ex')
+        self.assertIs(instructions,strat.instructions('ex'))
+        self.assertIs(node_instructions_2_ul(instructions),node_instructions_2_ul(strat.instructions('ex')))
+
+class GitOpsTest(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.origin = os.path.join(self.tmp,'origin')
+        _make_local_repo(self.origin,{'map/oefening.txt':'inhoud'})
+        self.commit = subprocess.run(['git','rev-parse','HEAD'],cwd=self.origin,capture_output=True).stdout.decode('utf-8').strip()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp,ignore_errors=True)
+
+    def test_read_head_of_checkout(self):
+        self.assertEqual(gitops.read_head(self.origin),self.commit)
+
+    def test_read_head_of_mirror_and_worktree(self):
+        mirror = os.path.join(self.tmp,'mirror.git')
+        gitops.run_git('clone','--mirror','--quiet',f'file://{self.origin}',mirror)
+        self.assertEqual(gitops.read_head(mirror),self.commit)
+        worktree = os.path.join(self.tmp,'worktree')
+        gitops.run_git('worktree','add','--detach','--quiet',worktree,'HEAD',cwd=mirror)
+        self.assertEqual(gitops.read_head(worktree),self.commit)
+
+    def test_not_a_repository(self):
+        with self.assertRaises(gitops.GitError):
+            gitops.read_head(self.tmp)
+
+    def test_filesystem_operations(self):
+        gitops.make_world_writable(self.origin)
+        self.assertEqual(os.stat(os.path.join(self.origin,'map','oefening.txt')).st_mode & 0o777,0o777)
+        os.chmod(os.path.join(self.origin,'map'),0o500)
+        gitops.remove_tree(self.origin)
+        self.assertFalse(os.path.exists(self.origin))
+
+    def test_clone_modes(self):
+        for mode in (gitops.CLONE_MODE_FULL,gitops.CLONE_MODE_PARTIAL,gitops.CLONE_MODE_SHALLOW):
+            cache = RepoCache(root=os.path.join(self.tmp,f'cache-{mode}'),clone_mode=mode)
+            with cache.worktree(f'file://{self.origin}',os.path.join(self.tmp,f'checkout-{mode}')) as commit:
+                self.assertEqual(commit,self.commit)
+                self.assertTrue(os.path.exists(os.path.join(self.tmp,f'checkout-{mode}','map','oefening.txt')))
+            self.assertEqual(cache.head(f'file://{self.origin}'),self.commit)
+
+class RateLimitTest(TestCase):
+
+    def setUp(self):
+        from django.contrib.auth.models import User
+        caches['default'].clear()
+        self.student = User.objects.create(username='student')
+        self.other_student = User.objects.create(username='andere_student')
+        self.admin = User.objects.create(username='admin',is_superuser=True)
+
+    def test_token_bucket_refills(self):
+        bucket = ratelimit.TokenBucket(2,10)
+        (allowed,state) = bucket.take(None,0)
+        self.assertTrue(allowed)
+        (allowed,state) = bucket.take(state,0)
+        self.assertTrue(allowed)
+        (allowed,state) = bucket.take(state,1)
+        self.assertFalse(allowed)
+        (allowed,state) = bucket.take(state,5)
+        self.assertTrue(allowed)
+
+    def test_per_user_budget(self):
+        limiter = ratelimit.CacheRateLimiter(per_user=(1,15))
+        self.assertIsNone(limiter.check(self.student,now=100))
+        self.assertEqual(limiter.check(self.student,now=110),"je mag maar één keer per 15 seconden checken")
+        self.assertIsNone(limiter.check(self.other_student,now=110))
+        self.assertIsNone(limiter.check(self.student,now=116))
+        for _ in range(3):
+            self.assertIsNone(limiter.check(self.admin,now=116))
+
+    def test_concurrent_requests_of_a_user(self):
+        limiter = ratelimit.CacheRateLimiter(per_user=(1,15))
+        cache = caches['default']
+        real_get_many = cache.get_many
+        concurrent = []
+        def get_many_with_concurrent_request(keys,*args,**kwargs):
+            if not concurrent:
+                # a second tab checks while the first request is being counted
+                concurrent.append(None)
+                concurrent[0] = limiter.check(self.student,now=100)
+            return real_get_many(keys,*args,**kwargs)
+        with patch.object(cache,'get_many',get_many_with_concurrent_request):
+            self.assertIsNone(limiter.check(self.student,now=100))
+        self.assertEqual(concurrent,[limiter.user_limit_message])
+        # the lock is released afterwards
+        self.assertIsNone(limiter.check(self.student,now=116))
+
+    def test_message_follows_budget(self):
+        limiter = ratelimit.CacheRateLimiter(per_user=(3,60))
+        for _ in range(3):
+            self.assertIsNone(limiter.check(self.student,now=100))
+        self.assertEqual(limiter.check(self.student,now=101),"je mag maar 3 keer per 60 seconden checken")
+
+    def test_global_budget(self):
+        limiter = ratelimit.CacheRateLimiter(per_user=(1,15),global_budget=(1,60))
+        self.assertIsNone(limiter.check(self.student,now=100))
+        self.assertEqual(limiter.check(self.other_student,now=101),ratelimit.GLOBAL_LIMIT_MESSAGE)
+        # a request refused by the global budget does not use the budget of the user
+        self.assertIsNone(limiter.check(self.other_student,now=161))
+
+    def test_database_limiter(self):
+        # only the period of the budget is used
+        limiter = ratelimit.DatabaseRateLimiter(per_user=(3,60))
+        self.assertIsNone(limiter.check(self.student))
+        repo = Repo.objects.create(url='file:///dev/null',user=self.student,course='testcursus')
+        SubmissionV2.objects.create(timestamp=datetime.datetime.now(),repo=repo,submitter=self.student,content_uid='oefening')
+        self.assertEqual(limiter.check(self.student),"je mag maar één keer per 60 seconden checken")
+        self.assertIsNone(limiter.check(self.other_student))
+
+    @override_settings(XCHK_RATE_LIMITER='xchk_core.ratelimit.NoRateLimiter')
+    def test_configured_limiter(self):
+        self.assertIsInstance(ratelimit.get_rate_limiter(),ratelimit.NoRateLimiter)
+
+class CompletedContentTest(TestCase):
+
+    def setUp(self):
+        from django.contrib.auth.models import User
+        course = courses.Course('voltooiingscursus','cursus voor tests',[(CourseNodeB,[CourseNodeA]),(CourseNodeC,[CourseNodeA,CourseNodeB])],'file:///dev/null')
+        _install_course_module('xchk_completion_course',course)
+        self.settings_override = override_settings(XCHK_SOURCE_COURSES={'voltooiingscursus': 'xchk_completion_course'})
+        self.settings_override.enable()
+        self.student = User.objects.create(username='student')
+        self.repo = Repo.objects.create(url='file:///dev/null',user=self.student,course='voltooiingscursus')
+
+    def tearDown(self):
+        self.settings_override.disable()
+        del sys.modules['xchk_completion_course.course']
+
+    def _submit(self,content_uid,state):
+        return SubmissionV2.objects.create(timestamp=datetime.datetime.now(),repo=self.repo,submitter=self.student,content_uid=content_uid,state=state)
+
+    def test_saved_submissions_update_completion(self):
+        submission = self._submit('course_node_a',SubmissionState.PENDING)
+        self.assertFalse(CourseNodeA.completed_by(self.student))
+        submission.state = SubmissionState.ACCEPTED
+        submission.save()
+        self.assertTrue(CourseNodeA.completed_by(self.student))
+        other_submission = self._submit('course_node_a',SubmissionState.ACCEPTED)
+        submission.state = SubmissionState.REFUSED
+        submission.save()
+        self.assertTrue(CourseNodeA.completed_by(self.student))
+        other_submission.delete()
+        self.assertFalse(CourseNodeA.completed_by(self.student))
+
+    def test_bulk_updated_submissions(self):
+        submissions = [self._submit(uid,SubmissionState.PENDING) for uid in ('course_node_a','course_node_b')]
+        submissions[0].state = SubmissionState.ACCEPTED
+        submissions[1].state = SubmissionState.NEW_REFUSED
+        SubmissionV2.objects.bulk_update(submissions,['state'])
+        record_completions(submissions)
+        record_completions(submissions)
+        self.assertEqual(list(CompletedContent.objects.values_list('content_uid',flat=True)),['course_node_a'])
+
+    def test_accessibility_needs_all_predecessors(self):
+        self.assertTrue(CourseNodeA.is_accessible_by_in(self.student,'voltooiingscursus'))
+        self.assertFalse(CourseNodeC.is_accessible_by_in(self.student,'voltooiingscursus'))
+        self._submit('course_node_a',SubmissionState.ACCEPTED)
+        self.assertTrue(CourseNodeB.is_accessible_by_in(self.student,'voltooiingscursus'))
+        self.assertFalse(CourseNodeC.is_accessible_by_in(self.student,'voltooiingscursus'))
+        self._submit('course_node_b',SubmissionState.ACCEPTED)
+        with self.assertNumQueries(1):
+            self.assertTrue(CourseNodeC.is_accessible_by_in(self.student,'voltooiingscursus'))
+
+    def test_accessibility_of_whole_course(self):
+        self._submit('course_node_a',SubmissionState.ACCEPTED)
+        with self.assertNumQueries(1):
+            accessibility = courses.accessibility(self.student,'voltooiingscursus')
+        self.assertEqual(accessibility.completed,{'course_node_a'})
+        self.assertEqual(accessibility.accessible,{'course_node_a','course_node_b'})
+        with self.assertNumQueries(1):
+            self.assertEqual(courses.accessibility_by_course(self.student),{'voltooiingscursus': accessibility})
+        with self.assertNumQueries(1):
+            self.assertTrue(CourseNodeB.is_accessible_by(self.student))
+
+    def test_prerequisites(self):
+        prerequisites = courses.registry.prerequisites('voltooiingscursus')
+        self.assertEqual(sorted(uid for (uid,_) in prerequisites),['course_node_a','course_node_b','course_node_c'])
+        self.assertEqual(dict(prerequisites)['course_node_c'],{'course_node_a','course_node_b'})
+
+try:
+    import celery
+except ImportError:
+    celery = None
+
+def _import_tasks():
+    """Imports `xchk_core.tasks`, which needs the `config` module of a host project for its Celery app.
+
+    Without a project, an app with an in-memory broker takes its place."""
+    try:
+        import config
+    except ImportError:
+        config = types.ModuleType('config')
+        config.celery_app = celery.Celery('xchk_test',broker='memory://',backend='cache+memory://',set_as_current=False)
+        sys.modules['config'] = config
+    from xchk_core import tasks
+    return tasks
+
+@unittest.skipUnless(celery,'celery is niet geïnstalleerd')
+class QueueRoutingTest(TestCase):
+
+    def setUp(self):
+        course = courses.Course('wachtrijcursus','cursus voor tests',[(CourseNodeB,[CourseNodeA])],'file:///dev/null')
+        _install_course_module('xchk_queue_course',course)
+        self.settings_override = override_settings(XCHK_SOURCE_COURSES={'wachtrijcursus': 'xchk_queue_course'})
+        self.settings_override.enable()
+        self.app = celery.Celery('xchk_queue_test',broker='memory://',set_as_current=False)
+        self.app.conf.task_routes = ('xchk_core.queues.route_task',)
+        # same names as the real tasks, which cannot be imported without a project
+        def placeholder(*args,**kwargs):
+            pass
+        self.tasks = {name: self.app.task(name=name)(placeholder) for name in (queues.CHECK_TASK,queues.FILES_TASK) + queues.NOTIFY_TASKS}
+
+    def tearDown(self):
+        self.settings_override.disable()
+        del sys.modules['xchk_queue_course.course']
+
+    def _queue(self,name,args=(),kwargs=None):
+        return self.app.amqp.router.route({},name,args,kwargs or {})['queue'].name
+
+    def test_single_check_queue_by_default(self):
+        self.assertEqual(self._queue(queues.CHECK_TASK,(0,1,[1]),{'course': 'wachtrijcursus'}),'xchk-checks')
+        self.assertEqual(queues.check_queues(),['xchk-checks'])
+
+    @override_settings(XCHK_CHECK_QUEUE_ROUTING='course')
+    def test_queue_per_course(self):
+        self.assertEqual(self._queue(queues.CHECK_TASK,(0,1,[1]),{'course': 'wachtrijcursus'}),'xchk-checks-wachtrijcursus')
+        self.assertEqual(self._queue(queues.CHECK_TASK,(0,1,[1])),'xchk-checks')
+        self.assertEqual(queues.check_queues(),['xchk-checks-wachtrijcursus','xchk-checks'])
+
+    @override_settings(XCHK_CHECK_QUEUE_ROUTING='batchtype')
+    def test_queue_per_batchtype(self):
+        self.assertEqual(self._queue(queues.CHECK_TASK,(1,1,[1]),{'course': 'wachtrijcursus'}),'xchk-checks-batchtype1')
+        self.assertEqual(len(queues.check_queues()),len(batch_types) + 1)
+
+    @override_settings(XCHK_CHECK_QUEUE_ROUTING='batchtype')
+    def test_speculative_parts_follow_their_batch(self):
+        for name in queues.SPECULATIVE_TASKS:
+            self.assertEqual(queues.route_task(name,([],1),{'batchtype_id': 1,'course': 'wachtrijcursus'},{}),{'queue': 'xchk-checks-batchtype1'})
+
+    def test_fast_lanes(self):
+        self.assertEqual(self._queue(queues.FILES_TASK,(1,)),'xchk-files')
+        for name in queues.NOTIFY_TASKS:
+            self.assertEqual(self._queue(name),'xchk-notify')
+        self.assertEqual(set(queues.fast_queues()),{'xchk-files','xchk-notify'})
+        self.assertIsNone(queues.route_task('andere.taak',(),{},{}))
+
+    @override_settings(XCHK_CHECK_QUEUE_ROUTING='course')
+    def test_messages_arrive_in_routed_queue(self):
+        self.tasks[queues.CHECK_TASK].apply_async(args=[0,1,[1]],kwargs={'course': 'wachtrijcursus'})
+        self.tasks[queues.NOTIFY_TASKS[0]].apply_async(args=[('oefening',[]),'user1'])
+        with self.app.connection_for_read() as connection:
+            for (queue_name,task_name) in (('xchk-checks-wachtrijcursus',queues.CHECK_TASK),('xchk-notify',queues.NOTIFY_TASKS[0])):
+                simple_queue = connection.SimpleQueue(queue_name)
+                message = simple_queue.get(timeout=1)
+                self.assertEqual(message.headers['task'],task_name)
+                message.ack()
+                simple_queue.close()
+
+@override_settings(XCHK_COALESCE_CACHE_ALIAS='default')
+class CoalesceTest(TestCase):
+
+    def setUp(self):
+        caches['default'].clear()
+        self.key = coalesce.request_key(1,['oefening1','oefening2'],0)
+
+    def test_request_key(self):
+        self.assertEqual(self.key,coalesce.request_key(1,['oefening1','oefening2'],0))
+        self.assertNotEqual(self.key,coalesce.request_key(1,['oefening2','oefening1'],0))
+        self.assertNotEqual(self.key,coalesce.request_key(1,['oefening1','oefening2'],1))
+
+    @override_settings(XCHK_COALESCE_TIMEOUT=3600)
+    def test_queued_batch_expires_with_its_task(self):
+        cache = caches['default']
+        with patch.object(cache,'add',wraps=cache.add) as add_mock:
+            coalesce.join(self.key,'user1',[1,2])
+        self.assertEqual(add_mock.call_args_list[0][0][2],coalesce.BATCH_EXPIRES)
+
+    @override_settings(XCHK_COALESCE_CACHE_ALIAS=None)
+    def test_disabled_by_default(self):
+        self.assertFalse(coalesce.enabled())
+
+    def test_identical_requests_subscribe(self):
+        (attached,token) = coalesce.join(self.key,'user1',[1,2])
+        self.assertFalse(attached)
+        self.assertIsNotNone(token)
+        self.assertEqual(coalesce.join(self.key,'user2',[3,4]),(True,None))
+        coalesce.mark_running(token)
+        self.assertEqual(coalesce.join(self.key,'user3',[5,6]),(True,None))
+        self.assertEqual(coalesce.finish(token),[{'group_name': 'user2','submission_ids': [3,4],'verify_head': False},
+                                                 {'group_name': 'user3','submission_ids': [5,6],'verify_head': True}])
+        # the next request starts a new batch
+        (attached,new_token) = coalesce.join(self.key,'user2',[7,8])
+        self.assertFalse(attached)
+        self.assertNotEqual(new_token,token)
+        self.assertEqual(coalesce.finish(new_token),[])
+
+    def test_subscriber_missed_by_finished_batch_starts_its_own(self):
+        (_,token) = coalesce.join(self.key,'user1',[1,2])
+        cache = caches['default']
+        real_incr = cache.incr
+        def finish_then_incr(key,*args,**kwargs):
+            # the batch finishes after the subscriber saw it, but before it took a slot
+            self.assertEqual(coalesce.finish(token),[])
+            return real_incr(key,*args,**kwargs)
+        with patch.object(cache,'incr',side_effect=finish_then_incr):
+            (attached,own_token) = coalesce.join(self.key,'user2',[3,4])
+        self.assertFalse(attached)
+        self.assertIsNotNone(own_token)
+        self.assertNotEqual(own_token,token)
+
+class FileIndexTest(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.origin = os.path.join(self.tmp,'origin')
+        _make_local_repo(self.origin,{'oefening.txt':'inhoud','map/script.sh':'echo','map/sub/les.py':'pass'})
+        self.cache = RepoCache(root=os.path.join(self.tmp,'cache'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp,ignore_errors=True)
+
+    def test_scan_and_git_tree_agree(self):
+        expected = {'oefening.txt','map','map/script.sh','map/sub','map/sub/les.py'}
+        self.assertEqual(fileindex.FileIndex.scan(self.origin).paths,expected)
+        self.assertEqual(fileindex.FileIndex.from_git_tree(self.origin).paths,expected)
+
+    def test_lookups(self):
+        index = fileindex.FileIndex.scan(self.origin)
+        self.assertTrue(index.exists('map/script.sh'))
+        self.assertTrue(index.exists('./map/../oefening.txt'))
+        self.assertTrue(index.exists('map'))
+        self.assertFalse(index.exists('script.sh'))
+        self.assertFalse(index.covers('../origin/oefening.txt'))
+        self.assertEqual(index.glob('map/*.sh'),['map/script.sh'])
+        self.assertEqual(index.with_extension('py'),['map/sub/les.py'])
+
+    def test_workspace_registers_index(self):
+        with Workspace() as ws:
+            ws.checkout(self.cache,f'file://{self.origin}',ws.student_dir)
+            ws.index_files(ws.student_dir)
+            self.assertTrue(fileindex.lookup(ws.student_dir).exists('map/sub/les.py'))
+            self.assertFalse(fileindex.lookup(ws.student_dir).exists('.git'))
+            # the index answers, not the disk
+            os.remove(os.path.join(ws.student_dir,'oefening.txt'))
+            submission = Mock(content_uid='oefening')
+            analysis = FileExistsCheck(extension='txt').check_submission(submission,ws.student_dir,ws.model_dir,True,1)
+            self.assertTrue(analysis.outcome)
+            fileindex.invalidate(ws.student_dir)
+            analysis = FileExistsCheck(extension='txt').check_submission(submission,ws.student_dir,ws.model_dir,True,1)
+            self.assertFalse(analysis.outcome)
+        self.assertIsNone(fileindex.lookup(ws.student_dir))
+
+    def test_sparse_checkout_is_scanned(self):
+        with Workspace() as ws:
+            ws.checkout(self.cache,f'file://{self.origin}',ws.student_dir,sparse_paths={'oefening.txt'})
+            index = ws.index_files(ws.student_dir,from_git_tree=False)
+            self.assertEqual(index.paths,{'oefening.txt'})
+
+_measurements = []
+
+def _record_measurement(name,seconds,labels):
+    _measurements.append((name,labels))
+
+class MetricsTest(TestCase):
+
+    def setUp(self):
+        _measurements.clear()
+
+    def test_nothing_is_recorded_by_default(self):
+        with metrics.recording() as recorder:
+            self.assertIsNone(recorder)
+            self.assertIsNone(metrics.current_recorder())
+
+    def test_checks_and_exercises_are_timed(self):
+        strat = Strategy(refusing_check=FixedOutcomeCheck(False),accepting_check=ConjunctiveCheck([FixedOutcomeCheck(True),FixedOutcomeCheck(True,delay=0.05)]))
+        with override_settings(XCHK_METRICS=True,XCHK_METRICS_HOOKS=[f'{__name__}._record_measurement']):
+            with metrics.recording() as recorder:
+                recorder.record_batch('queue_wait',1.5)
+                with recorder.exercise('ex'):
+                    (state,_) = strat.check_submission(SubmissionV2(content_uid='ex'),None,None)
+            self.assertIsNone(metrics.current_recorder())
+        self.assertEqual(state,SubmissionState.ACCEPTED)
+        timings = json.loads(recorder.for_submission('ex'))
+        self.assertEqual([(check['check'],check['component']) for check in timings['checks']],
+                         [('FixedOutcomeCheck',1),('FixedOutcomeCheck',3),('FixedOutcomeCheck',4)])
+        self.assertGreaterEqual(timings['checks'][2]['wall'],0.05)
+        self.assertGreaterEqual(timings['exercise']['wall'],timings['checks'][2]['wall'])
+        self.assertEqual(timings['batch'],{'queue_wait': {'wall': 1.5}})
+        self.assertIn(('xchk_exercise_wall_seconds',{'exercise': 'ex'}),_measurements)
+        self.assertIn(('xchk_queue_wait_seconds',{}),_measurements)
+        self.assertEqual(_measurements.count(('xchk_check_cpu_seconds',{'exercise': 'ex','check': 'FixedOutcomeCheck'})),3)
+
+    def test_cpu_time_of_subprocesses_and_threads(self):
+        busy = 'import time\nend = time.process_time() + 0.2\nwhile time.process_time() < end: pass'
+        def spin():
+            end = time.process_time() + 0.2
+            while time.process_time() < end:
+                pass
+        recorder = metrics.TimingRecorder()
+        with recorder.check('ex',TrueCheck(),1):
+            subprocess.run([sys.executable,'-c',busy],check=True)
+        with recorder.check('ex',TrueCheck(),2):
+            thread = threading.Thread(target=spin)
+            thread.start()
+            thread.join()
+        (in_subprocess,in_thread) = recorder.exercises['ex']['checks']
+        self.assertGreaterEqual(in_subprocess['cpu'],0.15)
+        self.assertGreaterEqual(in_thread['cpu'],0.15)
+
+    def test_local_exporter(self):
+        exporter = metrics.LocalExporter()
+        exporter('xchk_check_wall_seconds',0.25,{'exercise': 'ex"1','check': 'TrueCheck'})
+        exporter('xchk_check_wall_seconds',0.5,{'exercise': 'ex"1','check': 'TrueCheck'})
+        exporter('xchk_checkout_wall_seconds',2.0,{})
+        self.assertEqual(exporter.prometheus_text(),
+                         '# TYPE xchk_check_wall_seconds summary\n'
+                         'xchk_check_wall_seconds_count{check="TrueCheck",exercise="ex\\"1"} 2\n'
+                         'xchk_check_wall_seconds_sum{check="TrueCheck",exercise="ex\\"1"} 0.75\n'
+                         '# TYPE xchk_checkout_wall_seconds summary\n'
+                         'xchk_checkout_wall_seconds_count 1\n'
+                         'xchk_checkout_wall_seconds_sum 2.0\n')
+        tmp = tempfile.mkdtemp()
+        try:
+            exporter.write_textfile(tmp)
+            self.assertEqual(os.listdir(tmp),[f'xchk-{os.getpid()}.prom'])
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_statsd_line(self):
+        self.assertEqual(metrics.statsd_line('xchk_check_wall_seconds',0.0125,{'exercise': 'ex','check': 'TrueCheck'}),
+                         'xchk_check_wall_seconds:12.500|ms|#check:TrueCheck,exercise:ex')
+        self.assertEqual(metrics.statsd_line('xchk_checkout_wall_seconds',1,{}),'xchk_checkout_wall_seconds:1000.000|ms')
+
+@unittest.skipUnless(celery,'celery is niet geïnstalleerd')
+class BulkSubmissionWritesTest(TestCase):
+
+    def setUp(self):
+        from django.contrib.auth.models import User
+        self.tasks = _import_tasks()
+        from xchk_core import consumers
+        self.consumers = consumers
+        self.student = User.objects.create(username='student')
+        self.repo = Repo.objects.create(url='file:///dev/null',user=self.student,course='testcursus')
+
+    def _new_submissions(self,count):
+        return [SubmissionV2(timestamp=datetime.datetime.now(),repo=self.repo,submitter=self.student,content_uid=f'oefening{idx}') for idx in range(count)]
+
+    def test_intake_in_one_insert(self):
+        submissions = self._new_submissions(15)
+        def bulk_create(objs):
+            for (idx,obj) in enumerate(objs,start=1000):
+                obj.id = idx
+            return objs
+        with patch.object(connection.features,'can_return_ids_from_bulk_insert',True,create=True),\
+             patch.object(SubmissionV2.objects,'bulk_create',side_effect=bulk_create) as bulk_create_mock:
+            # only the savepoint of the transaction
+            with self.assertNumQueries(2):
+                created = self.consumers._create_submissions(submissions)
+        bulk_create_mock.assert_called_once_with(submissions)
+        self.assertEqual([submission.id for submission in created],list(range(1000,1015)))
+
+    def test_intake_without_returned_keys(self):
+        submissions = self._new_submissions(15)
+        with patch.object(connection.features,'can_return_ids_from_bulk_insert',False,create=True),\
+             patch.object(connection.features,'can_return_rows_from_bulk_insert',False,create=True):
+            # one insert per submission, inside a single transaction
+            with self.assertNumQueries(15 + 2):
+                created = self.consumers._create_submissions(submissions)
+        self.assertTrue(all(submission.id is not None for submission in created))
+        self.assertEqual(SubmissionV2.objects.filter(repo=self.repo).count(),15)
+
+    def test_writeback_in_constant_queries(self):
+        for count in (3,15):
+            submissions = self._saved_submissions(count)
+            for submission in submissions:
+                submission.state = SubmissionState.ACCEPTED
+                submission.checksum = 'abc'
+            submissions[-1].state = SubmissionState.NEW_REFUSED
+            # savepoint, update of all submissions, insert of the completions, release
+            with self.assertNumQueries(4):
+                result = self.tasks._store_batch(submissions,submissions[-1],['analyse'])
+            self.assertEqual(result,(submissions[-1].content_uid,['analyse']))
+            states = dict(SubmissionV2.objects.filter(id__in=[submission.id for submission in submissions]).values_list('content_uid','state'))
+            self.assertEqual(states[submissions[0].content_uid],SubmissionState.ACCEPTED)
+            self.assertEqual(states[submissions[-1].content_uid],SubmissionState.NEW_REFUSED)
+
+    def _saved_submissions(self,count):
+        submissions = self._new_submissions(count)
+        for submission in submissions:
+            submission.save()
+        return submissions
+
+class ProgressAcceptedView(ContentView):
+    uid = 'progress_accepted'
+    strat = Strategy(accepting_check=TrueCheck())
+
+class ProgressSideEffectView(ContentView):
+    uid = 'progress_side_effect'
+    strat = Strategy(accepting_check=SideEffectCheck())
+
+@unittest.skipUnless(celery,'celery is niet geïnstalleerd')
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class ProgressTest(TestCase):
+
+    def setUp(self):
+        from django.contrib.auth.models import User
+        self.tasks = _import_tasks()
+        caches['default'].clear()
+        self.student = User.objects.create(username='student')
+        self.repo = Repo.objects.create(url='file:///dev/null',user=self.student,course='testcursus')
+
+    def _receive_all(self,channel_layer,channel,count):
+        return [async_to_sync(channel_layer.receive)(channel) for _ in range(count)]
+
+    def test_every_decided_submission_is_reported(self):
+        from channels.layers import get_channel_layer
+        channel_layer = get_channel_layer()
+        channel = async_to_sync(channel_layer.new_channel)()
+        async_to_sync(channel_layer.group_add)('voortgang',channel)
+        submissions = [SubmissionV2.objects.create(timestamp=datetime.datetime.now(),repo=self.repo,submitter=self.student,content_uid=uid)
+                       for uid in ('progress_accepted','progress_side_effect','progress_accepted')]
+        # the default batch type allows no checks with side effects
+        self.tasks._check_submissions_in_commit(submissions,'abc',0,Mock(),'def',progress_group='voortgang')
+        events = self._receive_all(channel_layer,channel,3)
+        self.assertEqual([(event['type'],event['content_uid'],event['state']) for event in events],
+                         [('progress','progress_accepted',int(SubmissionState.ACCEPTED)),
+                          ('progress','progress_side_effect',int(SubmissionState.NOT_REACHED)),
+                          ('progress','progress_accepted',int(SubmissionState.NOT_REACHED))])
+        self.assertEqual(events[1]['analysis'][0][4],"Minstens één uit te voeren controle is niet toegelaten door het batchtype.")
+        self.assertEqual(events[2]['analysis'],[])
+        self.assertEqual([submission.state for submission in SubmissionV2.objects.order_by('id')],
+                         [SubmissionState.ACCEPTED,SubmissionState.NOT_REACHED,SubmissionState.NOT_REACHED])
+
+    def test_nothing_is_checked_after_a_failed_preparation(self):
+        submissions = [SubmissionV2.objects.create(timestamp=datetime.datetime.now(),repo=self.repo,submitter=self.student,content_uid='progress_accepted') for _ in range(2)]
+        with Workspace() as workspace,patch.object(verdicts,'store_verdict') as store_verdict_mock:
+            workspace.defer(Mock(side_effect=RepoCacheError('checkout mislukt')))
+            self.tasks._check_submissions_in_commit(submissions,'abc',0,workspace,'def')
+        store_verdict_mock.assert_not_called()
+        self.assertEqual([submission.state for submission in SubmissionV2.objects.order_by('id')],[SubmissionState.NOT_REACHED] * 2)
+
+    def test_consumers_forward_progress(self):
+        from channels.layers import get_channel_layer
+        from channels.testing import WebsocketCommunicator
+        from xchk_core import consumers
+
+        async def forwarded(consumer_class):
+            communicator = WebsocketCommunicator(lambda scope: consumer_class(dict(scope,user=self.student)),'/ws/sock/')
+            (connected,_) = await communicator.connect()
+            self.assertTrue(connected)
+            await get_channel_layer().group_send(f'user{self.student.id}',{'type': 'progress','content_uid': 'oefening','state': 0,'analysis': []})
+            message = await communicator.receive_json_from(timeout=5)
+            await communicator.disconnect()
+            return message
+
+        for consumer_class in (consumers.CheckRequestConsumer,consumers.AsyncCheckRequestConsumer):
+            self.assertEqual(async_to_sync(forwarded)(consumer_class),{'progress': {'content_uid': 'oefening','state': 0,'analysis': []}})
+
+class SubmittedFilesView(ContentView):
+    uid = 'submitted_files'
+    strat = Strategy(accepting_check=FileExistsCheck('oefening','txt'))
+
+@unittest.skipUnless(celery,'celery is niet geïnstalleerd')
+class SubmittedFilesTest(TestCase):
+
+    def setUp(self):
+        from django.contrib.auth.models import User
+        self.tasks = _import_tasks()
+        self.tmp = tempfile.mkdtemp()
+        self.origin = os.path.join(self.tmp,'origin')
+        _make_local_repo(self.origin,{'oefening.txt':'eerste versie'})
+        # pushes are made right after fetching here
+        self.cache = RepoCache(root=os.path.join(self.tmp,'cache'),fetch_interval=0)
+        self.student = User.objects.create(username='student')
+        self.repo = Repo.objects.create(url=f'file://{self.origin}',user=self.student,course='testcursus')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp,ignore_errors=True)
+
+    def _retrieve(self,content_uid):
+        submission = SubmissionV2.objects.create(timestamp=datetime.datetime.now(),repo=self.repo,submitter=self.student,content_uid=content_uid)
+        with patch('xchk_core.repocache.get_repo_cache',return_value=self.cache):
+            return self.tasks.retrieve_submitted_files(submission.id)
+
+    def test_unchecked_submission_shows_latest_push(self):
+        self.cache.mirror(self.repo.url)
+        _commit_files(self.origin,{'oefening.txt':'tweede versie'})
+        self.assertEqual(self._retrieve('submitted_files'),[('oefening.txt','codelines',['tweede versie'])])
+
+    def test_unknown_exercise(self):
+        self.assertIsInstance(self._retrieve('bestaat_niet'),str)
+
+@override_settings(XCHK_COALESCE_CACHE_ALIAS='default',CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class EagerTasksTestCase(TestCase):
+    """Runs the tasks of `xchk_core.tasks` eagerly, with a repository of three exercises and coalescing enabled."""
+
+    def setUp(self):
+        from django.contrib.auth.models import User
+        self.tasks = _import_tasks()
+        self.eager = self.tasks.celery_app.conf.task_always_eager
+        self.tasks.celery_app.conf.task_always_eager = True
+        caches['default'].clear()
+        self.student = User.objects.create(username='student')
+        self.repo = Repo.objects.create(url='file:///dev/null',user=self.student,course='testcursus')
+        self.uids = ['oefening1','oefening2','oefening3']
+        self.key = coalesce.request_key(self.repo.id,self.uids,0)
+
+    def tearDown(self):
+        self.tasks.celery_app.conf.task_always_eager = self.eager
+
+    def _request(self):
+        return [SubmissionV2.objects.create(timestamp=datetime.datetime.now(),repo=self.repo,submitter=self.student,content_uid=uid) for uid in self.uids]
+
+    def _listen(self,group_name):
+        from channels.layers import get_channel_layer
+        channel_layer = get_channel_layer()
+        channel = async_to_sync(channel_layer.new_channel)()
+        async_to_sync(channel_layer.group_add)(group_name,channel)
+        return lambda: async_to_sync(channel_layer.receive)(channel)
+
+    def _states(self,submissions):
+        by_id = SubmissionV2.objects.in_bulk([submission.id for submission in submissions])
+        return [by_id[submission.id].state for submission in submissions]
+
+@unittest.skipUnless(celery,'celery is niet geïnstalleerd')
+class SharedResultTest(EagerTasksTestCase):
+
+    def test_subscribers_get_copied_states(self):
+        receive = self._listen('tweede')
+        (first,second,third) = (self._request(),self._request(),self._request())
+        (_,token) = coalesce.join(self.key,'eerste',[submission.id for submission in first])
+        self.assertEqual(coalesce.join(self.key,'tweede',[submission.id for submission in second]),(True,None))
+        coalesce.mark_running(token)
+        # HEAD may have moved for a request made while the batch was running
+        self.assertEqual(coalesce.join(self.key,'derde',[submission.id for submission in third]),(True,None))
+        for (submission,state) in zip(first,(SubmissionState.ACCEPTED,SubmissionState.NEW_REFUSED,SubmissionState.NOT_REACHED)):
+            (submission.state,submission.checksum) = (state,'abc')
+        result = ('oefening2',['analyse'])
+        with patch('xchk_core.repocache.get_repo_cache') as repo_cache_mock, patch.object(self.tasks,'publish_check') as publish_mock:
+            repo_cache_mock.return_value.head.return_value = 'def'
+            self.tasks._share_result(token,0,self.repo,first,result)
+        self.assertEqual([(submission.state,submission.checksum) for submission in SubmissionV2.objects.filter(id__in=[submission.id for submission in second]).order_by('id')],
+                         [(SubmissionState.ACCEPTED,'abc'),(SubmissionState.NEW_REFUSED,'abc'),(SubmissionState.NOT_REACHED,'abc')])
+        self.assertEqual(receive(),{'type': 'completion','last_reached_file': 'oefening2','analysis': ['analyse']})
+        publish_mock.assert_called_once_with(0,self.repo,[submission.id for submission in third],'derde')
+        self.assertEqual(set(SubmissionV2.objects.filter(id__in=[submission.id for submission in third]).values_list('state',flat=True)),{SubmissionState.PENDING})
+
+@unittest.skipUnless(celery,'celery is niet geïnstalleerd')
+class SpeculativeBatchTest(EagerTasksTestCase):
+
+    def _coalesced(self,first,second):
+        (_,token) = coalesce.join(self.key,'eerste',[submission.id for submission in first])
+        coalesce.join(self.key,'tweede',[submission.id for submission in second])
+        return token
+
+    def test_aggregation_stops_at_first_failure(self):
+        (first,second) = (self._request(),self._request())
+        token = self._coalesced(first,second)
+        (progress,subscriber) = (self._listen('eerste'),self._listen('tweede'))
+        # the third exercise was checked as well, but is not reached once the second one is refused
+        speculative_verdicts = [(int(SubmissionState.ACCEPTED),[],None),(int(SubmissionState.NEW_REFUSED),['fout'],None),(int(SubmissionState.ACCEPTED),[],None)]
+        result = self.tasks.aggregate_speculative_batch(speculative_verdicts,self.repo.id,[submission.id for submission in first],'abc',
+                                                        batchtype_id=0,group_name='eerste',coalesce_token=token)
+        self.assertEqual(result,('oefening2',['fout']))
+        expected_states = [SubmissionState.ACCEPTED,SubmissionState.NEW_REFUSED,SubmissionState.NOT_REACHED]
+        self.assertEqual(self._states(first),expected_states)
+        self.assertEqual([(event['content_uid'],event['state'],event['analysis']) for event in (progress(),progress(),progress())],
+                         [('oefening1',0,[]),('oefening2',int(SubmissionState.NEW_REFUSED),['fout']),('oefening3',int(SubmissionState.NOT_REACHED),[])])
+        self.assertEqual(self._states(second),expected_states)
+        self.assertEqual(subscriber(),{'type': 'completion','last_reached_file': 'oefening2','analysis': ['fout']})
+
+    def test_failed_batch_is_not_reached(self):
+        (first,second) = (self._request(),self._request())
+        token = self._coalesced(first,second)
+        (progress,subscriber) = (self._listen('eerste'),self._listen('tweede'))
+        self.tasks.fail_speculative_batch(None,RuntimeError('worker weg'),None,self.repo.id,[submission.id for submission in first],'abc',
+                                          batchtype_id=0,group_name='eerste',coalesce_token=token)
+        self.assertEqual(self._states(first),[SubmissionState.NOT_REACHED] * 3)
+        self.assertEqual([progress()['state'] for _ in first],[int(SubmissionState.NOT_REACHED)] * 3)
+        self.assertEqual(progress()['type'],'completion')
+        self.assertEqual(self._states(second),[SubmissionState.NOT_REACHED] * 3)
+        self.assertEqual(subscriber()['last_reached_file'],'oefening1')
+
+    def test_chord_has_error_handler(self):
+        submissions = self._request()
+        with patch('xchk_core.repocache.get_repo_cache'),patch.dict(courses.courses(),{'testcursus': Mock(solutions_url='file:///dev/null')}):
+            speculative_chord = self.tasks._speculative_chord(0,self.repo,submissions,'eerste',None)
+        self.assertEqual(len(speculative_chord.tasks),3)
+        self.assertEqual([errback['task'] for errback in speculative_chord.body.options['link_error']],['xchk_core.tasks.fail_speculative_batch'])
+
+    @override_settings(XCHK_SPECULATIVE_BATCHES=True)
+    def test_eager_app_checks_regularly(self):
+        submissions = [SubmissionV2.objects.create(timestamp=datetime.datetime.now(),repo=self.repo,submitter=self.student,content_uid='progress_accepted') for _ in range(2)]
+        with patch.object(self.tasks,'_check_batch',return_value=('progress_accepted',[])) as check_batch_mock,\
+             patch.object(self.tasks,'_speculative_chord') as chord_mock:
+            self.tasks.publish_check(0,self.repo,[submission.id for submission in submissions],'eerste')
+        check_batch_mock.assert_called_once()
+        chord_mock.assert_not_called()
+
 if __name__ == '__main__':
     unittest.main()
 
@@ -0,0 +1,44 @@
+"""Cache of strategy verdicts, so unchanged work is not checked again.
+
+A verdict is identified by the student commit, the exercise, the model solution commit and the fingerprint of the strategy,
+so it is never reused once any of these changes. Verdicts live in the Django cache named by `XCHK_VERDICT_CACHE_ALIAS`
+for `XCHK_VERDICT_CACHE_TIMEOUT` seconds. Setting the alias to `None` disables the cache.
+Bump `XCHK_VERDICT_CACHE_VERSION` to drop all verdicts, e.g. when code used by checks changed outside their `check_submission`.
+"""
+import hashlib
+from django.conf import settings
+from django.core.cache import caches
+from .models import SubmissionState
+
+DEFAULT_TIMEOUT = 24 * 3600
+CACHE_KEY_PREFIX = 'xchk-verdict'
+
+# only verdicts that follow from the submitted files alone
+CACHEABLE_STATES = (SubmissionState.ACCEPTED,SubmissionState.NEW_REFUSED)
+
+def _cache():
+    alias = getattr(settings,'XCHK_VERDICT_CACHE_ALIAS','default')
+    return caches[alias] if alias is not None else None
+
+def verdict_key(checksum,content_uid,solutions_commit,strategy):
+    parts = [checksum,content_uid,solutions_commit,strategy.fingerprint(),str(getattr(settings,'XCHK_VERDICT_CACHE_VERSION',1))]
+    return f"{CACHE_KEY_PREFIX}-{hashlib.sha256('|'.join(parts).encode('utf-8')).hexdigest()}"
+
+def is_cacheable(strategy):
+    # checks with side effects depend on the batch type environment, not just on the commit
+    return not strategy.component_checks()
+
+def get_verdict(checksum,content_uid,solutions_commit,strategy):
+    """Returns the cached `(state, analysis)` for this combination, or `None`."""
+    cache = _cache()
+    if cache is None or not is_cacheable(strategy):
+        return None
+    return cache.get(verdict_key(checksum,content_uid,solutions_commit,strategy))
+
+def store_verdict(checksum,content_uid,solutions_commit,strategy,state,analysis):
+    cache = _cache()
+    if cache is None or not is_cacheable(strategy) or state not in CACHEABLE_STATES:
+        return
+    cache.set(verdict_key(checksum,content_uid,solutions_commit,strategy),
+              (state,analysis),
+              getattr(settings,'XCHK_VERDICT_CACHE_TIMEOUT',DEFAULT_TIMEOUT))
@@ -11,11 +11,11 @@ import datetime
 import re
 import requests
 import itertools
-import graphviz as gv
 from .forms import CheckRequestFormSet, RepoSelectionForm, BatchTypeForm, FeedbackForm
 from .models import Repo, SubmissionState
-from . import courses
+from . import contentviews, courses, overviews
 from django.forms import ChoiceField
+from django.views.decorators.http import condition
 
 @login_required
 def submission_view(request,submission_pk):
@@ -24,28 +24,20 @@ def submission_view(request,submission_pk):
     else:
         return HttpResponseForbidden("Enkel beheerders mogen submissies bekijken")
 
+def _course_overview_etag(request,course_title):
+    # page also depends on who is looking at it
+    return f'{overviews.overview_key(course_title)}-{request.user.pk}'
+
 @login_required
+@condition(etag_func=_course_overview_etag)
 def new_course_view(request,course_title):
-    course = courses.courses()[course_title]
-    graph = courses.course_graphs()[course_title]
-    for v in graph.vs:
-        uid = v["contentview"].uid
-        if uid != 'impossible_node':
-            v["URL"] = reverse(f'{v["contentview"].uid}_view')
-        else:
-            v["URL"] = reverse(f'checkerapp:{v["contentview"].uid}_view')
-    graph.write_dot(f'/tmp/{course_title}.gv')
-    with open(f'/tmp/{course_title}.gv') as fh:
-        dotfile = fh.read()
-        print(dotfile)
-        outpath = gv.render('dot','svg',f'/tmp/{course_title}.gv')
-        with open(outpath) as fh2:
-            return render(request,'checkerapp/course_overview2.html',{'graph':fh2.read()})
+    (_,svg) = overviews.course_overview(course_title)
+    return render(request,'checkerapp/course_overview2.html',{'graph':svg})
 
 @login_required
 def check_scripts_view(request):
     repos = Repo.objects.filter(user=request.user)
-    nodes = Node.objects.all()
+    nodes = contentviews.contentview_registry().values()
     if repos:
         batchtypeform = BatchTypeForm()
         repoform = RepoSelectionForm(owner=request.user)
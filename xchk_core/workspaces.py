@@ -0,0 +1,80 @@
+"""Isolated working directories for checking tasks.
+
+Each task gets its own directory under `XCHK_WORKSPACE_DIR` (or the system temp dir),
+so several tasks can run side by side on one worker node.
+"""
+import logging
+import os
+import shutil
+import tempfile
+from contextlib import ExitStack
+from django.conf import settings
+from . import fileindex
+
+logger = logging.getLogger(__name__)
+
+class Workspace:
+    """Holds a student checkout and a model solution checkout for a single task.
+
+    Use as a context manager: on exit, the batch type cleans up, checkouts are released and the directory is removed,
+    whether or not checking succeeded."""
+
+    def __init__(self,batchtype=None,prefix='xchk-'):
+        self.batchtype = batchtype
+        self.root = tempfile.mkdtemp(prefix=prefix,dir=getattr(settings,'XCHK_WORKSPACE_DIR',None))
+        # checks may run student code as another user, which has to reach the checkouts
+        os.chmod(self.root,0o755)
+        self.student_dir = os.path.join(self.root,'studentrepo')
+        self.model_dir = os.path.join(self.root,'modeloplossingen')
+        self._exit_stack = ExitStack()
+        self._preparations = []
+        self._failed_preparation = None
+
+    def checkout(self,repo_cache,url,dest,commit='HEAD',update=True,sparse_paths=None):
+        """Checks out `url` at `dest` through `repo_cache` for the lifetime of this workspace and returns the commit hash."""
+        return self._exit_stack.enter_context(repo_cache.worktree(url,dest,commit=commit,update=update,sparse_paths=sparse_paths))
+
+    def index_files(self,path,from_git_tree=True):
+        """Registers a `fileindex.FileIndex` of the checkout at `path` until the workspace is closed.
+
+        Without `from_git_tree`, the directory is scanned instead, e.g. when only part of the tree was checked out."""
+        index = fileindex.FileIndex.from_git_tree(path) if from_git_tree else fileindex.FileIndex.scan(path)
+        fileindex.register(path,index)
+        self._exit_stack.callback(fileindex.invalidate,path)
+        return index
+
+    def defer(self,preparation):
+        """Registers a callable that fills the workspace, to be run by `prepare` only when the workspace is really needed."""
+        self._preparations.append(preparation)
+
+    def prepare(self):
+        """Runs the registered preparations that have not run yet.
+
+        Once a preparation fails, this and every later call raise its error, so nothing is checked in a half-filled workspace."""
+        if self._failed_preparation is not None:
+            raise self._failed_preparation
+        while self._preparations:
+            try:
+                self._preparations.pop(0)()
+            except Exception as e:
+                self._failed_preparation = e
+                raise
+
+    def close(self):
+        try:
+            if self.batchtype is not None:
+                self.batchtype.cleanup(self.student_dir,self.model_dir)
+        except Exception as e:
+            logger.exception('Fout bij opruimen batchtype: %s',e)
+        finally:
+            try:
+                self._exit_stack.close()
+            finally:
+                shutil.rmtree(self.root,ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        self.close()
+        return False